@@ -0,0 +1,125 @@
+## On-disk cache of hidden-state activity (forw_mat of train_decoder()), so that analyses of the same
+## network on the same data set read the activity instead of re-running the network.
+## Entries are keyed by (hash of network weights, data generator parameters, data seed) and stored as
+## float32 .npy files that are loaded memory-mapped. Least recently used entries are evicted when the
+## total size exceeds the budget. Entries can be compressed (see compression.py), these are not memory-mapped.
+## Only seeded data sets are cached (unseeded analyses generate new random data on every call). Switch the
+## cache on for a session, with a default data seed for analyses that are not given one, with:
+##   activity_cache.set_default_cache(cache_folder='activity_cache/', data_seed=0)
+## All entry points (train_multiple_decoders(), plotting functions etc.) then reuse the cached activity.
+
+import numpy as np
+import os, json, hashlib, shutil
+import compression
+
+_default_cache = None  # cache used by train_single_decoder_new_data(), see set_default_cache()
+_default_data_seed = None  # data seed of analyses that are not given one, see get_data_seed()
+
+def set_default_cache(cache_folder='activity_cache/', max_size_gb=2.0, codec=None, level=None, data_seed=None):
+    """Use an ActivityCache in cache_folder for all analyses that take a data_seed. Returns the cache.
+    If data_seed is given, analyses that are called without data_seed use it (see get_data_seed()), so that
+    their activity is cached too. Use cache_folder=None to switch caching (and the default data seed) off."""
+    global _default_cache, _default_data_seed
+    _default_cache = None if cache_folder is None else ActivityCache(cache_folder=cache_folder, max_size_gb=max_size_gb,
+                                                                      codec=codec, level=level)
+    _default_data_seed = None if cache_folder is None else data_seed
+    return _default_cache
+
+def get_data_seed(data_seed=None):
+    """data_seed if given, else the default data seed of set_default_cache() (None: new random data)."""
+    return _default_data_seed if data_seed is None else data_seed
+
+def get_default_cache():
+    """Return cache set by set_default_cache() (None if not set)."""
+    return _default_cache
+
+def hash_weights(rnn):
+    """Hash (sha1 hex digest) of all parameters of torch model rnn."""
+    state_dict = rnn.state_dict()
+    hasher = hashlib.sha1()
+    for name in sorted(state_dict.keys()):
+        hasher.update(name.encode())
+        hasher.update(state_dict[name].detach().cpu().numpy().tobytes())
+    return hasher.hexdigest()
+
+
+class ActivityCache():
+    def __init__(self, cache_folder='activity_cache/', max_size_gb=2.0, codec=None, level=None):
+        '''Cache of forward activity in cache_folder (one sub folder per entry), of at most
+        max_size_gb gigabytes. New entries are compressed with codec at level (see compression.py).'''
+        self.cache_folder = cache_folder
+        self.codec = compression.resolve_codec(codec)
+        self.level = level
+        self.max_size = int(max_size_gb * 1e9)
+        self.array_names = ['train', 'test', 'labels_train', 'labels_test']
+        if not os.path.exists(self.cache_folder):
+            os.makedirs(self.cache_folder)
+
+    def __repr__(self):
+        return f'Activity cache in {self.cache_folder} ({len(self.list_entries())} entries, {self.get_size() / 1e9:.2f}/{self.max_size / 1e9:.2f} GB)'
+
+    def get_key(self, rnn, data_params, data_seed):
+        '''Key of activity of rnn on the data set generated with data_params (dict of keyword
+        arguments of the data generator) and data_seed.'''
+        hasher = hashlib.sha1()
+        hasher.update(hash_weights(rnn).encode())
+        hasher.update(type(rnn).__name__.encode())
+        hasher.update(json.dumps(data_params, sort_keys=True, default=str).encode())
+        hasher.update(str(int(data_seed)).encode())
+        return hasher.hexdigest()
+
+    def list_entries(self):
+        return [x for x in os.listdir(self.cache_folder) if os.path.isdir(os.path.join(self.cache_folder, x)) and x[0] != '.']
+
+    def get_size(self, key=None):
+        '''Size in bytes of entry key, or of whole cache if key is None.'''
+        list_keys = self.list_entries() if key is None else [key]
+        return np.sum([os.path.getsize(os.path.join(self.cache_folder, k, f)) for k in list_keys
+                       for f in os.listdir(os.path.join(self.cache_folder, k))], dtype=int)
+
+    def load(self, key):
+        '''Return forw_mat dict of entry key (activity memory-mapped, read only), or None if not cached.'''
+        path = os.path.join(self.cache_folder, key)
+        if not os.path.isdir(path):
+            return None
+        try:
+            forw_mat = {name: compression.load_array_file(os.path.join(path, name + '.npy'), mmap_mode=('r' if name in ['train', 'test'] else None))
+                        for name in self.array_names}
+        except (OSError, ValueError):  # eg evicted by another process while loading
+            return None
+        os.utime(path)  # mark as recently used
+        return forw_mat
+
+    def save(self, key, forw_mat):
+        '''Save forw_mat dict (train, test, labels_train, labels_test) as entry key, then evict
+        least recently used entries if the cache is larger than its budget.'''
+        path = os.path.join(self.cache_folder, key)
+        tmp_path = os.path.join(self.cache_folder, f'.tmp_{key}_{os.getpid()}')  # written first, then renamed (atomic)
+        os.makedirs(tmp_path, exist_ok=True)
+        for name in self.array_names:
+            arr = np.asarray(forw_mat[name])
+            compression.save_array(os.path.join(tmp_path, name + '.npy'), arr.astype(np.float32) if name in ['train', 'test'] else arr.astype(str),
+                                   codec=self.codec, level=self.level)  # labels without pickle
+        try:
+            os.rename(tmp_path, path)
+        except OSError:  # entry was saved concurrently
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        '''Delete least recently used entries (except keep) until the cache fits in its budget.'''
+        list_keys = self.list_entries()
+        last_used = {k: os.path.getmtime(os.path.join(self.cache_folder, k)) for k in list_keys}
+        sizes = {k: self.get_size(key=k) for k in list_keys}
+        total_size = np.sum(list(sizes.values()), dtype=int)
+        for k in sorted(list_keys, key=lambda x: last_used[x]):  # oldest first
+            if total_size <= self.max_size:
+                break
+            if k == keep:
+                continue
+            shutil.rmtree(os.path.join(self.cache_folder, k), ignore_errors=True)
+            total_size -= sizes[k]
+
+    def clear(self):
+        for k in self.list_entries():
+            shutil.rmtree(os.path.join(self.cache_folder, k), ignore_errors=True)
@@ -12,17 +12,25 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 from torch.utils.data import TensorDataset, DataLoader
-import pickle, datetime, time, os, sys, git
+import pickle, datetime, time, os, sys, git, collections
+from multiprocessing import Pool
 from tqdm import tqdm, trange
-import sklearn.svm, sklearn.model_selection, sklearn.discriminant_analysis
 import rot_utilities as ru
+import decoders
+import activity_cache
+import rnn_io
+import model_catalog
+import model_cache
+import model_prefetch
 
 def generate_synt_data(n_total=100, n_times=9, n_freq=8,
                        ratio_train=0.8, ratio_exp=0.5,
                        noise_scale=0.05, double_length=False,
-                       late_beta=False):
-    '''Generate synthetic data, see notebook for description.'''
+                       late_beta=False, rng=None):
+    '''Generate synthetic data, see notebook for description. rng (np.random.Generator)
+    is used for the stratified train/test split and noise.'''
     assert ratio_train <= 1 and ratio_train >= 0
+    rng = ru.get_rng(rng=rng)
     n_total = int(n_total)
     n_half_total = int(np.round(n_total / 2))
     assert ratio_exp <=1 and ratio_exp >= 0
@@ -81,16 +89,14 @@ def generate_synt_data(n_total=100, n_times=9, n_freq=8,
     assert n_train + n_test == n_total
 
     ## Train/test data:
-    sss = sklearn.model_selection.StratifiedShuffleSplit(n_splits=1, train_size=ratio_train).split(X=np.zeros_like(labels),
-                                                                                 y=labels) # stratified split
-    train_inds, test_inds = next(sss)  # generate
+    train_inds, test_inds = ru.stratified_split(labels=labels, ratio_train=ratio_train, rng=rng)  # stratified split
     train_seq = all_seq[train_inds, :, :]
     labels_train = labels[train_inds]
     test_seq = all_seq[test_inds, :, :]
     labels_test = labels[test_inds]
-    x_train = train_seq[:, :-1, :] + (np.random.randn(n_train, n_times - 1, n_freq) * noise_scale)  # add noise to input
+    x_train = train_seq[:, :-1, :] + (rng.standard_normal((n_train, n_times - 1, n_freq)) * noise_scale)  # add noise to input
     y_train = train_seq[:, 1:, :]  # do not add noise to output
-    x_test = test_seq[:, :-1, :] + (np.random.randn(n_test, n_times - 1, n_freq) * noise_scale)
+    x_test = test_seq[:, :-1, :] + (rng.standard_normal((n_test, n_times - 1, n_freq)) * noise_scale)
     y_test = test_seq[:, 1:, :]
     x_train, y_train, x_test, y_test = map(
         torch.tensor, (x_train, y_train, x_test, y_test))  # create tensors
@@ -162,9 +168,10 @@ class RNN(nn.Module):
         for key, val in param_dict.items():
             self.info_dict[key] = val  # overwrites
 
-    def save_model(self, folder=None, verbose=True, add_nnodes=False):
+    def save_model(self, folder=None, verbose=True, add_nnodes=False, file_format='structured'):
         '''Export this RNN model to folder. If self.file_name is None, it is saved  under
-        a timestamp.'''
+        a timestamp. file_format is 'structured' (see rnn_io.py) or 'pickle' (whole object, old format).
+        The file is written atomically (see rnn_io.write_atomic()), and a file of the same name is overwritten.'''
         dt = datetime.datetime.now()
         timestamp = str(dt.date()) + '-' + str(dt.hour).zfill(2) + str(dt.minute).zfill(2)
         self.info_dict['timestamp'] = timestamp
@@ -180,8 +187,12 @@ class RNN(nn.Module):
         elif folder[-1] != '/':
             folder += '/'
         self.full_path = folder + self.file_name
-        file_handle = open(self.full_path, 'wb')
-        pickle.dump(self, file_handle)
+        if file_format == 'structured':
+            rnn_io.write_atomic(path=self.full_path, write_function=lambda file_handle: rnn_io.write_model(rnn=self, file_handle=file_handle))
+        else:
+            rnn_io.write_atomic(path=self.full_path, write_function=lambda file_handle: pickle.dump(self, file_handle))
+        model_cache.invalidate(path=self.full_path)
+        model_catalog.update_default_catalog(path=self.full_path)
         if verbose > 0:
             print(f'RNN model saved as {self.file_name}')
 
@@ -221,9 +232,10 @@ class RNN_MNM(RNN):
             self.history_mnm = new_hist  # save for next iter
         return new_state, output
 
-    def save_model(self, folder=None, verbose=True, add_nnodes=False):  # redefine because we want to change saving name
+    def save_model(self, folder=None, verbose=True, add_nnodes=False, file_format='structured'):  # redefine because we want to change saving name
         '''Export this RNN model to folder. If self.file_name is None, it is saved  under
-        a timestamp.'''
+        a timestamp. file_format is 'structured' (see rnn_io.py) or 'pickle' (whole object, old format).
+        The file is written atomically (see rnn_io.write_atomic()), and a file of the same name is overwritten.'''
         dt = datetime.datetime.now()
         timestamp = str(dt.date()) + '-' + str(dt.hour).zfill(2) + str(dt.minute).zfill(2)
         self.info_dict['timestamp'] = timestamp
@@ -239,8 +251,12 @@ class RNN_MNM(RNN):
         elif folder[-1] != '/':
             folder += '/'
         self.full_path = folder + self.file_name
-        file_handle = open(self.full_path, 'wb')
-        pickle.dump(self, file_handle)
+        if file_format == 'structured':
+            rnn_io.write_atomic(path=self.full_path, write_function=lambda file_handle: rnn_io.write_model(rnn=self, file_handle=file_handle))
+        else:
+            rnn_io.write_atomic(path=self.full_path, write_function=lambda file_handle: pickle.dump(self, file_handle))
+        model_cache.invalidate(path=self.full_path)
+        model_catalog.update_default_catalog(path=self.full_path)
         if verbose > 0:
             print(f'RNN-MNM model saved as {self.file_name}')
 
@@ -550,9 +566,9 @@ def bptt_training_sa(rnn, optimiser, dict_training_params,
         return rnn
 
 
-def train_decoder(rnn_model, x_train, x_test, labels_train, labels_test,
-                  save_inplace=True, label_name='alpha', sparsity_c=1e-1, 
-                  bool_train_decoder=True, decoder_type='logistic_regression'):
+def compute_forward_activity(rnn_model, x_train, x_test):
+    """Forward runs of rnn_model on train and test trials; returns forw_mat dict with hidden
+    states (trials x time x neurons) of 'train' and 'test'."""
     n_nodes = rnn_model.info_dict['n_nodes']
     forw_mat = {'train': np.zeros((x_train.shape[0], x_train.shape[1], n_nodes)),  # trials x time x neurons
                 'test': np.zeros((x_test.shape[0], x_test.shape[1], n_nodes))}
@@ -577,45 +593,45 @@ def train_decoder(rnn_model, x_train, x_test, labels_train, labels_test,
                 hidden_state, output = rnn_model.forward(inp=x_test[kk, tau, :],
                                                    rnn_state=hidden_state)
                 forw_mat['test'][kk, tau, :] = hidden_state.numpy()
+    return forw_mat
 
-        if bool_train_decoder:
-            ## Train decoder
-            alpha_labels = {'train': np.array([int(x[0]) for x in labels_train]),
-                            'test': np.array([int(x[0]) for x in labels_test])}
-            beta_labels = {'train': np.array([int(x[1]) for x in labels_train]),
-                           'test': np.array([int(x[1]) for x in labels_test])}
-            if label_name == 'alpha':
-                labels_use = alpha_labels
-            elif label_name == 'beta':
-                labels_use = beta_labels
-            else:
-                print(f'Label name {label_name} not implemented. Please choose alpha or beta. Aborting')
+def train_decoder(rnn_model, x_train, x_test, labels_train, labels_test,
+                  save_inplace=True, label_name='alpha', sparsity_c=1e-1, 
+                  bool_train_decoder=True, decoder_type='logistic_regression', warm_start=False,
+                  forw_mat=None, window=1, window_mode='mean', reg_param=0.0):
+    '''label_name can be alpha, beta or a list of both (decoded from the same forward runs,
+    score_mat and decoder_dict are then returned as dicts with labels as keys).
+    If forw_mat (output of compute_forward_activity()) is given, the forward runs are skipped.
+    If window > 1, decoders use time windows of window time points (see decoders.window_features()),
+    so score_mat has one row/column per window. reg_param regularises the covariances of LDA/QDA decoders
+    (see decoders.fit_discriminant()).'''
+    list_labels = [label_name] if type(label_name) is str else list(label_name)
+    if forw_mat is None:
+        forw_mat = compute_forward_activity(rnn_model=rnn_model, x_train=x_train, x_test=x_test)
+
+    if bool_train_decoder:
+        ## Train decoder
+        alpha_labels = {'train': np.array([int(x[0]) for x in labels_train]),
+                        'test': np.array([int(x[0]) for x in labels_test])}
+        beta_labels = {'train': np.array([int(x[1]) for x in labels_train]),
+                       'test': np.array([int(x[1]) for x in labels_test])}
+        labels_dict = {'alpha': alpha_labels, 'beta': beta_labels}
+        score_mat, decoder_dict = {}, {}
+        for lab in list_labels:  # all representations are decoded from the same forward runs
+            if lab not in labels_dict.keys():
+                print(f'Label name {lab} not implemented. Please choose alpha or beta. Aborting')
                 return None
-            score_mat = np.zeros((n_times, n_times))  # T x T
-            decoder_dict = {}  # save decoder per time
-            tmp_var = True
-            for tau in range(n_times):  # train time loop
-                # decoder_dict[tau] = sklearn.svm.LinearSVC(C=sparsity_c)  # define SVM
-                if decoder_type == 'logistic_regression':
-                    decoder_dict[tau] = sklearn.linear_model.LogisticRegression(C=sparsity_c,
-                                                            solver='saga', penalty='l1', max_iter=250)  # define log reg
-                elif decoder_type == 'LDA':
-                     decoder_dict[tau] = sklearn.discriminant_analysis.QuadraticDiscriminantAnalysis()  # define log reg
-                decoder_dict[tau].fit(X=forw_mat['train'][:, tau, :],
-                                      y=labels_use['train'])  # train SVM
-                for tt in range(n_times):  # test time loop
-                    # score_mat[tau, tt] = decoder_dict[tau].score(X=forw_mat['test'][:, tt, :],
-                    #                                              y=labels_use['test'])  # evaluate
-                    prediction = decoder_dict[tau].predict_proba(X=forw_mat['test'][:, tt, :])
-                    inds_labels = np.zeros_like(labels_use['test'])  # zero = class 0
-                    inds_labels[(labels_use['test'] == decoder_dict[tau].classes_[1])] = 1
-                    prob_correct = np.array([prediction[i_pred, ind] for i_pred, ind in enumerate(inds_labels)])
-                    score_mat[tau, tt] = np.mean(prob_correct)
-                    # score_mat[tau, tt] = np.exp(np.mean(np.log(prob_correct)))
+            score_mat[lab], decoder_dict[lab] = decoders.train_crosstemp(activity_train=forw_mat['train'], labels_train=labels_dict[lab]['train'],
+                                                                         activity_test=forw_mat['test'], labels_test=labels_dict[lab]['test'],
+                                                                         decoder_type=decoder_type, C=sparsity_c, warm_start=warm_start,
+                                                                         window=window, window_mode=window_mode, reg_param=reg_param)
     if bool_train_decoder:
         if save_inplace:
-            rnn_model.decoding_crosstemp_score[label_name] = score_mat
-            rnn_model.decoder_dict[label_name] = decoder_dict
+            for lab in list_labels:
+                rnn_model.decoding_crosstemp_score[lab] = score_mat[lab]
+                rnn_model.decoder_dict[lab] = decoder_dict[lab]
+        if type(label_name) is str:
+            return score_mat[label_name], decoder_dict[label_name], forw_mat
         return score_mat, decoder_dict, forw_mat
     else:
         return None, None, forw_mat
@@ -722,53 +738,110 @@ def init_train_save_rnn_sa(t_dict, d_dict, n_simulations=1, save_folder='models/
 def train_single_decoder_new_data(rnn, ratio_expected=0.5, label='alpha',
                                   n_samples=None, ratio_train=0.8, verbose=False,
                                   sparsity_c=0.1, bool_train_decoder=True,
-                                  late_beta=False, decoder_type='LDA'):
-    '''Generates new data, and then trains the decoder via train_decoder()'''
+                                  late_beta=False, decoder_type='QDA', warm_start=False,
+                                  data_seed=None, reg_param=0.0):
+    '''Generates new data, and then trains the decoder via train_decoder().
+    If data_seed is given, data generation and forward runs are seeded by it, and the forward
+    activity is read from/written to the activity cache (see activity_cache.set_default_cache()). If data_seed
+    is None, the default data seed of the activity cache is used, if set (see activity_cache.get_data_seed()).
+    reg_param regularises the covariances of LDA/QDA decoders (see decoders.fit_discriminant()).'''
+    data_seed = activity_cache.get_data_seed(data_seed=data_seed)
     if n_samples is None:
         n_samples = rnn.info_dict['n_total']
 
     ## Generate data:
-    tmp0, tmp1 = generate_synt_data(n_total=n_samples,
-                                   n_times=rnn.info_dict['n_times'],
-                                   n_freq=rnn.info_dict['n_freq'],
-                                   ratio_train=ratio_train,
-                                   ratio_exp=ratio_expected,
-                                   noise_scale=rnn.info_dict['noise_scale'],
-                                   double_length=rnn.info_dict['doublesse'],
-                                   late_beta=late_beta)
-    x_train, y_train, x_test, y_test = tmp0
-    labels_train, labels_test = tmp1
+    data_params = {'n_total': n_samples, 'n_times': rnn.info_dict['n_times'], 'n_freq': rnn.info_dict['n_freq'],
+                   'ratio_train': ratio_train, 'ratio_exp': ratio_expected, 'noise_scale': rnn.info_dict['noise_scale'],
+                   'double_length': rnn.info_dict['doublesse'], 'late_beta': late_beta}
+    cache = activity_cache.get_default_cache() if data_seed is not None else None
+    if cache is not None:
+        cache_key = cache.get_key(rnn=rnn, data_params=data_params, data_seed=data_seed)
+        forward_mat = cache.load(key=cache_key)
+    else:
+        forward_mat = None
+    if forward_mat is None:
+        tmp0, tmp1 = generate_synt_data(**data_params,
+                                        rng=None if data_seed is None else np.random.default_rng(data_seed))
+        x_train, y_train, x_test, y_test = tmp0
+        labels_train, labels_test = tmp1
+        with torch.random.fork_rng(devices=[], enabled=(data_seed is not None)):  # seed initial states without changing global seed
+            if data_seed is not None:
+                torch.manual_seed(data_seed)
+            forward_mat = compute_forward_activity(rnn_model=rnn, x_train=x_train, x_test=x_test)
+        forward_mat['labels_train'] = labels_train
+        forward_mat['labels_test'] = labels_test
+        if cache is not None:
+            cache.save(key=cache_key, forw_mat=forward_mat)
+    else:
+        labels_train, labels_test = forward_mat['labels_train'], forward_mat['labels_test']
     if verbose > 0:
         print('train labels ', {x: np.sum(labels_train == x) for x in np.unique(labels_train)})
     ## Train decoder:
-    score_mat, decoder_dict, forward_mat = train_decoder(rnn_model=rnn, x_train=x_train, x_test=x_test,
+    score_mat, decoder_dict, forward_mat = train_decoder(rnn_model=rnn, x_train=None, x_test=None,
                                            labels_train=labels_train, labels_test=labels_test,
                                            save_inplace=True, sparsity_c=sparsity_c, label_name=label,
-                                           bool_train_decoder=bool_train_decoder, decoder_type=decoder_type)
-    forward_mat['labels_train'] = labels_train
-    forward_mat['labels_test'] = labels_test
+                                           bool_train_decoder=bool_train_decoder, decoder_type=decoder_type,
+                                           warm_start=warm_start, forw_mat=forward_mat, reg_param=reg_param)
     return score_mat, decoder_dict, forward_mat
 
+def decode_rnn_file(rnn_path, ratio_expected=0.5, n_samples=None, ratio_train=0.8, label='alpha',
+                    reset_decoders=False, data_seed=None, verbose=False):
+    '''Load RNN of rnn_path, train its decoders (see train_multiple_decoders()) and save it in place.'''
+    rnn = rnn_io.load_model(path=rnn_path)
+    return _decode_and_save(rnn=rnn, rnn_folder=os.path.dirname(rnn_path) + '/', ratio_expected=ratio_expected,
+                            n_samples=n_samples, ratio_train=ratio_train, label=label, reset_decoders=reset_decoders,
+                            data_seed=data_seed, verbose=verbose)
+
+def _decode_and_save(rnn, rnn_folder, ratio_expected, n_samples, ratio_train, label, reset_decoders, data_seed, verbose):
+    if reset_decoders:
+        rnn.decoding_crosstemp_score = {}
+        rnn.decoder_dict = {}
+    if 'late_beta' in rnn.info_dict.keys():
+        late_beta = rnn.info_dict['late_beta']
+    else:
+        late_beta = False
+    _ = train_single_decoder_new_data(rnn=rnn, ratio_expected=ratio_expected,
+                                      n_samples=n_samples, ratio_train=ratio_train,
+                                      verbose=verbose, label=label, late_beta=late_beta,
+                                      data_seed=data_seed) # results are saved in RNN class
+    rnn.save_model(folder=rnn_folder, verbose=0)  # save results to file
+    return True
+
+def init_decoding_worker():
+    '''Initialise worker process of train_multiple_decoders(): one torch thread per process, and
+    fresh random states (forked workers would otherwise all generate the same data).'''
+    torch.set_num_threads(1)
+    np.random.seed()
+    torch.manual_seed(np.random.randint(np.iinfo(np.int32).max))
+
 def train_multiple_decoders(rnn_folder='models/', ratio_expected=0.5,
                             n_samples=None, ratio_train=0.8, label='alpha', 
-                            reset_decoders=False):
-    '''train decoders for all RNNs in rnn_folder'''
+                            reset_decoders=False, data_seed=None, n_processes=1, max_queued=None):
+    '''train decoders for all RNNs in rnn_folder. If data_seed is given (or the default data seed of the
+    activity cache is set), all RNNs are decoded on the same data set and their activity is cached (see activity_cache.py).
+    If n_processes > 1, RNNs are decoded in parallel by a pool of processes, with at most max_queued
+    (default 2 * n_processes) RNNs submitted at a time (as bptt_rnn_mtl.train_multiple_decoders()).'''
     rnn_list = [x for x in os.listdir(rnn_folder) if x[-5:] == '.data']
-    for i_rnn, rnn_name in tqdm(enumerate(rnn_list)):
-        ## Load RNN:
-        with open(rnn_folder + rnn_name, 'rb') as f:
-            rnn = pickle.load(f)
-        if reset_decoders:
-            rnn.decoding_crosstemp_score = {}
-            rnn.decoder_dict = {}
-        if 'late_beta' in rnn.info_dict.keys():
-            late_beta = rnn.info_dict['late_beta']
-        else:
-            late_beta = False
-        _ = train_single_decoder_new_data(rnn=rnn, ratio_expected=ratio_expected,
-                                          n_samples=n_samples, ratio_train=ratio_train,
-                                          verbose=(i_rnn == 0), label=label, late_beta=late_beta) # results are saved in RNN class
-        rnn.save_model(folder=rnn_folder, verbose=0)  # save results to file
+    if rnn_folder[-1] != '/':
+        rnn_folder += '/'
+    kwargs = {'ratio_expected': ratio_expected, 'n_samples': n_samples, 'ratio_train': ratio_train, 'label': label,
+              'reset_decoders': reset_decoders, 'data_seed': activity_cache.get_data_seed(data_seed=data_seed)}
+    if n_processes == 1:
+        for i_rnn, (_, rnn) in tqdm(enumerate(model_prefetch.iter_models(paths=[rnn_folder + x for x in rnn_list], use_cache=False))):
+            _decode_and_save(rnn=rnn, rnn_folder=rnn_folder, verbose=(i_rnn == 0), **kwargs)
+        return None
+    if max_queued is None:
+        max_queued = 2 * n_processes
+    queue = collections.deque()  # bounded queue of submitted RNNs
+    with Pool(n_processes, initializer=init_decoding_worker) as pool, tqdm(total=len(rnn_list), unit='rnn') as pbar:
+        for rnn_name in rnn_list:
+            if len(queue) >= max_queued:  # wait for oldest before submitting more
+                queue.popleft().get()
+                pbar.update(1)
+            queue.append(pool.apply_async(decode_rnn_file, kwds={'rnn_path': rnn_folder + rnn_name, **kwargs}))
+        while len(queue) > 0:
+            queue.popleft().get()
+            pbar.update(1)
     return None
 
 def aggregate_convergence(model_folder='models/', check_info_dict=True):
@@ -781,19 +854,17 @@ def aggregate_convergence(model_folder='models/', check_info_dict=True):
     list_models = [x for x in os.listdir(model_folder) if x[-5:] == '.data']
     list_loss = {'train': [], 'test': []}
     arr_loss = {}
-    for ii, mn in enumerate(list_models):
-        with open(model_folder + mn, 'rb') as f:
-            model = pickle.load(f)
+    for ii, (mn, (_, model)) in enumerate(zip(list_models, model_prefetch.iter_fields(paths=[model_folder + x for x in list_models],
+                                                                                    fields=['info_dict', 'train_loss_arr', 'test_loss_arr']))):
         if ii > 0  and check_info_dict: # check if dicts with info are equal
             for cp in check_params:
-                assert (model.info_dict[cp] == prev_model.info_dict[cp]), f'AssertionError: models {prev_name} and {mn} are different'
-            assert (model.info_dict['eval_times'] == prev_model.info_dict['eval_times']).all(), f'AssertionError: models {prev_name} and {mn} are different'
+                assert (model['info_dict'][cp] == prev_model['info_dict'][cp]), f'AssertionError: models {prev_name} and {mn} are different'
+            assert (np.array(model['info_dict']['eval_times']) == np.array(prev_model['info_dict']['eval_times'])).all(), f'AssertionError: models {prev_name} and {mn} are different'
 
-        list_loss['train'].append(model.train_loss_arr)  # append training loss array
-        list_loss['test'].append(model.test_loss_arr)
+        list_loss['train'].append(model['train_loss_arr'])  # append training loss array
+        list_loss['test'].append(model['test_loss_arr'])
         prev_model = model
         prev_name = mn
-        f.close()
     for tt in ['train', 'test']:
         len_loss = []
         for tl in list_loss[tt]:  # for loss array in list:
@@ -812,9 +883,7 @@ def aggregate_score_mats(model_folder='models/', check_info_dict=True, label='al
     if model_folder[-1] != '/':
         model_folder += '/'
     list_models = [x for x in os.listdir(model_folder) if x[-5:] == '.data']
-    for ii, mn in enumerate(list_models):
-        with open(model_folder + mn, 'rb') as f:
-            model = pickle.load(f)
+    for ii, (mn, (_, model)) in enumerate(zip(list_models, model_prefetch.iter_models(paths=[model_folder + x for x in list_models], use_cache=False))):
         if ii == 0:  # use first to create agrr matrix
             mat_shape = model.decoding_crosstemp_score[label].shape
             assert len(mat_shape) == 2  # 2D matrix
@@ -828,7 +897,6 @@ def aggregate_score_mats(model_folder='models/', check_info_dict=True, label='al
         agg_score_mat[ii, :, :] = model.decoding_crosstemp_score[label]  # add score matrix
         prev_model = model
         prev_name = mn
-        f.close()
     return agg_score_mat
 
 
@@ -840,9 +908,7 @@ def aggregate_decoders(model_folder='models/', check_info_dict=True, label='alph
     if model_folder[-1] != '/':
         model_folder += '/'
     list_models = [x for x in os.listdir(model_folder) if x[-5:] == '.data']
-    for ii, mn in enumerate(list_models):
-        with open(model_folder + mn, 'rb') as f:
-            model = pickle.load(f)
+    for ii, (mn, (_, model)) in enumerate(zip(list_models, model_prefetch.iter_models(paths=[model_folder + x for x in list_models], use_cache=False))):
         if ii == 0:  # use first to create agrr matrix
             n_decoders = len(model.decoder_dict[label])
             n_nodes = len(model.decoder_dict[label][0].coef_[0])
@@ -857,7 +923,6 @@ def aggregate_decoders(model_folder='models/', check_info_dict=True, label='alph
             decoder_mat[ii, :, i_dec] = dec.coef_[0] # add score matrix
         prev_model = model
         prev_name = mn
-        f.close()
     return decoder_mat
 
 def aggregate_weights(model_folder='models/', weight='U', check_info_dict=True, label='alpha'):
@@ -868,9 +933,7 @@ def aggregate_weights(model_folder='models/', weight='U', check_info_dict=True,
         if model_folder[-1] != '/':
             model_folder += '/'
         list_models = [x for x in os.listdir(model_folder) if x[-5:] == '.data']
-        for ii, mn in enumerate(list_models):
-            with open(model_folder + mn, 'rb') as f:
-                model = pickle.load(f)
+        for ii, (mn, (_, model)) in enumerate(zip(list_models, model_prefetch.iter_models(paths=[model_folder + x for x in list_models], use_cache=False))):
             if ii == 0:  # use first to create agrr matrix
                 # n_decoders = len(model.decoder_dict[label])
                 # n_nodes = len(model.decoder_dict[label][0].coef_[0])
@@ -886,10 +949,9 @@ def aggregate_weights(model_folder='models/', weight='U', check_info_dict=True,
                 weight_mat[ii, :] = np.mean(np.abs(input_mat), 0)# add score matrix
             prev_model = model
             prev_name = mn
-            f.close()
         return weight_mat
 
-def save_pearson_corr(rnn, representation='alpha', set_nans=True):
+def save_pearson_corr(rnn, representation='alpha', set_nans=True, data_seed=None):
     assert representation == 'alpha' or representation == 'beta' or representation == 'mnm'
     if 'late_beta' in rnn.info_dict.keys():
         late_beta = rnn.info_dict['late_beta']
@@ -899,7 +961,7 @@ def save_pearson_corr(rnn, representation='alpha', set_nans=True):
     ## get forward activity
     _, __, forw  = train_single_decoder_new_data(rnn=rnn, ratio_expected=0.5, 
                                                  sparsity_c=0.1, bool_train_decoder=False,
-                                                 late_beta=late_beta)
+                                                 late_beta=late_beta, data_seed=data_seed)
 
 
     if representation == 'mnm':
@@ -934,10 +996,7 @@ def save_pearson_corr(rnn, representation='alpha', set_nans=True):
 def save_pearson_corr_folder(rnn_folder, representation='alpha', set_nans=True,
                              save_to_file=False):
     rnn_list = [x for x in os.listdir(rnn_folder) if x[-5:] == '.data']
-    for i_rnn, rnn_name in tqdm(enumerate(rnn_list)):
-        ## Load RNN:
-        with open(rnn_folder + rnn_name, 'rb') as f:
-            rnn = pickle.load(f)
+    for i_rnn, (_, rnn) in tqdm(enumerate(model_prefetch.iter_models(paths=[rnn_folder + x for x in rnn_list], use_cache=False))):
         save_pearson_corr(rnn=rnn, representation=representation,
                           set_nans=set_nans)
         if save_to_file:
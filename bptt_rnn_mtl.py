@@ -6,7 +6,7 @@
 # @Last modified time: 2021-06-01
 
 
-import os, sys, string
+import os, sys
 import numpy as np
 import torch
 from torch import nn
@@ -14,13 +14,20 @@ import torch.nn.functional as F
 from torch.utils.data import TensorDataset, DataLoader
 import pickle, datetime, time, os, sys, git
 from tqdm import tqdm, trange
-import sklearn.svm, sklearn.model_selection, sklearn.discriminant_analysis
 import rot_utilities as ru
+import decoders
+import activity_cache
+import decoder_store as decoder_store_module
+import rnn_io
+import model_catalog
+import model_cache
+import model_writer
 # from multiprocessing.dummy import Pool as ThreadPool
+import multiprocessing
 from multiprocessing import Pool
 import itertools
 from itertools import repeat as irep
-import copy
+import copy, zlib, tempfile, shutil, collections
 
 
 device = 'cpu'
@@ -31,14 +38,26 @@ def generate_synt_data_general(n_total=100, t_delay=2, t_stim=2,
                                ratio_train=0.8, ratio_exp=0.75,
                                noise_scale=0.05, late_s2=False,
                                early_match=False,
-                               nature_stim='onehot', task='dmc'):
+                               nature_stim='onehot', task='dmc', n_cat=None, rng=None,
+                               return_masks=False):
     '''Generate synthetic data
 
+    t_delay: delay duration, or list of delay durations to generate a mixed-timing
+             data set (see generate_synt_data_mixed_delays())
     nature_stim: onehot, periodic, tuning
     task: dms, dmc, dmrs, dmrc, discr
+    n_cat: number of stimulus categories (2 for onehot and 4 for periodic if None)
     late_s2: if true, present s2 during original GO window (and GO after)
-    early_match: if true, prompt for MNM during S2 presentation'''
+    early_match: if true, prompt for MNM during S2 presentation
+    rng: np.random.Generator used for trial sampling, split and noise (seeded from np.random if None)
+    return_masks: if true, also return (masks_train, masks_test) of get_window_masks()'''
     assert (late_s2 and early_match) is False
+    rng = ru.get_rng(rng=rng)
+    if np.ndim(t_delay) > 0:  # mixed timing
+        return generate_synt_data_mixed_delays(t_delay_list=t_delay, n_total=n_total, t_stim=t_stim,
+                                               ratio_train=ratio_train, ratio_exp=ratio_exp, noise_scale=noise_scale,
+                                               late_s2=late_s2, early_match=early_match, nature_stim=nature_stim,
+                                               task=task, n_cat=n_cat, rng=rng, return_masks=return_masks)
     # assert late_s2 is False, 'Late s2 not implemented'
     assert ratio_train <= 1 and ratio_train >= 0
     pd = {}  #parameter dictionariy
@@ -50,7 +69,8 @@ def generate_synt_data_general(n_total=100, t_delay=2, t_stim=2,
     assert pd['ratio_exp'] + pd['ratio_unexp'] == 1
     pd['n_exp_half'] = int(np.round(pd['ratio_exp'] * pd['n_half_total']))
 
-    pd['n_input'] = 6
+    pd['n_input'] = get_n_input(nature_stim=nature_stim, n_cat=n_cat)
+    i_go = pd['n_input'] - 1
     pd['n_times'] = int(4 * t_delay + 3 * t_stim)
     pd['period'] = int(t_delay + t_stim)
     pd['t_delay'] = t_delay
@@ -68,19 +88,18 @@ def generate_synt_data_general(n_total=100, t_delay=2, t_stim=2,
         for i_delay in range(4):  # 4 delay periods
             all_seq[:, :, 0][:, (i_delay * pd['period']):(i_delay * pd['period'] + t_delay)] = 1
         if early_match is False:
-            all_seq[:, :, 5][:, (3 * t_delay + 2 * t_stim):(3 * t_delay + 3 * t_stim)] = 1  # Go cue
+            all_seq[:, :, i_go][:, (3 * t_delay + 2 * t_stim):(3 * t_delay + 3 * t_stim)] = 1  # Go cue
         elif early_match:
-            all_seq[:, :, 5][:, pd['slice_s2']] = 1  # Go cue
+            all_seq[:, :, i_go][:, pd['slice_s2']] = 1  # Go cue
     elif late_s2:
         for i_delay in range(3):  # 3 delay periods
             all_seq[:, :, 0][:, (i_delay * pd['period']):(i_delay * pd['period'] + t_delay)] = 1
-        all_seq[:, :, 5][:, (3 * pd['period']):(3 * pd['period'] + t_delay)] = 1  # late Go cue
+        all_seq[:, :, i_go][:, (3 * pd['period']):(3 * pd['period'] + t_delay)] = 1  # late Go cue
         all_seq[:, :, 0][:, (2 * t_delay + 1 * t_stim):(2 * t_delay + 2 * t_stim)] = 1  # extra delay during regular s2 time
     ## First fill in sequence of trials, shuffle later
-    if nature_stim == 'onehot':
-        all_seq, labels = fill_onehot_trials(all_seq=all_seq, labels=labels, task=task, pd=pd, late_s2=late_s2)
-    elif nature_stim == 'periodic':
-        all_seq, labels = fill_periodic_trials(all_seq=all_seq, labels=labels, task=task, pd=pd, late_s2=late_s2)
+    if nature_stim == 'onehot' or nature_stim == 'periodic':
+        all_seq, labels = fill_trials(all_seq=all_seq, labels=labels, task=task, pd=pd,
+                                      nature_stim=nature_stim, n_cat=n_cat, rng=rng)
     elif nature_stim == 'tuning':
         pass
     elif nature_stim == 'binary':
@@ -94,17 +113,15 @@ def generate_synt_data_general(n_total=100, t_delay=2, t_stim=2,
     assert n_train + n_test == pd['n_total']
 
     ## Train/test data:
-    sss = sklearn.model_selection.StratifiedShuffleSplit(n_splits=1, train_size=ratio_train).split(X=np.zeros_like(labels),
-                                                                                 y=labels) # stratified split
-    train_inds, test_inds = next(sss)  # generate
+    train_inds, test_inds = ru.stratified_split(labels=labels, ratio_train=ratio_train, rng=rng)  # stratified split
     train_seq = all_seq[train_inds, :, :]
     labels_train = labels[train_inds]
     test_seq = all_seq[test_inds, :, :]
     labels_test = labels[test_inds]
 
     ##
-    x_train = train_seq[:, :-1, :] + (np.random.randn(n_train, pd['n_times'] - 1, pd['n_input']) * noise_scale)  # add noise to input
-    x_test = test_seq[:, :-1, :] + (np.random.randn(n_test, pd['n_times'] - 1, pd['n_input']) * noise_scale)
+    x_train = train_seq[:, :-1, :] + (rng.standard_normal((n_train, pd['n_times'] - 1, pd['n_input'])) * noise_scale)  # add noise to input
+    x_test = test_seq[:, :-1, :] + (rng.standard_normal((n_test, pd['n_times'] - 1, pd['n_input'])) * noise_scale)
     y_train_pred = train_seq[:, 1:, :]  # do not add noise to output
     y_test_pred = test_seq[:, 1:, :]
 
@@ -126,102 +143,179 @@ def generate_synt_data_general(n_total=100, t_delay=2, t_stim=2,
         # nonmatch_train = np.where(np.array([x[0] != x[1] for x in labels_train]))[0]
         match_train = np.where(np.array([x[1] != 'x' for x in labels_train]))[0]
         nonmatch_train = np.where(np.array([x[1] == 'x' for x in labels_train]))[0]
-        y_train[match_train, slice_go_output, 6] = 1
-        y_train[nonmatch_train, slice_go_output, 7] = 1
+        y_train[match_train, slice_go_output, pd['n_input']] = 1
+        y_train[nonmatch_train, slice_go_output, pd['n_input'] + 1] = 1
 
         match_test = np.where(np.array([x[1] != 'x' for x in labels_test]))[0]
         nonmatch_test = np.where(np.array([x[1] == 'x'  for x in labels_test]))[0]
-        y_test[match_test, slice_go_output, 6] = 1
-        y_test[nonmatch_test, slice_go_output, 7] = 1
+        y_test[match_test, slice_go_output, pd['n_input']] = 1
+        y_test[nonmatch_test, slice_go_output, pd['n_input'] + 1] = 1
 
     x_train, y_train, x_test, y_test = map(
         torch.tensor, (x_train, y_train, x_test, y_test))  # create tensors
     x_train, y_train, x_test, y_test = x_train.float(), y_train.float(), x_test.float(), y_test.float()  # need to be float type (instead of 'double', which is somewhat silly)
+    if return_masks:
+        assert late_s2 is False and early_match is False, 'masks only implemented for standard trial layout'
+        masks_train = get_window_masks(t_delay=np.zeros(n_train, dtype=int) + t_delay, t_stim=t_stim, n_times=pd['n_times'])
+        masks_test = get_window_masks(t_delay=np.zeros(n_test, dtype=int) + t_delay, t_stim=t_stim, n_times=pd['n_times'])
+        return (x_train, y_train, x_test, y_test), (labels_train, labels_test), (masks_train, masks_test)
     return (x_train, y_train, x_test, y_test), (labels_train, labels_test)
 
-
-def fill_onehot_trials(all_seq=None, labels=None, task='dmc', pd=None, late_s2=False):
-    """Add OH data into all_seq."""
-    if task == 'dmc':
-        n_cat = 2
-    elif task == 'dms':
-        n_cat = 2
-    else:
-        assert False, f'{task} not implement for onehot'
-
-    if n_cat == 2:
-        all_seq[:pd['n_half_total'], :, 1][:, pd['slice_s1']] = 1  # S1
-        all_seq[pd['n_half_total']:, :, 2][:, pd['slice_s1']] = 1  # S2
-
-        if task == 'dmc':
-            add_task = 2
-        elif task == 'dms':
-            add_task = 0
-
-        all_seq[:pd['n_exp_half'], :, (1 + add_task)][:, pd['slice_s2']] = 1  # exp S2-1
-        labels[:pd['n_exp_half']] = '11'
-        all_seq[pd['n_exp_half']:pd['n_half_total'], :, (2 + add_task)][:, pd['slice_s2']] = 1  #unexp S2-2
-        labels[pd['n_exp_half']:pd['n_half_total']] = '1x'
-        all_seq[pd['n_half_total']:(pd['n_half_total'] + pd['n_exp_half']), :, (2 + add_task)][:, pd['slice_s2']] = 1 # exp S2-2
-        labels[pd['n_half_total']:(pd['n_half_total'] + pd['n_exp_half'])] = '22'
-        all_seq[(pd['n_half_total'] + pd['n_exp_half']):, :, (1 + add_task)][:, pd['slice_s2']] = 1  # unexp S2-1
-        labels[(pd['n_half_total'] + pd['n_exp_half']):] = '2x'
-
-    elif n_cat == 4:
-        assert task == 'dms'
-        assert False, 'not implemented'
-
-    return all_seq, labels
-
-
-def fill_periodic_trials(all_seq=None, labels=None, task='dmc', pd=None, n_cat=4, late_s2=False):
-    """Add periodic/4 sample data into all_seq"""
-    assert pd['n_total'] % n_cat == 0, 'number of categories not a factor of number of trials'
-    assert task == 'dmc' or task == 'dms' or task == 'dmrs' or task == 'dmrc'
-    assert n_cat < 10  # to stay within 1 digit with labelling
-    assert late_s2 is False, 'late s2 not implemented for periodic trials'
-    ## Create periodic stim by cos & sin of angle
-    rad_stim = np.array([x * 2 * np.pi / n_cat for x in range(n_cat)])
-    cos_stim = np.cos(rad_stim)
-    sin_stim = np.sin(rad_stim)
-
-    if task == 'dmc' or task == 'dmrc':
-        add_task = 2
-    elif task == 'dms' or task == 'dmrs':
-        add_task = 0
-    n_trials_per_cat = int(np.round(pd['n_total'] / n_cat))
-    n_trials_exp_per_cat = int(np.round(pd['ratio_exp'] * n_trials_per_cat))
-    n_trials_unexp_per_cat = n_trials_per_cat - n_trials_exp_per_cat
-    assert n_trials_exp_per_cat + n_trials_unexp_per_cat == n_trials_per_cat
-
-    ## Fill sequences per S1 category
-    for i_cat in range(n_cat):
-        i_trial = i_cat * n_trials_per_cat
-        i_next_cat_trial = (i_cat + 1) * n_trials_per_cat
-        ## Fill S1
-        all_seq[i_trial:i_next_cat_trial, :, 1][:, pd['slice_s1']] = cos_stim[i_cat]
-        all_seq[i_trial:i_next_cat_trial, :, 2][:, pd['slice_s1']] = sin_stim[i_cat]
-
-        ## Fill S2
-        if task == 'dms' or task == 'dmc':
-            match_cat = i_cat
-        elif task == 'dmrs' or task == 'dmrc':
-            match_cat = (i_cat + 1) % n_cat
-        all_seq[i_trial:(i_trial + n_trials_exp_per_cat), :, (1 + add_task)][:, pd['slice_s2']] = cos_stim[match_cat]  # same stim
-        all_seq[i_trial:(i_trial + n_trials_exp_per_cat), :, (2 + add_task)][:, pd['slice_s2']] = sin_stim[match_cat]
-        labels[i_trial:(i_trial + n_trials_exp_per_cat)] = f'{i_cat}{match_cat}'
-
-        random_cat = np.random.choice(a=np.delete(np.arange(n_cat), match_cat, 0), size=n_trials_unexp_per_cat, replace=True)
-        all_seq[(i_trial + n_trials_exp_per_cat):i_next_cat_trial, :, (1 + add_task)][:, pd['slice_s2']] = np.array([cos_stim[x] for x in random_cat])[:, None]  # different stim
-        all_seq[(i_trial + n_trials_exp_per_cat):i_next_cat_trial, :, (2 + add_task)][:, pd['slice_s2']] = np.array([sin_stim[x] for x in random_cat])[:, None]
-        # labels[(i_trial + n_trials_exp_per_cat):i_next_cat_trial] = [f'{i_cat}{i_random_cat.copy()}' for i_random_cat in random_cat]  # specify other cat
-        labels[(i_trial + n_trials_exp_per_cat):i_next_cat_trial] = [f'{i_cat}x' for i_random_cat in random_cat]  # do not specifiy => best for shuffling with StratifiedShuffleSplit
-
+def generate_synt_data_mixed_delays(t_delay_list=[2], n_total=100, t_stim=2, ratio_train=0.8,
+                                    rng=None, return_masks=True, **kwargs):
+    '''Generate data set with mixed timing: trials are divided equally over the delay durations
+    in t_delay_list (each split stratified), padded at the end to the longest trial and shuffled.
+    kwargs are passed to generate_synt_data_general(). Returns as generate_synt_data_general();
+    the masks of get_window_masks() define the loss windows of each trial (and are needed
+    to discard padded time points).'''
+    rng = ru.get_rng(rng=rng)
+    t_delay_list = np.array(t_delay_list, dtype=int)
+    n_times_max = int(4 * t_delay_list.max() + 3 * t_stim)
+    bounds = np.round(np.arange(len(t_delay_list) + 1) * n_total / len(t_delay_list)).astype(int)
+    data = {'x_train': [], 'y_train': [], 'x_test': [], 'y_test': [],
+            'labels_train': [], 'labels_test': [], 'masks_train': [], 'masks_test': []}
+    for i_delay, t_delay in enumerate(t_delay_list):
+        tmp0, tmp1, tmp2 = generate_synt_data_general(n_total=bounds[i_delay + 1] - bounds[i_delay], t_delay=int(t_delay),
+                                                      t_stim=t_stim, ratio_train=ratio_train, rng=rng,
+                                                      return_masks=True, **kwargs)
+        n_pad = n_times_max - int(4 * t_delay + 3 * t_stim)
+        for key, arr in zip(['x_train', 'y_train', 'x_test', 'y_test'], tmp0):
+            data[key].append(F.pad(arr, (0, 0, 0, n_pad)))  # pad time axis at the end
+        for key, arr in zip(['labels_train', 'labels_test'], tmp1):
+            data[key].append(arr)
+        for key, masks in zip(['masks_train', 'masks_test'], tmp2):
+            data[key].append({k: (torch.cat([v, torch.zeros((v.shape[0], n_pad), dtype=v.dtype)], 1) if v.ndim == 2 else v)
+                              for k, v in masks.items()})  # padded time points are masked out
+
+    ## Concatenate and shuffle:
+    for ds_type in ['train', 'test']:
+        n_ds = np.sum([len(x) for x in data[f'labels_{ds_type}']])
+        inds = torch.tensor(rng.permutation(n_ds))
+        for key in ['x', 'y']:
+            data[f'{key}_{ds_type}'] = torch.cat(data[f'{key}_{ds_type}'], 0)[inds]
+        data[f'labels_{ds_type}'] = np.concatenate(data[f'labels_{ds_type}'])[inds.numpy()]
+        data[f'masks_{ds_type}'] = {k: torch.cat([m[k] for m in data[f'masks_{ds_type}']], 0)[inds]
+                                    for k in data[f'masks_{ds_type}'][0].keys()}
+    tmp0 = (data['x_train'], data['y_train'], data['x_test'], data['y_test'])
+    tmp1 = (data['labels_train'], data['labels_test'])
+    if return_masks:
+        return tmp0, tmp1, (data['masks_train'], data['masks_test'])
+    return tmp0, tmp1
+
+def get_window_masks(t_delay, t_stim=2, n_times=None):
+    '''Boolean masks (n_trials x n_times - 1) of the output time points (ie one step ahead of input)
+    of each loss window, given the delay duration per trial. Standard layout only
+    (late_s2 and early_match False). Keys: valid (not padded), pred, spec, and the split keys
+    of test_loss_append_split(). Also contains the input onset time (index) of S1, S2 and G per trial.'''
+    t_delay = torch.as_tensor(np.asarray(t_delay), dtype=torch.long)[:, None]
+    if n_times is None:
+        n_times = int(4 * t_delay.max() + 3 * t_stim)
+    t_out = torch.arange(n_times - 1)[None, :]
+    window = lambda start, stop: (t_out >= start - 1) & (t_out < stop - 1)  # input time window -> output time
+    onset_s1 = t_delay
+    onset_s2 = 2 * t_delay + t_stim
+    onset_go = 3 * t_delay + 2 * t_stim
+    t_end = 4 * t_delay + 3 * t_stim
+    masks = {'valid': window(1, t_end),
+             'pred': window(onset_s1 + t_stim, t_end),  # everything after S1
+             'spec': window(onset_go, onset_go + t_stim),
+             'S2': window(onset_s2, onset_s2 + t_stim),
+             'G': window(onset_go, onset_go + t_stim),
+             'G1': window(onset_go, onset_go + 1),
+             'G2': window(onset_go + 1, onset_go + t_stim),
+             '0_postS1': window(onset_s1 + t_stim, onset_s2),
+             '0_postS2': window(onset_s2 + t_stim, onset_go),
+             '0_postG': window(onset_go + t_stim, t_end)}
+    masks['0'] = masks['0_postS1'] | masks['0_postS2'] | masks['0_postG']
+    masks['onset_s1'], masks['onset_s2'], masks['onset_go'] = onset_s1[:, 0], onset_s2[:, 0], onset_go[:, 0]
+    return masks
+
+
+def get_n_input(nature_stim='onehot', n_cat=None):
+    """Number of input channels: 0, S1/S2 stimulus channels and G."""
+    if nature_stim == 'onehot':  # 0 A1 .. An B1 .. Bn G
+        if n_cat is None:
+            n_cat = 2
+        return 2 + 2 * n_cat
+    else:  # 0 cosA sinA cosB sinB G
+        return 6
+
+def fill_trials(all_seq=None, labels=None, task='dmc', pd=None, nature_stim='onehot',
+                n_cat=None, rng=None):
+    """Add S1 and S2 stimuli of n_cat categories into all_seq (in place), for onehot or
+    periodic stimuli. Trials are laid out in blocks per S1 category (boundaries rounded),
+    the first round(ratio_exp * n_trials_first_block) trials of each block are expected (match).
+    Non-match S2 categories are drawn uniformly from the other categories.
+
+    Parameters
+    ----------
+    all_seq : np.array of shape (n_total, n_times, n_input)
+        sequences, filled in place.
+    labels : np.array of dtype object and shape (n_total,)
+        labels '<S1><S2>' with S2 'x' for non-match, onehot categories start at 1, periodic at 0.
+    task : str
+        dms, dmc, dmrs or dmrc. In dmc/dmrc S2 is presented on separate B channels.
+    pd : dict
+        parameter dict of generate_synt_data_general().
+    nature_stim : str
+        onehot (category per channel) or periodic (cos & sin of category angle).
+    n_cat : int or None
+        number of categories, if None 2 for onehot and 4 for periodic.
+    rng : np.random.Generator
+        used for non-match categories.
+
+    Returns
+    -------
+    all_seq, labels
+    """
+    assert task in ['dms', 'dmc', 'dmrs', 'dmrc'], f'{task} not implemented'
+    assert nature_stim in ['onehot', 'periodic'], f'{nature_stim} not implemented'
+    rng = ru.get_rng(rng=rng)
+    if n_cat is None:
+        n_cat = 2 if nature_stim == 'onehot' else 4
+    assert n_cat >= 2 and n_cat < 10  # to stay within 1 digit with labelling
+    if nature_stim == 'periodic':
+        assert pd['n_total'] % n_cat == 0, 'number of categories not a factor of number of trials'
+    n_total = pd['n_total']
+
+    ## Category per trial, in blocks:
+    cat_bounds = np.round(np.arange(n_cat + 1) * n_total / n_cat).astype(int)
+    cat_s1 = np.repeat(np.arange(n_cat), np.diff(cat_bounds))
+    n_exp_per_cat = int(np.round(pd['ratio_exp'] * cat_bounds[1]))
+    expected = (np.arange(n_total) - cat_bounds[cat_s1]) < n_exp_per_cat
+    if task == 'dms' or task == 'dmc':
+        match_cat = cat_s1
+    elif task == 'dmrs' or task == 'dmrc':
+        match_cat = (cat_s1 + 1) % n_cat
+    cat_s2 = np.where(expected, match_cat, (match_cat + rng.integers(1, n_cat, size=n_total)) % n_cat)  # uniform over other categories
+
+    ## Scatter stimuli:
+    trials = np.arange(n_total)[:, None]
+    times_s1 = np.arange(pd['slice_s1'].start, pd['slice_s1'].stop)[None, :]
+    times_s2 = np.arange(pd['slice_s2'].start, pd['slice_s2'].stop)[None, :]
+    if nature_stim == 'onehot':
+        add_task = n_cat if task in ['dmc', 'dmrc'] else 0
+        all_seq[trials, times_s1, 1 + cat_s1[:, None]] = 1
+        all_seq[trials, times_s2, 1 + add_task + cat_s2[:, None]] = 1
+        label_offset = 1
+    elif nature_stim == 'periodic':  # periodic stim by cos & sin of angle
+        add_task = 2 if task in ['dmc', 'dmrc'] else 0
+        rad_stim = np.arange(n_cat) * 2 * np.pi / n_cat
+        all_seq[trials, times_s1, 1] = np.cos(rad_stim)[cat_s1][:, None]
+        all_seq[trials, times_s1, 2] = np.sin(rad_stim)[cat_s1][:, None]
+        all_seq[trials, times_s2, 1 + add_task] = np.cos(rad_stim)[cat_s2][:, None]
+        all_seq[trials, times_s2, 2 + add_task] = np.sin(rad_stim)[cat_s2][:, None]
+        label_offset = 0
+
+    ## Labels; non-match S2 is not specified => best for stratified splitting
+    digits = np.array(list('0123456789'))
+    labels[:] = np.char.add(digits[cat_s1 + label_offset],
+                            np.where(expected, digits[match_cat + label_offset], 'x'))
     return all_seq, labels
 
 
 class RNN_MTL(nn.Module):
-    def __init__(self, n_nodes=20, nature_stim='onehot', task='pred_dmc', init_std_scale=0.1):
+    def __init__(self, n_nodes=20, nature_stim='onehot', task='pred_dmc', init_std_scale=0.1, n_input=6):
         '''RNN Model with input/hidden/output layers. Fully connected.
 
         Terminology:
@@ -235,8 +329,8 @@ class RNN_MTL(nn.Module):
         super().__init__()
 
         ## Model parameters
-        self.n_input = 6  # A1 A2 B1 B2 G 0
-        self.n_output = 8  # = n_input + M1 M2
+        self.n_input = n_input  # 0 A1 A2 B1 B2 G (by default, see get_n_input())
+        self.n_output = self.n_input + 2  # = n_input + M1 M2
         self.n_nodes = n_nodes
         self.init_std_scale = init_std_scale
         self.task = task
@@ -302,13 +396,17 @@ class RNN_MTL(nn.Module):
         """Define representation"""
         return f'Instance {self.rnn_name} of RNN_MTL Class'
 
-    def init_state(self):
-        '''Initialise hidden state to random values N(0, 0.1)'''
-        self.state = torch.randn(self.n_nodes) * self.init_std_scale  # initialise s_{-1}
+    def init_state(self, n_trials=None):
+        '''Initialise hidden state to random values N(0, 0.1), for n_trials trials if not None.'''
+        if n_trials is None:
+            self.state = torch.randn(self.n_nodes) * self.init_std_scale  # initialise s_{-1}
+        else:
+            self.state = torch.randn(n_trials, self.n_nodes) * self.init_std_scale
 
     def forward(self, inp, rnn_state=None):
         '''Perform one forward step given input and hidden state. If hidden state
-        (rnn_state) is None, self.state will be used (regular behaviour).'''
+        (rnn_state) is None, self.state will be used (regular behaviour). inp can be
+        a single time point (n_input) or a batch of trials (n_trials x n_input).'''
         if rnn_state is None:
             rnn_state = self.state
         # rnn_state.to(device)  # if use_gpu
@@ -319,17 +417,17 @@ class RNN_MTL(nn.Module):
         linear_output = self.lin_output(new_state.squeeze())
         output = torch.zeros_like(linear_output)  # we will normalise the prediction task & specialisation task separately:
         if self.info_dict['output_nonlin_pred'] == 'softmax':
-            output[:self.n_input] = F.softmax(linear_output[:self.n_input], dim=0)  # output nonlin-lin of the prediction task (normalised on these only )
+            output[..., :self.n_input] = F.softmax(linear_output[..., :self.n_input], dim=-1)  # output nonlin-lin of the prediction task (normalised on these only )
         elif self.info_dict['output_nonlin_pred'] == 'softmax_relu':
-            output[:self.n_input] = F.softmax(F.relu(linear_output[:self.n_input]), dim=0)  # output nonlin-lin of the prediction task (normalised on these only )
+            output[..., :self.n_input] = F.softmax(F.relu(linear_output[..., :self.n_input]), dim=-1)  # output nonlin-lin of the prediction task (normalised on these only )
         elif self.info_dict['output_nonlin_pred'] == 'tanh':
-            output[:self.n_input] = torch.tanh(linear_output[:self.n_input])
+            output[..., :self.n_input] = torch.tanh(linear_output[..., :self.n_input])
         else:
             assert False, 'output nonlinearity not defined'
         if self.info_dict['output_nonlin_spec'] == 'softmax':
-            output[self.n_input:] = F.softmax(linear_output[self.n_input:], dim=0)
+            output[..., self.n_input:] = F.softmax(linear_output[..., self.n_input:], dim=-1)
         elif self.info_dict['output_nonlin_spec'] == 'softmax_relu':
-            output[self.n_input:] = F.softmax(F.relu(linear_output[self.n_input:]), dim=0)  # probabilities units for M and NM (normalised)
+            output[..., self.n_input:] = F.softmax(F.relu(linear_output[..., self.n_input:]), dim=-1)  # probabilities units for M and NM (normalised)
         else:
             assert False, 'output nonlinearly not defined'
         return new_state, output
@@ -340,9 +438,15 @@ class RNN_MTL(nn.Module):
         for key, val in param_dict.items():
             self.info_dict[key] = val  # overwrites
 
-    def save_model(self, folder=None, verbose=True, add_nnodes=False, allow_name_change=True):  # redefine because we want to change saving name
+    def save_model(self, folder=None, verbose=True, add_nnodes=False, allow_name_change=True,
+                   file_format='structured', writer=None, codec=None, level=None):  # redefine because we want to change saving name
         '''Export this RNN model to folder. If self.file_name is None, it is saved  under
-        a timestamp.'''
+        a timestamp. file_format is 'structured' (see rnn_io.py) or 'pickle' (whole object, old format).
+        Structured files are compressed with codec (eg 'zstd', 'default') at level, see compression.py.
+        If writer (AsyncModelWriter, see model_writer.py) is given, a snapshot of the model is written
+        in the background (compressed as set in the writer) and save_model() returns immediately, with a
+        future of the path of the file (self.full_path does not get the suffix of a changed name).'''
+        assert file_format in ['structured', 'pickle'], f'file_format {file_format} not recognised'
         dt = datetime.datetime.now()
         timestamp = str(dt.date()) + '-' + str(dt.hour).zfill(2) + str(dt.minute).zfill(2)
         self.info_dict['timestamp'] = timestamp
@@ -365,36 +469,50 @@ class RNN_MTL(nn.Module):
         self.full_path = folder + self.file_name
         if current_suffix is not None:
             self.full_path = folder + self.file_name[:-5] + current_suffix + '.data'
+        if writer is not None:
+            assert file_format == 'structured', 'background writing is only implemented for the structured format'
+            model_cache.invalidate(path=self.full_path)
+            return writer.submit(rnn=self, allow_name_change=allow_name_change, verbose=verbose)
+
+        def write_function(file_handle, path):
+            self.full_path = path  # full_path is saved in the file too
+            if file_format == 'structured':
+                rnn_io.write_model(rnn=self, file_handle=file_handle, codec=codec, level=level)
+            else:
+                assert codec is None, 'compression is only implemented for the structured format'
+                pickle.dump(self, file_handle)
+
+        ## Write to temporary file in same folder first, then rename (atomic), so that the file is never half-written.
+        ## If the name is taken (eg by another process that finished in the same minute), add a random suffix:
         if allow_name_change:
-            i_ascii = 0
-            suffix_list = string.ascii_letters
-            while os.path.exists(self.full_path):
-                self.full_path = folder + self.file_name[:-5] + suffix_list[i_ascii] + '.data'
-                i_ascii += 1
-                if i_ascii == len(suffix_list):
-                    print('WARNING: EXPANDING ASCII LIST')
-                    suffix_list = [x + x for x in suffix_list]
-                    i_ascii = 0  # reset because suffix_list has been changed
-                    assert False, 'safety stop'
-        file_handle = open(self.full_path, 'wb')
-        pickle.dump(self, file_handle)
+            rnn_io.write_unique(path=self.full_path, write_function=write_function)
+        else:
+            rnn_io.write_atomic(path=self.full_path, write_function=lambda file_handle: write_function(file_handle, self.full_path))
+        model_cache.invalidate(path=self.full_path)
+        model_catalog.update_default_catalog(path=self.full_path)
         if verbose > 0:
             print(f'RNN-MTL model saved as {self.file_name}')
 
 def prediction_loss(y_est, y_true, model, eval_times=np.array([3, 4, 5, 6, 7, 8, 9, 10, 11, 12]),
-                    loss_function=None):
-    '''Compute Cross Entropy of prediction loss given time array eval_times.'''
+                    loss_function=None, mask=None):
+    '''Compute Cross Entropy of prediction loss given time array eval_times, or given
+    the per-trial boolean mask (n_trials x n_times, see get_window_masks()) if not None.'''
     # assert not (simulated_annealing and mnm_only), f'cannot do mnm only and SA simultaneously. sa = {simulated_annealing}, mnm = {mnm_only}'
     assert model.train_pred_task
     assert y_est.shape == y_true.shape
-    assert y_est.shape[1] == 13
     if loss_function is None:
         loss_function = model.info_dict['pred_loss_function']
-    y_est_trunc = y_est[:, eval_times, :][:, :, :model.n_input]  # only evaluated these time points, cut off at n_input, because spec task follows after
-    y_true_trunc = y_true[:, eval_times, :][:, :, :model.n_input]
+    if mask is None:
+        assert y_est.shape[1] == 13
+        y_est_trunc = y_est[:, eval_times, :][:, :, :model.n_input]  # only evaluated these time points, cut off at n_input, because spec task follows after
+        y_true_trunc = y_true[:, eval_times, :][:, :, :model.n_input]
+    else:
+        assert mask.shape == y_true.shape[:2]
+        y_est_trunc = y_est[mask][:, :model.n_input]  # (n_evaluated_points x n_input)
+        y_true_trunc = y_true[mask][:, :model.n_input]
     n_samples = y_true.shape[0]
     if loss_function == 'cross_entropy':
-        assert y_true_trunc.sum(2).mean() == 1, y_true_trunc.sum(2).mean() # sum should be 1 to use cross entropy
+        assert y_true_trunc.sum(-1).mean() == 1, y_true_trunc.sum(-1).mean() # sum should be 1 to use cross entropy
         loss = torch.sum(-1 * y_true_trunc * torch.log(y_est_trunc)) / n_samples  # take the mean CE over samples
     elif loss_function == 'mean_squared_error':
         # loss_f = nn.MSELoss(reduction='mean')
@@ -412,11 +530,18 @@ def regularisation_loss(model, reg_param=None):  # default 0.001
         reg_loss += reg_param * p_set.norm(p=1)
     return reg_loss
 
-def specialisation_loss(y_est, y_true, model, eval_times=np.array([9, 10]), late_s2=False):
-    '''Compute Cross Entropy of specialisation loss given time array eval_times.'''
+def specialisation_loss(y_est, y_true, model, eval_times=np.array([9, 10]), late_s2=False, mask=None):
+    '''Compute Cross Entropy of specialisation loss given time array eval_times, or given
+    the per-trial boolean mask (n_trials x n_times, see get_window_masks()) if not None.'''
     # assert not (simulated_annealing and mnm_only), f'cannot do mnm only and SA simultaneously. sa = {simulated_annealing}, mnm = {mnm_only}'
     assert model.train_spec_task
     assert y_est.shape == y_true.shape
+    if mask is not None:
+        assert mask.shape == y_true.shape[:2]
+        y_est_trunc = y_est[mask][:, model.n_input:]  # (n_evaluated_points x 2)
+        y_true_trunc = y_true[mask][:, model.n_input:]
+        assert y_true_trunc.sum(-1).mean() == 1, f'mean: {y_true_trunc.sum(-1).mean()}'  # sum should be 1 to use cross entropy
+        return torch.sum(-1 * y_true_trunc * torch.log(y_est_trunc)) / y_true.shape[0]
     assert y_est.shape[1] == 13
     if late_s2:
         eval_times = np.array([11, 12])
@@ -435,14 +560,17 @@ def specialisation_loss(y_est, y_true, model, eval_times=np.array([9, 10]), late
     ce = torch.sum(-1 * y_true_trunc * torch.log(y_est_trunc)) / n_samples  # take the mean CE over samples, natural log
     return ce
 
-def total_loss(y_est, y_true, model, late_s2):
-    """Compute total loss, pred and spec are taken into account based on info in rnn model"""
+def total_loss(y_est, y_true, model, late_s2, masks=None):
+    """Compute total loss, pred and spec are taken into account based on info in rnn model.
+    masks: dict of get_window_masks() (or None to use the default time points)"""
     if model.train_pred_task:
-        pred_loss = prediction_loss(y_est=y_est, y_true=y_true, model=model)
+        pred_loss = prediction_loss(y_est=y_est, y_true=y_true, model=model,
+                                    mask=None if masks is None else masks['pred'])
     else:
         pred_loss = 0
     if model.train_spec_task:
-        spec_loss = specialisation_loss(y_est=y_est, y_true=y_true, model=model, late_s2=late_s2)
+        spec_loss = specialisation_loss(y_est=y_est, y_true=y_true, model=model, late_s2=late_s2,
+                                        mask=None if masks is None else masks['spec'])
     else:
         spec_loss = 0
     reg_loss = regularisation_loss(model=model)
@@ -450,9 +578,17 @@ def total_loss(y_est, y_true, model, late_s2):
     ratio_reg = reg_loss / total_error
     return total_error, ratio_reg
 
-def test_loss_append_split(y_est, y_true, model, time_prediction_array_dict=None, late_s2=False):
-    """append split pred losses and spec losses to rnn model"""
-    if model.train_pred_task:
+def test_loss_append_split(y_est, y_true, model, time_prediction_array_dict=None, late_s2=False,
+                           masks=None):
+    """append split pred losses and spec losses to rnn model. If masks (dict of get_window_masks())
+    is given, the windows are defined per trial by masks."""
+    if model.train_pred_task and masks is not None:
+        for key in ['S2', 'G', 'G1', 'G2', '0', '0_postS1', '0_postS2', '0_postG']:
+            ce = prediction_loss(y_est=y_est, y_true=y_true, model=model, mask=masks[key])
+            model.test_loss_split[key].append(float(ce.detach().numpy()))
+        ce = prediction_loss(y_est=y_est, y_true=y_true, model=model, mask=masks['pred'])  # full prediction error
+        model.test_loss_split['pred'].append(float(ce.detach().numpy()))
+    elif model.train_pred_task:
         if time_prediction_array_dict is None and late_s2 is False:
             time_prediction_array_dict={'S2': [5, 6], 'G': [9, 10], 'G1': [9], 'G2': [10],
                                         '0': [3, 4, 7, 8, 11, 12], '0_postS1': [3, 4],
@@ -473,44 +609,62 @@ def test_loss_append_split(y_est, y_true, model, time_prediction_array_dict=None
     model.test_loss_split['L1'].append(float(reg_loss.detach().numpy()))  # add to array
 
     if model.train_spec_task:
-        spec_loss = specialisation_loss(y_est=y_est, y_true=y_true, model=model, late_s2=late_s2)
+        spec_loss = specialisation_loss(y_est=y_est, y_true=y_true, model=model, late_s2=late_s2,
+                                        mask=None if masks is None else masks['spec'])
         task_name = model.info_dict['spec_task_name']
         model.test_loss_split[task_name].append(float(spec_loss.detach().numpy()))  # add to array
 
-    tot_loss, ratio_reg = total_loss(y_est=y_est, y_true=y_true, model=model, late_s2=late_s2)
+    tot_loss, ratio_reg = total_loss(y_est=y_est, y_true=y_true, model=model, late_s2=late_s2, masks=masks)
     model.test_loss_arr.append(float(tot_loss.detach().numpy()))
     model.test_loss_ratio_reg.append(float(ratio_reg.detach().numpy()))
 
-def compute_full_pred(input_data, model):
+def compute_full_pred(input_data, model, valid_mask=None):
     '''Compute forward prediction of RNN. I.e. given an input series input_data, the
-    model (RNN) computes the predicted output series.'''
+    model (RNN) computes the predicted output series. If valid_mask (n_trials x n_times) is
+    given (mixed-timing data), all trials are propagated as one batch (each with its own random
+    initial state) and time points after the last valid (non-padded) time point are not computed.
+    Without valid_mask, trials are propagated one by one, so that initial states are drawn
+    from the torch random stream in the same order as before (seeded runs reproduce).'''
     if input_data.ndim == 2:
         input_data = input_data[None, :, :]
     full_pred = torch.zeros((input_data.shape[0], input_data.shape[1], input_data.shape[2] + 2))  # make space for two M elements
-    for kk in range(input_data.shape[0]): # loop over trials
-        model.init_state()  # initiate rnn state per trial
-        for tt in range(input_data.shape[1]):  # loop through time
-            _, full_pred[kk, tt, :] = model(input_data[kk, tt, :])  # compute prediction at this time
+    if valid_mask is None:
+        for kk in range(input_data.shape[0]): # loop over trials
+            model.init_state()  # initiate rnn state per trial
+            for tt in range(input_data.shape[1]):  # loop through time
+                _, full_pred[kk, tt, :] = model(input_data[kk, tt, :])  # compute prediction at this time
+        return full_pred
+    n_times = int(torch.nonzero(valid_mask.any(0)).max()) + 1  # padding is at the end, so earlier time points are unaffected
+    model.init_state(n_trials=input_data.shape[0])  # initiate rnn state per trial
+    for tt in range(n_times):  # loop through time
+        _, full_pred[:, tt, :] = model(input_data[:, tt, :])  # compute prediction at this time
     return full_pred
 
 def bptt_training(rnn, optimiser, dict_training_params, d_dict=None,
                   x_train=None, x_test=None, y_train=None, y_test=None,
                   simulated_annealing=False, ratio_exp_array=None,
-                  verbose=1, late_s2=False, use_gpu=False, save_state=False):
+                  verbose=1, late_s2=False, use_gpu=False, save_state=False, rng=None,
+                  masks_train=None, masks_test=None):
     '''Training algorithm for backpropagation through time, given a RNN model, optimiser,
     dictionary with training parameters and train and test data. RNN is NOT reset,
     so continuation training is possible. Training can be aborted prematurely by Ctrl+C,
-    and it will terminate correctly.'''
+    and it will terminate correctly. rng (np.random.Generator) is used to generate
+    the data of each epoch in case of simulated annealing. masks_train and masks_test
+    (dicts of get_window_masks()) define the loss windows per trial, eg for mixed-timing data.'''
     # assert dict_training_params['bs'] == 1, 'batch size is not 1; this error is thrown because for MNM we assume it is 1 to let labels correspond to dataloadre loop'
     if simulated_annealing is False:
         assert x_train is not None  #and also the others technically
     else:
         assert ratio_exp_array is not None
         assert d_dict is not None
+        assert masks_train is None, 'masks not implemented for simulated annealing'
 
     if simulated_annealing is False:  # use same data [that is passed as arg] on each epoch
         ## Create data loader objects:
-        train_ds = TensorDataset(x_train, y_train)
+        if masks_train is None:
+            train_ds = TensorDataset(x_train, y_train)
+        else:  # add trial index to look up masks of batch
+            train_ds = TensorDataset(x_train, y_train, torch.arange(x_train.shape[0]))
         train_dl = DataLoader(train_ds, batch_size=dict_training_params['bs'])
 
         test_ds = TensorDataset(x_test, y_test)
@@ -543,7 +697,8 @@ def bptt_training(rnn, optimiser, dict_training_params, d_dict=None,
                     tmp0, tmp1 = generate_synt_data_general(n_total=d_dict['n_total'], t_delay=d_dict['t_delay'], t_stim=d_dict['t_stim'],
                                                 ratio_train=d_dict['ratio_train'], ratio_exp=ratio_exp_array[epoch],  # with current exp ratio
                                                 noise_scale=d_dict['noise_scale'], late_s2=late_s2,
-                                                nature_stim=rnn.info_dict['nature_stim'], task=rnn.info_dict['type_task'])
+                                                nature_stim=rnn.info_dict['nature_stim'], task=rnn.info_dict['type_task'],
+                                                n_cat=d_dict['n_cat'] if 'n_cat' in d_dict.keys() else None, rng=rng)
 
                     x_train, y_train, x_test, y_test = tmp0
                     train_ds = TensorDataset(x_train, y_train)
@@ -563,13 +718,16 @@ def bptt_training(rnn, optimiser, dict_training_params, d_dict=None,
                 rnn.train()  # set to train model (i.e. allow gradient computation/tracking)
                 it_train = 0
 
-                for xb, yb in train_dl:  # returns torch(n_bs x n_times x n_freq)
+                for batch in train_dl:  # returns torch(n_bs x n_times x n_freq)
+                    xb, yb = batch[0], batch[1]
+                    masks_b = None if masks_train is None else {key: val[batch[2]] for key, val in masks_train.items()}
                     if use_gpu:
                         xb, yb = xb.to(device), yb.to(device)
                         rnn.to(device)
                     # curr_label = labels_train[it_train]  # this works if batch size == 1
-                    full_pred = compute_full_pred(model=rnn, input_data=xb)  # predict time trace
-                    loss, _ = total_loss(y_est=full_pred, y_true=yb, model=rnn, late_s2=late_s2)
+                    full_pred = compute_full_pred(model=rnn, input_data=xb,
+                                                  valid_mask=None if masks_b is None else masks_b['valid'])  # predict time trace
+                    loss, _ = total_loss(y_est=full_pred, y_true=yb, model=rnn, late_s2=late_s2, masks=masks_b)
                     loss.backward()  # compute gradients
                     optimiser.step()  # update
                     optimiser.zero_grad()   # reset
@@ -578,14 +736,18 @@ def bptt_training(rnn, optimiser, dict_training_params, d_dict=None,
                 rnn.eval()  # evaluation mode -> disable gradient tracking
                 with torch.no_grad():  # to be sure
                     ## Compute losses for saving:
-                    full_train_pred = compute_full_pred(model=rnn, input_data=x_train)
-                    train_loss, _ = total_loss(y_est=full_train_pred, y_true=y_train, model=rnn, late_s2=late_s2)
+                    full_train_pred = compute_full_pred(model=rnn, input_data=x_train,
+                                                        valid_mask=None if masks_train is None else masks_train['valid'])
+                    train_loss, _ = total_loss(y_est=full_train_pred, y_true=y_train, model=rnn, late_s2=late_s2,
+                                               masks=masks_train)
                     if use_gpu:
                         train_loss = train_loss.cpu()
                     rnn.train_loss_arr.append(float(train_loss.detach().numpy()))
 
-                    full_test_pred = compute_full_pred(model=rnn, input_data=x_test)
-                    test_loss_append_split(y_est=full_test_pred, y_true=y_test, model=rnn, late_s2=late_s2)  # append loss within function
+                    full_test_pred = compute_full_pred(model=rnn, input_data=x_test,
+                                                       valid_mask=None if masks_test is None else masks_test['valid'])
+                    test_loss_append_split(y_est=full_test_pred, y_true=y_test, model=rnn, late_s2=late_s2,
+                                           masks=masks_test)  # append loss within function
 
                     ## Inspect training loss for convergence
                     new_loss = rnn.train_loss_arr[epoch]
@@ -613,13 +775,9 @@ def bptt_training(rnn, optimiser, dict_training_params, d_dict=None,
         return rnn
 
 
-def train_decoder(rnn_model, x_train, x_test, labels_train, labels_test,
-                  save_inplace=False, label_name='s1', sparsity_c=1e-1,
-                  bool_train_decoder=True, decoder_type='logistic_regression'):
-
-    """Train decoder on rnn_model given data, for label_name representaoitn.
-    if bool_train_decoder is False, then the decoder is not trained (but a forward pass
-    is done). If save_inplace is True the results are saved in the RNN (and they are always returned)"""
+def compute_forward_activity(rnn_model, x_train, x_test):
+    """Forward runs of rnn_model on train and test trials; returns forw_mat dict with hidden
+    states (trials x time x neurons) of 'train' and 'test'."""
     n_nodes = rnn_model.info_dict['n_nodes']
     forw_mat = {'train': np.zeros((x_train.shape[0], x_train.shape[1], n_nodes)),  # trials x time x neurons
                  'test': np.zeros((x_test.shape[0], x_test.shape[1], n_nodes))}
@@ -644,58 +802,56 @@ def train_decoder(rnn_model, x_train, x_test, labels_train, labels_test,
                 hidden_state, output = rnn_model.forward(inp=x_test[kk, tau, :],
                                                          rnn_state=hidden_state)
                 forw_mat['test'][kk, tau, :] = hidden_state.numpy()
+    return forw_mat
 
-        if bool_train_decoder:
-            ## Train decoder
-            assert rnn_model.info_dict['nature_stim'] == 'onehot', 'periodic not yet implemented because S2 decoding is determined by label (is not specific because of =x)'
-            s1_labels = {'train': np.array([int(x[0]) for x in labels_train]),
-                         'test': np.array([int(x[0]) for x in labels_test])}
-             # s2_labels = {'train': np.array([int(x[1]) for x in labels_train]),
-             #              'test': np.array([int(x[1]) for x in labels_test])}
-            s2_labels = {'train': np.zeros(len(labels_train), dtype='int'),
-                         'test': np.zeros(len(labels_test), dtype='int')}
-            mnm_labels = {'train': np.array([int(x[0] == x[1]) for x in labels_train]),
-                          'test': np.array([int(x[0] == x[1]) for x in labels_test])}
-            for ds_type, labels_type in zip(('train', 'test'), (labels_train, labels_test)):
-                for i_lab, lab in enumerate(labels_type):
-                    if lab[1] == 'x':
-                        numeric_lab = ('1' if lab[0] == '2' else '2')  # opposite from first label
-                        s2_labels[ds_type][i_lab] = numeric_lab
-                    else:
-                        s2_labels[ds_type][i_lab] = lab[1]
-            if label_name == 's1':
-                labels_use = s1_labels
-            elif label_name == 's2':
-                labels_use = s2_labels
-                # assert False, 'double check to make sure s2_labels is handled correctly by decoder. because it is filled with floats not str'
-            elif label_name == 'go':
-                labels_use = mnm_labels
-            else:
-                assert False, f'Label name {label_name} not implemented. Please choose s1 or s2 or go. Aborting'
-            score_mat = np.zeros((n_times, n_times))  # T x T
-            decoder_dict = {}  # save decoder per time
-            for tau in range(n_times):  # train time loop
-                # decoder_dict[tau] = sklearn.svm.LinearSVC(C=sparsity_c)  # define SVM
-                if decoder_type == 'logistic_regression':
-                    decoder_dict[tau] = sklearn.linear_model.LogisticRegression(C=sparsity_c,
-                                                            solver='saga', penalty='l1', max_iter=250)  # define log reg
-                elif decoder_type == 'LDA':
-                     decoder_dict[tau] = sklearn.discriminant_analysis.QuadraticDiscriminantAnalysis()  # define log reg
-                decoder_dict[tau].fit(X=forw_mat['train'][:, tau, :],
-                                      y=labels_use['train'])  # train SVM
-                for tt in range(n_times):  # test time loop
-                    # score_mat[tau, tt] = decoder_dict[tau].score(X=forw_mat['test'][:, tt, :],
-                    #                                              y=labels_use['test'])  # evaluate
-                    prediction = decoder_dict[tau].predict_proba(X=forw_mat['test'][:, tt, :])
-                    inds_labels = np.zeros_like(labels_use['test'], dtype='int')  # zero = class 0
-                    inds_labels[(labels_use['test'] == decoder_dict[tau].classes_[1])] = 1
-                    prob_correct = np.array([prediction[i_pred, ind] for i_pred, ind in enumerate(inds_labels)])
-                    score_mat[tau, tt] = np.mean(prob_correct)
-                    # score_mat[tau, tt] = np.exp(np.mean(np.log(prob_correct)))
+def get_decoding_labels(labels):
+    '''Numeric labels of the representations s1, s2 and go (match/non-match) of trials with labels
+    (eg '12', '1x'). For non-match trials with S2 'x', S2 is the category opposite from S1.'''
+    s1_labels = np.array([int(x[0]) for x in labels])
+    s2_labels = np.array([int(x[1]) if x[1] != 'x' else (1 if x[0] == '2' else 2) for x in labels], dtype='int')  # opposite from first label
+    mnm_labels = np.array([int(x[0] == x[1]) for x in labels])
+    return {'s1': s1_labels, 's2': s2_labels, 'go': mnm_labels}
+
+def train_decoder(rnn_model, x_train, x_test, labels_train, labels_test,
+                  save_inplace=False, label_name='s1', sparsity_c=1e-1,
+                  bool_train_decoder=True, decoder_type='logistic_regression', warm_start=False,
+                  forw_mat=None, window=1, window_mode='mean', reg_param=0.0):
+
+    """Train decoder on rnn_model given data, for label_name representaoitn.
+    if bool_train_decoder is False, then the decoder is not trained (but a forward pass
+    is done). If save_inplace is True the results are saved in the RNN (and they are always returned).
+    If warm_start is True, logistic regression decoders of time point tau are initialised at the
+    solution of tau - 1 (see decoders.compare_warm_start() for the speed-up).
+    label_name can also be a list of labels (eg ['s1', 's2', 'go']), which are all decoded from the
+    same forward runs; score_mat and decoder_dict are then returned as dicts with these labels as keys.
+    If forw_mat (output of compute_forward_activity()) is given, the forward runs are skipped.
+    If window > 1, decoders use time windows of window time points (see decoders.window_features()),
+    so score_mat has one row/column per window. reg_param regularises the covariances of LDA/QDA decoders
+    (see decoders.fit_discriminant())."""
+    list_labels = [label_name] if type(label_name) is str else list(label_name)
+    if forw_mat is None:
+        forw_mat = compute_forward_activity(rnn_model=rnn_model, x_train=x_train, x_test=x_test)
+
+    if bool_train_decoder:
+        ## Train decoder
+        assert rnn_model.info_dict['nature_stim'] == 'onehot', 'periodic not yet implemented because S2 decoding is determined by label (is not specific because of =x)'
+        assert rnn_model.n_input == 6, 'only 2 categories implemented because S2 decoding is determined by label'
+        labels_dict = {ds_type: get_decoding_labels(labels=labels_type) for ds_type, labels_type in zip(('train', 'test'), (labels_train, labels_test))}
+        labels_dict = {lab: {'train': labels_dict['train'][lab], 'test': labels_dict['test'][lab]} for lab in labels_dict['train'].keys()}
+        score_mat, decoder_dict = {}, {}
+        for lab in list_labels:  # all representations are decoded from the same forward runs
+            assert lab in labels_dict.keys(), f'Label name {lab} not implemented. Please choose s1 or s2 or go. Aborting'
+            score_mat[lab], decoder_dict[lab] = decoders.train_crosstemp(activity_train=forw_mat['train'], labels_train=labels_dict[lab]['train'],
+                                                                         activity_test=forw_mat['test'], labels_test=labels_dict[lab]['test'],
+                                                                         decoder_type=decoder_type, C=sparsity_c, warm_start=warm_start,
+                                                                         window=window, window_mode=window_mode, reg_param=reg_param)
     if bool_train_decoder:
         if save_inplace:
-            rnn_model.decoding_crosstemp_score[label_name] = score_mat
-            rnn_model.decoder_dict[label_name] = decoder_dict
+            for lab in list_labels:
+                rnn_model.decoding_crosstemp_score[lab] = score_mat[lab]
+                rnn_model.decoder_dict[lab] = decoder_dict[lab]
+        if type(label_name) is str:
+            return score_mat[label_name], decoder_dict[label_name], forw_mat
         return score_mat, decoder_dict, forw_mat
     else:
         return None, None, forw_mat
@@ -704,8 +860,16 @@ def train_decoder(rnn_model, x_train, x_test, labels_train, labels_test,
 def train_single_decoder_new_data(rnn, ratio_expected=0.5, label='s1',
                                   n_samples=None, ratio_train=0.8, verbose=False,
                                   sparsity_c=0.1, bool_train_decoder=True,
-                                  decoder_type='logistic_regression', save_inplace=True):
-    '''Generates new data, and then trains the decoder via train_decoder()'''
+                                  decoder_type='logistic_regression', save_inplace=True, warm_start=False,
+                                  data_seed=None, decoder_store=None, reg_param=0.0):
+    '''Generates new data, and then trains the decoder via train_decoder().
+    If data_seed is given, data generation and forward runs are seeded by it, and the forward
+    activity is read from/written to the activity cache (see activity_cache.set_default_cache()). If data_seed
+    is None, the default data seed of the activity cache is used, if set (see activity_cache.get_data_seed()).
+    If decoder_store (decoder_store.DecoderStore) is given and save_inplace, the decoders are saved in
+    the store instead of in rnn.decoder_dict, and rnn.decoder_store_refs references them (see get_decoder_dict()).
+    reg_param regularises the covariances of LDA/QDA decoders (see decoders.fit_discriminant()).'''
+    data_seed = activity_cache.get_data_seed(data_seed=data_seed)
     if n_samples is None:
         n_samples = rnn.info_dict['n_total']
 
@@ -714,58 +878,177 @@ def train_single_decoder_new_data(rnn, ratio_expected=0.5, label='s1',
         early_match = rnn.info_dict['early_match']
     else:
         early_match = False
-    tmp0, tmp1 = generate_synt_data_general(n_total=n_samples,
-                                   t_delay=rnn.info_dict['t_delay'],
-                                   t_stim=rnn.info_dict['t_stim'],
-                                   ratio_train=ratio_train,
-                                   ratio_exp=ratio_expected,
-                                   noise_scale=rnn.info_dict['noise_scale'],
-                                   late_s2=rnn.info_dict['late_s2'],  nature_stim=rnn.info_dict['nature_stim'],
-                                   task=rnn.info_dict['type_task'], early_match=early_match)
-    x_train, y_train, x_test, y_test = tmp0
-    labels_train, labels_test = tmp1
+    data_params = {'n_total': n_samples, 't_delay': rnn.info_dict['t_delay'], 't_stim': rnn.info_dict['t_stim'],
+                   'ratio_train': ratio_train, 'ratio_exp': ratio_expected, 'noise_scale': rnn.info_dict['noise_scale'],
+                   'late_s2': rnn.info_dict['late_s2'], 'nature_stim': rnn.info_dict['nature_stim'],
+                   'task': rnn.info_dict['type_task'], 'early_match': early_match,
+                   'n_cat': rnn.info_dict['n_cat'] if 'n_cat' in rnn.info_dict.keys() else None}
+    cache = activity_cache.get_default_cache() if data_seed is not None else None
+    if cache is not None:
+        cache_key = cache.get_key(rnn=rnn, data_params=data_params, data_seed=data_seed)
+        forward_mat = cache.load(key=cache_key)
+    else:
+        forward_mat = None
+    if forward_mat is None:
+        tmp0, tmp1 = generate_synt_data_general(**data_params,
+                                                rng=None if data_seed is None else np.random.default_rng(data_seed))
+        x_train, y_train, x_test, y_test = tmp0
+        labels_train, labels_test = tmp1
+        with torch.random.fork_rng(devices=[], enabled=(data_seed is not None)):  # seed initial states without changing global seed
+            if data_seed is not None:
+                torch.manual_seed(data_seed)
+            forward_mat = compute_forward_activity(rnn_model=rnn, x_train=x_train, x_test=x_test)
+        forward_mat['labels_train'] = labels_train
+        forward_mat['labels_test'] = labels_test
+        if cache is not None:
+            cache.save(key=cache_key, forw_mat=forward_mat)
+    else:
+        labels_train, labels_test = forward_mat['labels_train'], forward_mat['labels_test']
     if verbose > 0:
         print('train labels ', {x: np.sum(labels_train == x) for x in np.unique(labels_train)})
     ## Train decoder:
-    score_mat, decoder_dict, forward_mat = train_decoder(rnn_model=rnn, x_train=x_train, x_test=x_test,
+    score_mat, decoder_dict, forward_mat = train_decoder(rnn_model=rnn, x_train=None, x_test=None,
                                            labels_train=labels_train, labels_test=labels_test,
-                                           save_inplace=save_inplace, sparsity_c=sparsity_c, label_name=label,
-                                           bool_train_decoder=bool_train_decoder, decoder_type=decoder_type)
-    forward_mat['labels_train'] = labels_train
-    forward_mat['labels_test'] = labels_test
+                                           save_inplace=(save_inplace and decoder_store is None), sparsity_c=sparsity_c,
+                                           label_name=label, bool_train_decoder=bool_train_decoder, decoder_type=decoder_type,
+                                           warm_start=warm_start, forw_mat=forward_mat, reg_param=reg_param)
+    if save_inplace and bool_train_decoder and decoder_store is not None:  # save decoders in store, keep reference in rnn
+        dict_score = {label: score_mat} if type(label) is str else score_mat
+        dict_decoders = {label: decoder_dict} if type(label) is str else decoder_dict
+        if hasattr(rnn, 'decoder_store_refs') is False:
+            rnn.decoder_store_refs = {}
+        model_id = activity_cache.hash_weights(rnn)[:16]  # identical copies of a network are distinguished by file name:
+        if hasattr(rnn, 'full_path') and rnn.full_path is not None:
+            model_id = os.path.basename(rnn.full_path)[:-5] + '_' + model_id
+        for lab in dict_score.keys():
+            rnn.decoding_crosstemp_score[lab] = dict_score[lab]
+            rnn.decoder_store_refs[lab] = decoder_store.save(model_id=model_id, label=lab, decoder_type=decoder_type,
+                                                             C=sparsity_c, data_seed=data_seed, score_mat=dict_score[lab],
+                                                             decoder_dict=dict_decoders[lab])
+            rnn.decoder_dict.pop(lab, None)  # remove stale decoder objects
     return score_mat, decoder_dict, forward_mat
 
+def get_decoder_dict(rnn, label='s1'):
+    '''Return decoders of label of rnn, from rnn.decoder_dict or else from the decoder store.'''
+    if label in rnn.decoder_dict.keys():
+        return rnn.decoder_dict[label]
+    assert hasattr(rnn, 'decoder_store_refs') and label in rnn.decoder_store_refs.keys(), f'no decoders of {label} in {rnn}'
+    return decoder_store_module.get_decoder_dict(ref=rnn.decoder_store_refs[label])
+
+def train_decoder_cv(rnn, label='s1', decoder_type='logistic_regression', sparsity_c=0.1,
+                     n_folds=5, n_repeats=1, n_processes=1, n_samples=None, data_seed=None,
+                     save_inplace=False, reg_param=0.0):
+    '''Cross-validated cross-temporal decoding (decoders.train_crosstemp_cv()) of label (or list of labels)
+    on all trials of one new data set, with one forward pass (read from the activity cache if data_seed
+    is given). If save_inplace, the mean score matrix is saved in rnn.decoding_crosstemp_score and its
+    std over folds in rnn.decoding_crosstemp_std.
+
+    Returns
+    -------
+    cv_dict : dict
+        mean, std and per-fold score matrices (see decoders.train_crosstemp_cv()), per label if label is a list.
+    '''
+    data_seed = activity_cache.get_data_seed(data_seed=data_seed)
+    _, __, forw = train_single_decoder_new_data(rnn=rnn, n_samples=n_samples, bool_train_decoder=False,
+                                                data_seed=data_seed)
+    activity = np.concatenate([forw['train'], forw['test']], 0)  # all trials, split in folds below
+    labels_dict = get_decoding_labels(labels=np.concatenate([forw['labels_train'], forw['labels_test']]))
+    list_labels = [label] if type(label) is str else list(label)
+    cv_dict = {}
+    for lab in list_labels:
+        assert lab in labels_dict.keys(), f'Label name {lab} not implemented. Please choose s1 or s2 or go. Aborting'
+        cv_dict[lab] = decoders.train_crosstemp_cv(activity=activity, labels=labels_dict[lab], decoder_type=decoder_type,
+                                                   C=sparsity_c, n_folds=n_folds, n_repeats=n_repeats, n_processes=n_processes,
+                                                   rng=None if data_seed is None else np.random.default_rng(data_seed),
+                                                   reg_param=reg_param)
+        if save_inplace:
+            if hasattr(rnn, 'decoding_crosstemp_std') is False:
+                rnn.decoding_crosstemp_std = {}
+            rnn.decoding_crosstemp_score[lab] = cv_dict[lab]['mean']
+            rnn.decoding_crosstemp_std[lab] = cv_dict[lab]['std']
+    if type(label) is str:
+        return cv_dict[label]
+    return cv_dict
+
+def decode_rnn_file(rnn_folder, rnn_name, ratio_expected=0.5, n_samples=None, ratio_train=0.8,
+                    label='s1', reset_decoders=False, skip_if_already_decoded=True, verbose=False,
+                    decoder_store_folder=None, data_seed=None):
+    '''Load RNN rnn_name from rnn_folder, train its decoders (see train_multiple_decoders()) and save
+    it in place (atomically). Returns True if decoded, False if skipped.'''
+    rnn = rnn_io.load_model(path=rnn_folder + rnn_name)
+    assert rnn_name == rnn.full_path.split('/')[-1]
+    if skip_if_already_decoded:
+        if rnn.decoding_crosstemp_score != {}:  # already decoded before
+            return False
+    if reset_decoders:
+        rnn.decoding_crosstemp_score = {}
+        rnn.decoder_dict = {}
+        rnn.decoder_store_refs = {}
+
+    _ = train_single_decoder_new_data(rnn=rnn, ratio_expected=ratio_expected,
+                                      n_samples=n_samples, ratio_train=ratio_train, verbose=verbose, label=label,
+                                      data_seed=data_seed, decoder_store=(None if decoder_store_folder is None else
+                                                     decoder_store_module.DecoderStore(store_folder=decoder_store_folder))) # results are saved in RNN class
+    rnn.save_model(folder=rnn_folder, verbose=0, allow_name_change=False)  # save results to file
+    return True
+
+def init_decoding_worker():
+    '''Initialise worker process of train_multiple_decoders(): one torch thread per process, and
+    fresh random states (forked workers would otherwise all generate the same data).'''
+    torch.set_num_threads(1)
+    np.random.seed()
+    torch.manual_seed(np.random.randint(np.iinfo(np.int32).max))
+
 def train_multiple_decoders(rnn_folder='models/', ratio_expected=0.5,
                             n_samples=None, ratio_train=0.8, label='s1',
-                            reset_decoders=False, skip_if_already_decoded=True):
+                            reset_decoders=False, skip_if_already_decoded=True,
+                            n_processes=1, max_queued=None, decoder_store_folder=None, data_seed=None):
     '''train decoders for all RNNs in rnn_folder. If reset_decoders; train always. Else
     if skip_if_already_decoded is True, then skip if trained decoder already exists in RNN class.
-    NB: This could be a different decoder, as they are not saved by representation or decoder type (eg log reg, lda)'''
+    label can be a list of labels, which are then all decoded from one data set & forward pass per RNN (and saved once).
+    NB: This could be a different decoder, as they are not saved by representation or decoder type (eg log reg, lda)
+    If n_processes > 1, RNNs are decoded in parallel by a pool of processes, with at most max_queued
+    (default 2 * n_processes) RNNs submitted at a time. Files are replaced atomically, so an interrupted
+    run leaves each file either decoded or as it was. Returns the number of decoded RNNs.
+    If decoder_store_folder is given, decoders are saved there (see decoder_store.py) instead of in the RNN files.
+    If data_seed is given (or the default data seed of the activity cache is set), all RNNs are decoded on the
+    same data set, and their forward activity is cached (see activity_cache.py).'''
     rnn_list = ru.get_list_rnns(rnn_folder=rnn_folder)
-    for i_rnn, rnn_name in tqdm(enumerate(rnn_list)):
-        ## Load RNN:
-        with open(rnn_folder + rnn_name, 'rb') as f:
-            rnn = pickle.load(f)
-        assert rnn_name == rnn.full_path.split('/')[-1]
-        if skip_if_already_decoded:
-            if rnn.decoding_crosstemp_score != {}:  # already decoded before
-                continue
-        if reset_decoders:
-            rnn.decoding_crosstemp_score = {}
-            rnn.decoder_dict = {}
-
-        _ = train_single_decoder_new_data(rnn=rnn, ratio_expected=ratio_expected,
-                                          n_samples=n_samples, ratio_train=ratio_train,
-                                          verbose=(i_rnn == 0), label=label) # results are saved in RNN class
-        rnn.save_model(folder=rnn_folder, verbose=0, allow_name_change=False)  # save results to file
-    return None
-
-def save_pearson_corr(rnn, representation='s1', set_nans=True, save_inplace=False):
-    """Compute cross correlation and save"""
+    if rnn_folder[-1] != '/':
+        rnn_folder += '/'
+    kwargs = {'rnn_folder': rnn_folder, 'ratio_expected': ratio_expected, 'n_samples': n_samples,
+              'ratio_train': ratio_train, 'label': label, 'reset_decoders': reset_decoders,
+              'skip_if_already_decoded': skip_if_already_decoded, 'decoder_store_folder': decoder_store_folder,
+              'data_seed': activity_cache.get_data_seed(data_seed=data_seed)}  # resolved here, workers do not share the default
+    t_start = time.time()
+    decoded = []
+    if n_processes == 1:
+        for i_rnn, rnn_name in tqdm(enumerate(rnn_list), total=len(rnn_list), unit='rnn'):
+            decoded.append(decode_rnn_file(rnn_name=rnn_name, verbose=(i_rnn == 0), **kwargs))
+    else:
+        if max_queued is None:
+            max_queued = 2 * n_processes
+        queue = collections.deque()  # bounded queue of submitted RNNs
+        with Pool(n_processes, initializer=init_decoding_worker) as pool, tqdm(total=len(rnn_list), unit='rnn') as pbar:
+            for rnn_name in rnn_list:
+                if len(queue) >= max_queued:  # wait for oldest before submitting more
+                    decoded.append(queue.popleft().get())
+                    pbar.update(1)
+                queue.append(pool.apply_async(decode_rnn_file, kwds={'rnn_name': rnn_name, **kwargs}))
+            while len(queue) > 0:
+                decoded.append(queue.popleft().get())
+                pbar.update(1)
+    duration = time.time() - t_start
+    print(f'Decoded {np.sum(decoded)} RNNs (skipped {len(decoded) - np.sum(decoded)}) in {duration:.1f}s: ' +
+          f'{np.sum(decoded) / max(duration, 1e-6):.2f} networks/sec')
+    return int(np.sum(decoded))
+
+def save_pearson_corr(rnn, representation='s1', set_nans=True, save_inplace=False, data_seed=None):
+    """Compute cross correlation and save. If data_seed is given, forward activity may be read from the activity cache."""
     assert representation == 's1' or representation == 's1' or representation == 'go'
     assert rnn.info_dict['nature_stim'] == 'onehot' and rnn.info_dict['type_task'] in ['dmc', 'dms'], 'not implemented'
     ## get forward activity
-    _, __, forw  = train_single_decoder_new_data(rnn=rnn, ratio_expected=0.5,
+    _, __, forw  = train_single_decoder_new_data(rnn=rnn, ratio_expected=0.5, data_seed=data_seed,
                                                  sparsity_c=0.1, bool_train_decoder=False)  # just gets data without training decoder
 
     plot_diff, labels_use_1, labels_use_2 = ru.calculate_diff_activity(forw=forw, representation=representation)
@@ -790,17 +1073,85 @@ def save_pearson_corr(rnn, representation='s1', set_nans=True, save_inplace=Fals
         # rnn.save_model(folder=rnn_folder, verbose=0, allow_name_change=False)  # save results to file
     return corr_mat
 
+def get_spawn_key(cell_name='', i_sim=0):
+    """Return SeedSequence spawn key for simulation i_sim of sweep cell cell_name (eg its save folder)."""
+    return (zlib.crc32(str(cell_name).encode()), int(i_sim))
+
+def get_simulation_rngs(seed_entropy, spawn_key):
+    """Derive independent numpy and torch random streams of one simulation from a SeedSequence.
+
+    Parameters
+    ----------
+    seed_entropy : int
+        entropy of the root SeedSequence (shared by all simulations of a sweep).
+    spawn_key : tuple of int
+        identifies the simulation, see get_spawn_key().
+
+    Returns
+    -------
+    np_rng : np.random.Generator
+        generator for data generation.
+    torch_seed : int
+        seed for torch (weight init & initial states).
+    """
+    seed_seq = np.random.SeedSequence(entropy=seed_entropy, spawn_key=tuple(spawn_key))
+    ss_numpy, ss_torch = seed_seq.spawn(2)
+    np_rng = np.random.default_rng(ss_numpy)
+    torch_seed = int(ss_torch.generate_state(1, dtype=np.uint64)[0] >> np.uint64(1))  # 63 bit, fits in int64 of torch
+    return np_rng, torch_seed
+
+def get_eval_rng(seed_entropy, cell_name=''):
+    """Generator of the shared evaluation set of sweep cell cell_name (distinct from all simulation streams)."""
+    return np.random.default_rng(np.random.SeedSequence(entropy=seed_entropy,
+                                                        spawn_key=get_spawn_key(cell_name=cell_name)[:1]))
+
+def save_shared_eval_set(eval_folder, d_dict, nature_stim='onehot', type_task='dmc',
+                         late_s2=False, early_match=False, rng=None):
+    """Generate one held-out evaluation set (of the test set size given by d_dict) and save
+    it as .npy files in eval_folder, so that all training workers can memory-map it."""
+    n_test = d_dict['n_total'] - int(d_dict['ratio_train'] * d_dict['n_total'])
+    tmp0, tmp1 = generate_synt_data_general(n_total=n_test, t_delay=d_dict['t_delay'], t_stim=d_dict['t_stim'],
+                                            ratio_train=1, ratio_exp=d_dict['ratio_exp'],
+                                            noise_scale=d_dict['noise_scale'], late_s2=late_s2,
+                                            nature_stim=nature_stim, task=type_task, early_match=early_match,
+                                            n_cat=d_dict['n_cat'] if 'n_cat' in d_dict.keys() else None, rng=rng)
+    np.save(os.path.join(eval_folder, 'x_eval.npy'), tmp0[0].numpy())
+    np.save(os.path.join(eval_folder, 'y_eval.npy'), tmp0[1].numpy())
+    np.save(os.path.join(eval_folder, 'labels_eval.npy'), tmp1[0].astype(str))
+    return eval_folder
+
+def load_shared_eval_set(eval_folder):
+    """Memory-map evaluation set saved by save_shared_eval_set(). Pages are shared between
+    processes (copy-on-write), so the data is neither regenerated nor pickled per worker."""
+    x_eval = torch.from_numpy(np.load(os.path.join(eval_folder, 'x_eval.npy'), mmap_mode='c'))
+    y_eval = torch.from_numpy(np.load(os.path.join(eval_folder, 'y_eval.npy'), mmap_mode='c'))
+    labels_eval = np.load(os.path.join(eval_folder, 'labels_eval.npy')).astype(object)
+    return x_eval, y_eval, labels_eval
+
 def execute_rnn_training(nn, n_simulations, t_dict, d_dict, nature_stim='',
                         type_task='', task_name='', device='', late_s2=False,
                         train_task='', save_folder='', use_gpu=False,
                         simulated_annealing=False, ratio_exp_array=None,
-                        save_state=False):
-    """Create data, RNN and train using all input parameters"""
+                        save_state=False, seed_entropy=None, spawn_key=None, eval_folder=None,
+                        async_save=False):
+    """Create data, RNN and train using all input parameters. The random streams are derived
+    from (seed_entropy, spawn_key), so the same network is obtained irrespective of the process
+    it runs in. If spawn_key is None it is derived from (save_folder, nn). If eval_folder is
+    given, the test set is the shared evaluation set saved there (see save_shared_eval_set())
+    and only train data is generated. If save_folder is None the RNN is not saved. If async_save,
+    the RNN is written in the background by the writer of this process (see model_writer.py).
+    Returns trained RNN."""
     print(f'\n-----------\nsimulation {nn}/{n_simulations}')
 
-    ## Ensure seeds change with multi processing
-    np.random.seed(np.random.get_state()[1][0] + nn)
-    print('seed:', np.random.get_state()[1][0])
+    ## Independent random streams per (sweep cell, simulation):
+    if seed_entropy is None:
+        seed_entropy = np.random.SeedSequence().entropy
+    if spawn_key is None:
+        spawn_key = get_spawn_key(cell_name=save_folder, i_sim=nn)
+    np_rng, torch_seed = get_simulation_rngs(seed_entropy=seed_entropy, spawn_key=spawn_key)
+    torch.manual_seed(torch_seed)  # torch stream of this process is reset per simulation
+    print('seed:', seed_entropy, spawn_key)
+    n_cat = d_dict['n_cat'] if 'n_cat' in d_dict.keys() else None
 
     if simulated_annealing is False:
         ## Generate data:
@@ -808,19 +1159,31 @@ def execute_rnn_training(nn, n_simulations, t_dict, d_dict, nature_stim='',
             early_match = t_dict['early_match']
         else:
             early_match = False
-        tmp0, tmp1 = generate_synt_data_general(n_total=d_dict['n_total'], t_delay=d_dict['t_delay'], t_stim=d_dict['t_stim'],
-                                    ratio_train=d_dict['ratio_train'], ratio_exp=d_dict['ratio_exp'],
+        mixed_timing = np.ndim(d_dict['t_delay']) > 0
+        if eval_folder is None:
+            n_total, ratio_train = d_dict['n_total'], d_dict['ratio_train']
+        else:  # train data only
+            n_total, ratio_train = int(d_dict['ratio_train'] * d_dict['n_total']), 1
+        tmp_data = generate_synt_data_general(n_total=n_total, t_delay=d_dict['t_delay'], t_stim=d_dict['t_stim'],
+                                    ratio_train=ratio_train, ratio_exp=d_dict['ratio_exp'],
                                     noise_scale=d_dict['noise_scale'], late_s2=late_s2,
-                                    nature_stim=nature_stim, task=type_task, early_match=early_match)
-
-        x_train, y_train, x_test, y_test = tmp0
-        labels_train, labels_test = tmp1
+                                    nature_stim=nature_stim, task=type_task, early_match=early_match,
+                                    n_cat=n_cat, rng=np_rng, return_masks=mixed_timing)
+
+        x_train, y_train, x_test, y_test = tmp_data[0]
+        labels_train, labels_test = tmp_data[1]
+        masks_train, masks_test = tmp_data[2] if mixed_timing else (None, None)
+        if eval_folder is not None:
+            assert mixed_timing is False, 'shared evaluation set not implemented for mixed timing'
+            x_test, y_test, labels_test = load_shared_eval_set(eval_folder=eval_folder)
         if use_gpu:
             x_train, y_train = x_train.to(device), y_train.to(device)
             x_test, y_test = x_test.to(device), y_test.to(device)
         ratio_exp_array = None
     else:
+        assert eval_folder is None, 'shared evaluation set not implemented for simulated annealing'
         x_train, y_train, x_test, y_test = None, None, None, None
+        masks_train, masks_test = None, None
         if ratio_exp_array is None:
             total_epochs = t_dict['n_epochs']
             assert total_epochs == 200, 'number of epochs not equal to 200 (hard set)'
@@ -832,7 +1195,8 @@ def execute_rnn_training(nn, n_simulations, t_dict, d_dict, nature_stim='',
             ratio_exp_array[int(0.8 * total_epochs):] = 0.5
 
     ## Initiate RNN model
-    rnn = RNN_MTL(task=task_name, nature_stim=nature_stim, n_nodes=t_dict['n_nodes'])  # Create RNN class
+    rnn = RNN_MTL(task=task_name, nature_stim=nature_stim, n_nodes=t_dict['n_nodes'],
+                  n_input=get_n_input(nature_stim=nature_stim, n_cat=n_cat))  # Create RNN class
     if use_gpu:
         rnn.to(device)
     opt = torch.optim.SGD(rnn.parameters(), lr=t_dict['learning_rate'])  # call optimiser from pytorhc
@@ -841,6 +1205,9 @@ def execute_rnn_training(nn, n_simulations, t_dict, d_dict, nature_stim='',
     rnn.info_dict['train_task'] = train_task
     rnn.info_dict['late_s2'] = late_s2
     rnn.info_dict['simulated_annealing'] = simulated_annealing
+    rnn.info_dict['seed_entropy'] = seed_entropy
+    rnn.info_dict['seed_spawn_key'] = tuple(spawn_key)
+    rnn.info_dict['shared_eval_set'] = eval_folder is not None
 
     ## Train with BPTT
     if 'early_match' in rnn.info_dict:
@@ -850,7 +1217,7 @@ def execute_rnn_training(nn, n_simulations, t_dict, d_dict, nature_stim='',
                         x_train=x_train, x_test=x_test, y_train=y_train, y_test=y_test,
                         verbose=0, late_s2=late_s2, use_gpu=use_gpu,
                         simulated_annealing=simulated_annealing, ratio_exp_array=ratio_exp_array,
-                        save_state=save_state)
+                        save_state=save_state, rng=np_rng, masks_train=masks_train, masks_test=masks_test)
 
     # ## Decode cross temporally
     # score_mat, decoder_dict, _ = train_single_decoder_new_data(rnn=rnn, ratio_expected=0.5,
@@ -858,16 +1225,56 @@ def execute_rnn_training(nn, n_simulations, t_dict, d_dict, nature_stim='',
     #                                                 late_s2=late_s2)
 
     ## Save results:
-    rnn.save_model(folder=save_folder)
-
-
+    if save_folder is not None:
+        rnn.save_model(folder=save_folder, writer=(model_writer.get_process_writer() if async_save else None))
+    return rnn
+
+def execute_rnn_training_task(*args):
+    """execute_rnn_training() for pool.starmap(), without returning the trained RNN (so that it, including
+    any saved states, is not pickled back to the parent process)."""
+    execute_rnn_training(*args)
+
+def recreate_rnn(info_dict, save_folder=None):
+    """Re-train the network described by info_dict (of a saved RNN) from its recorded seed,
+    which yields the same network."""
+    assert 'seed_entropy' in info_dict.keys(), 'this RNN was trained before seeds were recorded'
+    d_dict = {key: info_dict[key] for key in ['n_total', 'ratio_train', 'ratio_exp', 'noise_scale', 't_delay', 't_stim',
+                                              'n_cat'] if key in info_dict.keys()}
+    t_dict = {key: info_dict[key] for key in ['n_nodes', 'learning_rate', 'bs', 'n_epochs', 'check_conv',
+                                              'conv_rel_tol', 'l1_param', 'early_match'] if key in info_dict.keys()}
+    ratio_exp_array = info_dict['ratio_exp_array'] if info_dict['simulated_annealing'] else None
+    eval_folder = None
+    if 'shared_eval_set' in info_dict.keys() and info_dict['shared_eval_set']:  # regenerate shared evaluation set
+        eval_folder = tempfile.mkdtemp(prefix='eval_set_')
+        rng_eval = np.random.default_rng(np.random.SeedSequence(entropy=info_dict['seed_entropy'],
+                                                                spawn_key=tuple(info_dict['seed_spawn_key'][:1])))  # as get_eval_rng()
+        save_shared_eval_set(eval_folder=eval_folder, d_dict=d_dict, nature_stim=info_dict['nature_stim'],
+                             type_task=info_dict['type_task'], late_s2=info_dict['late_s2'],
+                             early_match=t_dict['early_match'] if 'early_match' in t_dict.keys() else False,
+                             rng=rng_eval)
+    rnn = execute_rnn_training(nn=info_dict['seed_spawn_key'][-1], n_simulations=1, t_dict=t_dict, d_dict=d_dict,
+                               nature_stim=info_dict['nature_stim'], type_task=info_dict['type_task'],
+                               task_name=info_dict['task'], device=device, late_s2=info_dict['late_s2'],
+                               train_task=info_dict['train_task'], save_folder=save_folder,
+                               simulated_annealing=info_dict['simulated_annealing'], ratio_exp_array=ratio_exp_array,
+                               seed_entropy=info_dict['seed_entropy'], spawn_key=info_dict['seed_spawn_key'],
+                               eval_folder=eval_folder)
+    if eval_folder is not None:
+        shutil.rmtree(eval_folder)
+    return rnn
 
 def init_train_save_rnn(t_dict, d_dict, n_simulations=1, use_multiproc=True,
                         n_threads=10, save_folder='models/', use_gpu=False,
                         late_s2=False, nature_stim='onehot', type_task='dmc',
                         train_task='pred_only', simulated_annealing=False, ratio_exp_array=None,
-                        save_state=False):
-    """Train n_simulations of RNN given argument. Uses multiprocessing by default"""
+                        save_state=False, seed_entropy=None, shared_eval_set=False, async_save=False):
+    """Train n_simulations of RNN given argument. Uses multiprocessing by default.
+    All simulations derive their random streams from seed_entropy (new entropy if None),
+    so serial and parallel execution give identical networks. If shared_eval_set, one
+    evaluation set is generated and memory-mapped by all simulations, so that all test
+    losses are computed on the same trials. If async_save, RNNs are saved in a background
+    thread (compressed with the default codec, see compression.py) while the next simulation trains,
+    see model_writer.py."""
     assert type_task in ['dms', 'dmc', 'dmrs', 'dmrc']
     assert train_task in ['pred_only', 'spec_only', 'pred_spec']
     if train_task == 'pred_only':
@@ -877,24 +1284,43 @@ def init_train_save_rnn(t_dict, d_dict, n_simulations=1, use_multiproc=True,
     elif train_task == 'pred_spec':
         task_name = f'pred_{type_task}'
 
-    np.random.seed(np.random.get_state()[1][0] + 100)
+    if seed_entropy is None:
+        seed_entropy = np.random.SeedSequence().entropy
+
+    eval_folder = None
+    if shared_eval_set:
+        assert simulated_annealing is False, 'shared evaluation set not implemented for simulated annealing'
+        eval_folder = tempfile.mkdtemp(prefix='eval_set_')
+        save_shared_eval_set(eval_folder=eval_folder, d_dict=d_dict, nature_stim=nature_stim, type_task=type_task,
+                             late_s2=late_s2, early_match=t_dict['early_match'] if 'early_match' in t_dict.keys() else False,
+                             rng=get_eval_rng(seed_entropy=seed_entropy, cell_name=save_folder))
 
     try:
         if use_multiproc:
-            pool = Pool(n_threads)
-            results = pool.starmap(execute_rnn_training, zip(range(n_simulations), irep(n_simulations),
-                            irep(t_dict), irep(d_dict), irep(nature_stim), irep(type_task), irep(task_name),
-                            irep(device), irep(late_s2), irep(train_task), irep(save_folder), irep(False),
-                            irep(simulated_annealing), irep(ratio_exp_array), irep(save_state)))
+            error_queue = multiprocessing.Queue()  # write errors of the last models of each worker
+            pool = Pool(n_threads, initializer=model_writer.init_pool_worker, initargs=(error_queue,))
+            pool.starmap(execute_rnn_training_task, zip(range(n_simulations), irep(n_simulations),
+                         irep(t_dict), irep(d_dict), irep(nature_stim), irep(type_task), irep(task_name),
+                         irep(device), irep(late_s2), irep(train_task), irep(save_folder), irep(False),
+                         irep(simulated_annealing), irep(ratio_exp_array), irep(save_state),
+                         irep(seed_entropy), irep(None), irep(eval_folder), irep(async_save)))
             pool.close()
+            pool.join()  # workers write their last models when they exit
+            model_writer.raise_pool_errors(error_queue=error_queue)
         else:
-            assert False, 'update this part'
-            # for nn in range(n_simulations):
-                # execute_rnn_training(nn=nn, n_simulations=n_simulations, t_dict=t_dict, d_dict=d_dict, nature_stim=nature_stim,
-                #                     type_task=type_task, task_name=task_name, device=device, late_s2=late_s2,
-                #                     train_task=train_task, save_folder=save_folder, use_gpu=use_gpu)
+            for nn in range(n_simulations):
+                execute_rnn_training(nn=nn, n_simulations=n_simulations, t_dict=t_dict, d_dict=d_dict, nature_stim=nature_stim,
+                                     type_task=type_task, task_name=task_name, device=device, late_s2=late_s2,
+                                     train_task=train_task, save_folder=save_folder, use_gpu=use_gpu,
+                                     simulated_annealing=simulated_annealing, ratio_exp_array=ratio_exp_array,
+                                     save_state=save_state, seed_entropy=seed_entropy, eval_folder=eval_folder,
+                                     async_save=async_save)
     except KeyboardInterrupt:
         print('KeyboardInterrupt, exit')
+    finally:
+        model_writer.close_process_writer()  # write remaining models (serial), raises write errors
+        if eval_folder is not None:
+            shutil.rmtree(eval_folder)
 
 
 
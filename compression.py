@@ -0,0 +1,194 @@
+## Optional compression of model files (rnn_io.py), decoder store entries (decoder_store.py) and activity
+## cache entries (activity_cache.py). Compressed data are zlib streams or zstd/lz4 frames (zip files use zip
+## deflate for 'zlib' instead), which are recognised by their first bytes when reading (.npy data start with
+## \x93NUMPY, pickles with \x80), so compressed and uncompressed files can be mixed and readers need no
+## settings. zstandard and lz4 are optional packages (pip install zstandard lz4), only needed for files
+## that use them. Defaults were picked with the benchmark of this module:
+##   python compression.py --folder models/7525/ --n_files 1000
+
+import numpy as np
+import os, io, zlib, time, argparse, tempfile, shutil
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+codecs = ['zlib', 'zstd', 'lz4']
+default_levels = {'zlib': 6, 'zstd': 3, 'lz4': 0}  # lz4 level 0 is its fast mode
+default_codec = 'zlib'  # best size on models/7525 (1.57x vs 1.33x for zstd 3, at similar load times: python compression.py --folder models/7525/)
+zstd_magic = b'\x28\xb5\x2f\xfd'
+lz4_magic = b'\x04\x22\x4d\x18'
+
+def is_available(codec):
+    '''Whether codec can be used (its package is installed).'''
+    assert codec in codecs, f'codec {codec} not recognised, options: {codecs}'
+    return {'zlib': True, 'zstd': zstandard is not None, 'lz4': lz4 is not None}[codec]
+
+def get_default_codec():
+    return default_codec if is_available(default_codec) else 'zlib'
+
+def resolve_codec(codec):
+    '''Codec name of codec, which can also be 'default' (see get_default_codec()) or None/'none' (no compression).'''
+    if codec is None or codec == 'none':
+        return None
+    if codec == 'default':
+        return get_default_codec()
+    assert is_available(codec), f'codec {codec} is not installed (pip install {"zstandard" if codec == "zstd" else codec})'
+    return codec
+
+def get_level(codec, level=None):
+    return default_levels[codec] if level is None else level
+
+def compress(data, codec, level=None):
+    '''Compress bytes data with codec (zlib stream, or zstd or lz4 frame) at level (default_levels if None).'''
+    codec = resolve_codec(codec)
+    level = None if codec is None else get_level(codec=codec, level=level)
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    elif codec == 'lz4':
+        return lz4.frame.compress(data, compression_level=level)
+    elif codec == 'zlib':
+        return zlib.compress(data, level)
+    return data
+
+def get_codec(data):
+    '''Codec of (the first bytes of) data, None if not compressed.'''
+    if data[:4] == zstd_magic:
+        return 'zstd'
+    if data[:4] == lz4_magic:
+        return 'lz4'
+    if len(data) >= 2 and data[0] == 0x78 and (data[0] * 256 + data[1]) % 31 == 0:  # zlib header
+        return 'zlib'
+    return None
+
+def decompress(data):
+    '''Decompress data if these are compressed by compress(), else return data.'''
+    codec = get_codec(data)
+    if codec is None:
+        return data
+    assert is_available(codec), f'data are compressed with {codec}, which is not installed'
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    elif codec == 'lz4':
+        return lz4.frame.decompress(data)
+    return zlib.decompress(data)
+
+class ZlibStream(io.RawIOBase):
+    def __init__(self, file_obj, chunk_size=2 ** 16):
+        '''Readable stream of the decompressed data of zlib stream file_obj, read in chunks of chunk_size bytes.'''
+        self.file_obj = file_obj
+        self.chunk_size = chunk_size
+        self.decompressor = zlib.decompressobj()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.decompressor.eof:
+            data = self.decompressor.unconsumed_tail  # left over when the output was limited to len(b)
+            if len(data) == 0:
+                data = self.file_obj.read(self.chunk_size)
+                if len(data) == 0:
+                    raise EOFError('zlib stream ended before its end-of-stream marker')
+            out = self.decompressor.decompress(data, len(b))
+            if len(out) > 0:
+                b[:len(out)] = out
+                return len(out)
+        return 0
+
+def open_stream(file_obj):
+    '''Readable stream of the decompressed data of binary file_obj (which must have peek(), like open(.., 'rb')
+    and zipfile.ZipFile.open()), without decompressing everything first.'''
+    codec = get_codec(file_obj.peek(4)[:4])
+    if codec is None:
+        return file_obj
+    assert is_available(codec), f'data are compressed with {codec}, which is not installed'
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().stream_reader(file_obj)
+    elif codec == 'lz4':
+        return lz4.frame.LZ4FrameFile(file_obj, mode='rb')
+    return io.BufferedReader(ZlibStream(file_obj))
+
+def load_array(file_obj):
+    '''Read .npy array from binary file_obj, decompressing it on the fly if needed (see open_stream()).'''
+    return np.lib.format.read_array(open_stream(file_obj), allow_pickle=False)
+
+def save_array_bytes(arr, codec=None, level=None):
+    '''Bytes of arr in .npy format, compressed with codec (see compress()).'''
+    buffer = io.BytesIO()
+    np.save(buffer, arr, allow_pickle=False)
+    return compress(data=buffer.getvalue(), codec=codec, level=level)
+
+def save_array(path, arr, codec=None, level=None):
+    '''Save arr as .npy file path, compressed with codec (None: plain .npy file, which can be memory-mapped).'''
+    if resolve_codec(codec) is None:
+        np.save(path, arr, allow_pickle=False)
+        return
+    with open(path, 'wb') as f:
+        f.write(save_array_bytes(arr=arr, codec=codec, level=level))
+
+def load_array_file(path, mmap_mode=None):
+    '''Load .npy file path saved by save_array(). Uncompressed files are memory-mapped if mmap_mode.'''
+    with open(path, 'rb') as f:
+        if get_codec(f.peek(4)[:4]) is not None:
+            return load_array(file_obj=f)
+    return np.load(path, mmap_mode=mmap_mode, allow_pickle=False)
+
+def benchmark_compression(folder='models/7525/', n_files=1000, settings=None, seed=0, verbose=1):
+    """Size and speed of saving and loading a random sample of n_files model files of folder (searched
+    recursively) per (codec, level) of settings (list of tuples, codec None for no compression).
+    Files are written to a temporary folder with rnn_io, load times include reconstructing the model
+    (rnn_io.load_model()) and reading the loss curves only (rnn_io.read_fields()), from the OS page cache.
+    Returns data frame with one row per setting."""
+    import pandas as pd
+    import rnn_io
+    if settings is None:
+        settings = [(None, None), ('zlib', 1), ('zlib', 6), ('zstd', 1), ('zstd', 3), ('zstd', 9), ('zstd', 19),
+                    ('lz4', 0), ('lz4', 9)]
+    settings = [(codec, level) for codec, level in settings if codec is None or is_available(codec)]
+    paths = sorted(os.path.join(dir_path, x) for dir_path, _, files in os.walk(folder) for x in files if x[-5:] == '.data')
+    paths = [paths[i] for i in np.random.default_rng(seed).choice(len(paths), size=min(n_files, len(paths)), replace=False)]
+    encoded_models = [rnn_io.snapshot_model(rnn=rnn_io.load_model(path=path)) for path in paths]
+    tmp_folder = tempfile.mkdtemp(prefix='compression_benchmark_')
+    results = []
+    try:
+        for codec, level in settings:
+            t_start = time.perf_counter()
+            new_paths = []
+            for i_model, (header, arrays, pickled) in enumerate(encoded_models):
+                new_paths.append(os.path.join(tmp_folder, f'{codec}_{level}_{i_model}.data'))
+                with open(new_paths[-1], 'wb') as f:
+                    rnn_io.write_encoded(header=header, arrays=arrays, pickled=pickled, file_handle=f, codec=codec, level=level)
+            time_save = time.perf_counter() - t_start
+            t_start = time.perf_counter()
+            for path in new_paths:
+                _ = rnn_io.load_model(path=path)
+            time_load = time.perf_counter() - t_start
+            t_start = time.perf_counter()
+            for path in new_paths:
+                _ = rnn_io.read_fields(path=path, fields=['test_loss_split'])
+            time_fields = time.perf_counter() - t_start
+            results.append({'codec': 'none' if codec is None else codec, 'level': level,
+                            'size_mb': np.sum([os.path.getsize(x) for x in new_paths]) / 1e6,
+                            'save_ms': time_save / len(paths) * 1e3, 'load_ms': time_load / len(paths) * 1e3,
+                            'read_losses_ms': time_fields / len(paths) * 1e3})
+            if verbose > 0:
+                print(results[-1])
+    finally:
+        shutil.rmtree(tmp_folder)
+    df = pd.DataFrame(results)
+    df['ratio'] = df['size_mb'][0] / df['size_mb']
+    df['size_pickle_mb'] = np.sum([os.path.getsize(x) for x in paths]) / 1e6  # original files
+    return df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark compression of model files.')
+    parser.add_argument('--folder', default='models/7525/', help='folder of model files (searched recursively)')
+    parser.add_argument('--n_files', default=1000, type=int, help='number of model files to sample')
+    args = parser.parse_args()
+    print(benchmark_compression(folder=args.folder, n_files=args.n_files, verbose=0).to_string(index=False))
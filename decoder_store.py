@@ -0,0 +1,93 @@
+## Store of fitted decoders outside of the model pickle. Per (model id, label, decoder type, C, data seed)
+## one compressed .npz file holds the score matrix and the fitted parameters of all time points as arrays,
+## so no sklearn (or torch) is needed to read them. The model only keeps a reference (see DecoderStore.save()).
+## Files are compressed with zip deflate (np.savez_compressed), or with zstd/lz4 if a codec is set (see compression.py).
+
+import numpy as np
+import os, zipfile
+import compression
+import rnn_io
+
+decoder_attributes = ['coef_', 'intercept_', 'means_', 'classes_', 'n_iter_']  # saved if all decoders have them
+
+
+class StoredDecoder():
+    def __init__(self, arrays, i_time):
+        '''Decoder of time point i_time, restored from the arrays of DecoderStore.load(). Has the saved
+        attributes (eg coef_, intercept_, means_, classes_) of the original decoder, not its methods.'''
+        self.decoder_type = str(arrays['decoder_type'])
+        for attr in decoder_attributes:
+            if attr in arrays.keys():
+                setattr(self, attr, arrays[attr][i_time])
+
+    def __repr__(self):
+        return f'Stored {self.decoder_type} decoder'
+
+rnn_io.register_decoder_type(decoder_class=StoredDecoder, attributes=decoder_attributes)  # decoders in model files
+
+
+class DecoderStore():
+    def __init__(self, store_folder='decoder_store/', codec=None, level=None):
+        '''Store of decoders in store_folder (one .npz file per model, label, decoder type, C & data seed).
+        New entries are compressed with codec at level (None: zip deflate), see compression.py.'''
+        self.store_folder = store_folder
+        self.codec = compression.resolve_codec(codec)
+        self.level = level
+        if not os.path.exists(self.store_folder):
+            os.makedirs(self.store_folder)
+
+    def __repr__(self):
+        return f'Decoder store in {self.store_folder} ({len(self.list_files())} entries)'
+
+    def list_files(self):
+        return [x for x in os.listdir(self.store_folder) if x[-4:] == '.npz']
+
+    def get_file_name(self, model_id, label, decoder_type, C, data_seed=None):
+        return f'{model_id}_{label}_{decoder_type}_C{C:g}_seed{data_seed}.npz'
+
+    def save(self, model_id, label, decoder_type, C, score_mat, decoder_dict, data_seed=None):
+        '''Save score matrix and decoder parameters (stacked over time points of decoder_dict).
+
+        Returns
+        -------
+        ref : dict
+            reference to the entry (keys and file name), to be saved in the model instead of the decoders.
+        '''
+        file_name = self.get_file_name(model_id=model_id, label=label, decoder_type=decoder_type, C=C, data_seed=data_seed)
+        time_points = sorted(decoder_dict.keys())
+        arrays = {'score_mat': np.asarray(score_mat), 'decoder_type': np.array(decoder_type)}
+        for attr in decoder_attributes:
+            if np.all([hasattr(decoder_dict[tau], attr) for tau in time_points]):
+                arrays[attr] = np.stack([np.asarray(getattr(decoder_dict[tau], attr)) for tau in time_points])
+        tmp_path = os.path.join(self.store_folder, f'.tmp_{os.getpid()}_{file_name}')
+        if self.codec is None or self.codec == 'zlib':
+            np.savez_compressed(tmp_path, **arrays)
+        else:  # npz layout (zip of .npy files) with zstd/lz4 compressed members
+            with zipfile.ZipFile(tmp_path, mode='w', compression=zipfile.ZIP_STORED) as zip_file:
+                for key, arr in arrays.items():
+                    zip_file.writestr(key + '.npy', compression.save_array_bytes(arr=arr, codec=self.codec, level=self.level))
+        os.replace(tmp_path, os.path.join(self.store_folder, file_name))  # atomic
+        return {'store_folder': self.store_folder, 'file_name': file_name, 'model_id': model_id, 'label': label,
+                'decoder_type': decoder_type, 'C': C, 'data_seed': data_seed}
+
+    def exists(self, model_id, label, decoder_type, C, data_seed=None):
+        file_name = self.get_file_name(model_id=model_id, label=label, decoder_type=decoder_type, C=C, data_seed=data_seed)
+        return os.path.exists(os.path.join(self.store_folder, file_name))
+
+    def load(self, file_name):
+        '''Return dict of arrays of entry file_name (score_mat, and coef_ etc. with time as first axis).'''
+        arrays = {}
+        with zipfile.ZipFile(os.path.join(self.store_folder, file_name), mode='r') as zip_file:  # .npz, see save()
+            for member in zip_file.namelist():
+                with zip_file.open(member) as f:
+                    arrays[member[:-4]] = compression.load_array(file_obj=f)
+        return arrays
+
+def load_ref(ref):
+    '''Load arrays of decoder store entry ref (as returned by DecoderStore.save()).'''
+    return DecoderStore(store_folder=ref['store_folder']).load(file_name=ref['file_name'])
+
+def get_decoder_dict(ref):
+    '''Dictionary of StoredDecoder per time point of decoder store entry ref.'''
+    arrays = load_ref(ref=ref)
+    return {tau: StoredDecoder(arrays=arrays, i_time=tau) for tau in range(arrays['score_mat'].shape[0])}
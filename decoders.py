@@ -0,0 +1,725 @@
+## Batched decoders of hidden-state activity: all time points (and optionally many models)
+## are fitted and scored cross-temporally at once, instead of one sklearn decoder per time point.
+
+import numpy as np
+import torch
+import time, warnings
+import sklearn.linear_model
+import multiprocessing
+import rot_utilities as ru
+
+
+## Closed-form discriminant analysis (LDA & QDA):
+
+def fit_discriminant(activity, labels, decoder_type='LDA', reg_param=0.0):
+    """Fit Gaussian discriminant decoders for all time points (and models) at once.
+
+    LDA uses one covariance matrix shared by all classes (pooled within-class, normalised
+    by n_trials - n_classes), QDA one covariance matrix per class (normalised by
+    n_trials_class - 1), as sklearn 0.21 (py37.yml) Linear/QuadraticDiscriminantAnalysis.
+    Covariances are regularised as (1 - reg_param) * cov + reg_param * I. Singular covariance
+    matrices (eg QDA with fewer trials per class than nodes and reg_param=0) give a warning and are
+    inverted by pseudo-inverse, with the log pseudo-determinant (null space eigenvalues left out).
+
+    Parameters
+    ----------
+    activity : np.array of shape (n_trials, n_times, n_nodes) or (n_models, n_trials, n_times, n_nodes)
+        hidden-state activity of train trials.
+    labels : np.array of shape (n_trials,)
+        class label per trial (same for all models).
+    decoder_type : str, 'LDA' or 'QDA'
+        linear or quadratic discriminant analysis.
+    reg_param : float, default: 0
+        covariance regularisation.
+
+    Returns
+    -------
+    params : dict
+        decoder parameters with leading axes (n_models, n_times): 'means' (.. x n_classes x n_nodes),
+        'precision' and 'log_det' of the covariance matrix (per class for QDA), 'log_priors',
+        'classes', 'decoder_type' and, for LDA, the linear 'coef' and 'intercept'.
+    """
+    assert decoder_type in ['LDA', 'QDA'], f'decoder type {decoder_type} not implemented'
+    assert reg_param >= 0 and reg_param <= 1
+    activity = np.asarray(activity, dtype=float)
+    if activity.ndim == 3:
+        activity = activity[None, ...]  # add model axis
+    classes, label_codes = np.unique(labels, return_inverse=True)
+    label_codes = label_codes.ravel()
+    n_models, n_trials, n_times, n_nodes = activity.shape
+    n_classes = len(classes)
+    assert len(label_codes) == n_trials
+    onehot = np.eye(n_classes)[label_codes]  # n_trials x n_classes
+    counts = onehot.sum(0)
+
+    means = np.einsum('mntd,nk->mtkd', activity, onehot) / counts[:, None]  # n_models x n_times x n_classes x n_nodes
+    centered = activity - means.transpose(0, 2, 1, 3)[:, label_codes]  # subtract class mean of each trial
+    if decoder_type == 'LDA':
+        cov = np.einsum('mntd,mnte->mtde', centered, centered) / (n_trials - n_classes)
+    elif decoder_type == 'QDA':
+        cov = np.einsum('mntd,mnte,nk->mtkde', centered, centered, onehot) / (counts[:, None, None] - 1)
+
+    ## Regularised inverse via eigendecomposition (symmetric):
+    eig_val, eig_vec = np.linalg.eigh(cov)
+    eig_val = (1 - reg_param) * eig_val + reg_param
+    bool_pos = eig_val > 1e-10 * np.max(np.abs(eig_val), -1, keepdims=True)  # per covariance matrix
+    if not np.all(bool_pos):
+        warnings.warn(f'{np.sum(~np.all(bool_pos, -1))} covariance matrices are singular, using pseudo-inverse. Increase reg_param to avoid this')
+    inv_eig_val = np.where(bool_pos, 1 / np.where(bool_pos, eig_val, 1), 0)
+    precision = np.einsum('...de,...e,...fe->...df', eig_vec, inv_eig_val, eig_vec)
+    params = {'decoder_type': decoder_type, 'classes': classes, 'means': means, 'precision': precision,
+              'log_det': np.log(np.where(bool_pos, eig_val, 1)).sum(-1), 'log_priors': np.log(counts / n_trials),
+              'reg_param': reg_param}
+    if decoder_type == 'LDA':  # linear discriminant: x W_k + b_k
+        params['coef'] = np.einsum('mtde,mtke->mtkd', precision, means)
+        params['intercept'] = -0.5 * np.einsum('mtkd,mtkd->mtk', params['coef'], means) + params['log_priors']
+    return params
+
+def discriminant_log_proba(params, activity):
+    """Log posterior class probabilities of the decoders of all (train) time points, evaluated
+    on activity of all (test) time points.
+
+    Parameters
+    ----------
+    params : dict
+        output of fit_discriminant().
+    activity : np.array of shape (n_trials, n_times, n_nodes) or (n_models, n_trials, n_times, n_nodes)
+        hidden-state activity of test trials.
+
+    Returns
+    -------
+    log_proba : np.array of shape (n_models, n_times_train, n_times_test, n_trials, n_classes)
+    """
+    activity = np.asarray(activity, dtype=float)
+    if activity.ndim == 3:
+        activity = activity[None, ...]
+    if params['decoder_type'] == 'LDA':
+        log_joint = (np.einsum('mnsd,mtkd->mtsnk', activity, params['coef']) +
+                     params['intercept'][:, :, None, None, :])
+    elif params['decoder_type'] == 'QDA':
+        diff = activity.transpose(0, 2, 1, 3)[:, None, :, :, None, :] - params['means'][:, :, None, None, :, :]  # m t s n k d
+        mahal = np.einsum('mtsnkd,mtkde,mtsnke->mtsnk', diff, params['precision'], diff)
+        log_joint = -0.5 * (mahal + params['log_det'][:, :, None, None, :]) + params['log_priors']
+    log_norm = np.logaddexp.reduce(log_joint, axis=-1, keepdims=True)
+    return log_joint - log_norm
+
+def get_prob_correct(proba, labels, classes):
+    """Probability of the correct class of each trial, from proba (.. x n_trials x n_classes) with
+    columns classes (sorted). Labels that are not in classes (eg a rare class that is missing from
+    the train trials of a fold) get probability 0, with a warning."""
+    labels = np.asarray(labels)
+    inds_labels = np.minimum(np.searchsorted(classes, labels), len(classes) - 1)
+    bool_seen = np.asarray(classes)[inds_labels] == labels
+    if not np.all(bool_seen):
+        warnings.warn(f'test labels {np.unique(labels[~bool_seen])} are not in the train classes {classes}, scored as 0')
+    prob_correct = np.take_along_axis(proba, inds_labels.reshape((1,) * (proba.ndim - 2) + (-1, 1)), axis=-1)[..., 0]
+    return np.where(bool_seen, prob_correct, 0)
+
+def score_crosstemp(proba, labels, classes):
+    """Mean probability of the correct class, for each (model, train time, test time).
+
+    Parameters
+    ----------
+    proba : np.array of shape (n_models, n_times_train, n_times_test, n_trials, n_classes)
+        (posterior) class probabilities.
+    labels : np.array of shape (n_trials,)
+        true test labels.
+    classes : np.array
+        sorted classes corresponding to the last axis of proba.
+
+    Returns
+    -------
+    score_mat : np.array of shape (n_models, n_times_train, n_times_test)
+        labels that are not in classes count as 0 (see get_prob_correct()).
+    """
+    return get_prob_correct(proba=proba, labels=labels, classes=classes).mean(-1)
+
+def train_discriminant_crosstemp(activity_train, labels_train, activity_test, labels_test,
+                                 decoder_type='LDA', reg_param=0.0):
+    """Fit LDA/QDA decoders at all time points and score them cross-temporally.
+
+    Returns
+    -------
+    score_mat : np.array of shape (n_models, n_times, n_times)
+        score of decoder trained at time tau (rows) and tested at time tt (columns).
+    params : dict
+        fitted parameters, see fit_discriminant().
+    """
+    params = fit_discriminant(activity=activity_train, labels=labels_train,
+                              decoder_type=decoder_type, reg_param=reg_param)
+    proba = np.exp(discriminant_log_proba(params=params, activity=activity_test))
+    score_mat = score_crosstemp(proba=proba, labels=labels_test, classes=params['classes'])
+    return score_mat, params
+
+
+class DiscriminantDecoder():
+    def __init__(self, params, i_time, i_model=0):
+        '''Fitted LDA/QDA decoder of one time point (and model), taken from the parameters of
+        fit_discriminant(). Mirrors the attributes of the sklearn decoders that are used by
+        analyses (classes_, means_, priors_, coef_, intercept_ and predict_proba()).'''
+        self.decoder_type = params['decoder_type']
+        self.reg_param = params['reg_param']
+        self.classes_ = params['classes']
+        self.means_ = params['means'][i_model, i_time]
+        self.priors_ = np.exp(params['log_priors'])
+        self.precision_ = params['precision'][i_model, i_time]
+        self.log_det_ = params['log_det'][i_model, i_time]
+        if self.decoder_type == 'LDA':
+            coef = params['coef'][i_model, i_time]
+            intercept = params['intercept'][i_model, i_time]
+            if len(self.classes_) == 2:  # binary as sklearn: log odds of class 1
+                self.coef_ = coef[1:] - coef[:1]
+                self.intercept_ = intercept[1:] - intercept[:1]
+            else:
+                self.coef_ = coef
+                self.intercept_ = intercept
+
+    def __repr__(self):
+        return f'{self.decoder_type} decoder (batched), classes {self.classes_}'
+
+    def predict_proba(self, X):
+        '''Posterior class probabilities of samples X (n_samples x n_nodes).'''
+        params = {'decoder_type': self.decoder_type, 'means': self.means_[None, None],
+                  'precision': self.precision_[None, None], 'log_det': np.atleast_1d(self.log_det_)[None, None],
+                  'log_priors': np.log(self.priors_)}
+        if self.decoder_type == 'LDA':
+            coef = np.einsum('de,ke->kd', self.precision_, self.means_)
+            params['coef'] = coef[None, None]
+            params['intercept'] = (-0.5 * np.einsum('kd,kd->k', coef, self.means_) + np.log(self.priors_))[None, None]
+        log_proba = discriminant_log_proba(params=params, activity=np.asarray(X)[:, None, :])
+        return np.exp(log_proba[0, 0, 0])
+
+    def predict(self, X):
+        '''Most likely class of samples X (n_samples x n_nodes).'''
+        return self.classes_[np.argmax(self.predict_proba(X), 1)]
+
+def get_decoder_dict(params, i_model=0):
+    '''Dictionary of DiscriminantDecoder per time point (as decoder_dict of train_decoder()).'''
+    return {tau: DiscriminantDecoder(params=params, i_time=tau, i_model=i_model) for tau in range(params['means'].shape[1])}
+
+
+## L1-regularised logistic regression (FISTA):
+
+def _lipschitz_logistic(X, C, n_power_iter=50):
+    """Upper bound of Lipschitz constant of the gradient of C * sum(logloss) for each batch
+    element of X (n_batch x n_trials x n_features+1), via power iteration on X^T X."""
+    v = torch.ones(X.shape[0], X.shape[2], 1, dtype=X.dtype)
+    for _ in range(n_power_iter):
+        v = torch.matmul(X.transpose(1, 2), torch.matmul(X, v))
+        v = v / v.norm(dim=1, keepdim=True)
+    eig_max = torch.matmul(X, v).norm(dim=1)[:, 0] ** 2
+    return 1.01 * C * eig_max / 4  # small margin because power iteration underestimates
+
+def l1_logistic_objective(coef, intercept, X, y, C):
+    """Objective ||w||_1 + C * sum_i log(1 + exp(-s_i (x_i w + b))), s_i = +-1, per batch element
+    (the objective of sklearn LogisticRegression(penalty='l1')).
+
+    coef : (n_batch x n_features), intercept : (n_batch), X : (n_batch x n_trials x n_features), y : (n_trials) in {0, 1}."""
+    logits = torch.einsum('bnd,bd->bn', X, coef) + intercept[:, None]
+    sign = 2 * y - 1
+    return coef.abs().sum(1) + C * torch.nn.functional.softplus(-1 * sign * logits).sum(1)
+
+def fit_l1_logistic(activity, labels, C=0.1, max_iter=1000, tol=1e-6,
+                    coef_init=None, intercept_init=None, verbose=0):
+    """Fit binary L1-regularised logistic regression decoders for all time points (and models)
+    at once, by FISTA (accelerated proximal gradient with adaptive restart) in torch on CPU.
+    Minimises ||w||_1 + C * sum(logloss) as sklearn LogisticRegression(C=C, penalty='l1')
+    (intercept not penalised).
+
+    Parameters
+    ----------
+    activity : np.array of shape (n_trials, n_times, n_nodes) or (n_models, n_trials, n_times, n_nodes)
+        hidden-state activity of train trials.
+    labels : np.array of shape (n_trials,)
+        binary class label per trial (same for all models).
+    C : float
+        inverse regularisation strength.
+    max_iter : int
+        maximum number of iterations.
+    tol : float
+        convergence tolerance on the relative change of the parameters (per decoder).
+    coef_init, intercept_init : np.array of shape (n_models, n_times, n_nodes) and (n_models, n_times), optional
+        initial solution (zeros if None).
+
+    Returns
+    -------
+    params : dict
+        'coef' (n_models x n_times x n_nodes), 'intercept' (n_models x n_times), 'classes',
+        'n_iter' (n_models x n_times, iterations until convergence), 'converged' and 'fit_time'.
+    """
+    t_start = time.time()
+    activity = np.asarray(activity, dtype=float)
+    if activity.ndim == 3:
+        activity = activity[None, ...]  # add model axis
+    n_models, n_trials, n_times, n_nodes = activity.shape
+    classes, label_codes = np.unique(labels, return_inverse=True)
+    assert len(classes) == 2, 'only binary classification implemented'
+
+    ## One batch element per (model, time point):
+    X = torch.from_numpy(activity.transpose(0, 2, 1, 3).reshape(n_models * n_times, n_trials, n_nodes).copy())
+    y = torch.from_numpy(label_codes.ravel().astype(float))
+    X_aug = torch.cat([X, torch.ones(X.shape[0], n_trials, 1, dtype=X.dtype)], 2)  # intercept as last feature
+    step = 1 / _lipschitz_logistic(X_aug, C=C)[:, None]
+    theta = torch.zeros(X.shape[0], n_nodes + 1, dtype=X.dtype)
+    if coef_init is not None:
+        theta[:, :n_nodes] = torch.from_numpy(np.asarray(coef_init, dtype=float).reshape(-1, n_nodes))
+    if intercept_init is not None:
+        theta[:, n_nodes] = torch.from_numpy(np.asarray(intercept_init, dtype=float).ravel())
+    theta_prev = theta.clone()
+    logits = torch.bmm(X_aug, theta[:, :, None])[:, :, 0]  # logits of theta, updated along with theta
+    logits_prev = logits.clone()
+    momentum = torch.ones(X.shape[0], 1, dtype=X.dtype)
+    active = torch.ones(X.shape[0], dtype=torch.bool)  # not yet converged
+    n_iter = np.zeros(X.shape[0], dtype=int)
+    sign = 2 * y - 1
+    step_growth = 1.25  # trial step size increase per iteration
+
+    inds = torch.arange(X.shape[0])  # working set of decoders, compacted when many have converged
+    X_it = X_aug
+    for it in range(max_iter):
+        if active[inds].sum() < 0.5 * len(inds):
+            inds = torch.nonzero(active)[:, 0]
+            X_it = X_aug[inds]
+        momentum_new = (1 + torch.sqrt(1 + 4 * momentum[inds] ** 2)) / 2
+        beta = (momentum[inds] - 1) / momentum_new
+        z = theta[inds] + beta * (theta[inds] - theta_prev[inds])  # extrapolation
+        logits_z = logits[inds] + beta * (logits[inds] - logits_prev[inds])  # (linear in parameters)
+        loss_z = C * torch.nn.functional.softplus(-1 * sign * logits_z).sum(1)
+        grad = C * torch.bmm(X_it.transpose(1, 2), (torch.sigmoid(logits_z) - y)[:, :, None])[:, :, 0]
+
+        ## Proximal gradient step with backtracking line search (local curvature is often much smaller than 1/step):
+        step_it = step[inds] * step_growth
+        for _ in range(50):
+            thresh = torch.cat([step_it.expand(-1, n_nodes), torch.zeros_like(step_it)], 1)  # no penalty on intercept
+            z_step = z - step_it * grad
+            theta_new = torch.sign(z_step) * torch.clamp(z_step.abs() - thresh, min=0)  # soft threshold (prox of L1)
+            diff = theta_new - z
+            logits_new = torch.bmm(X_it, theta_new[:, :, None])[:, :, 0]
+            loss_new = C * torch.nn.functional.softplus(-1 * sign * logits_new).sum(1)
+            upper_bound = loss_z + (grad * diff).sum(1) + (diff ** 2).sum(1) / (2 * step_it[:, 0])
+            too_large = loss_new > upper_bound + 1e-12 * loss_z.abs()
+            if too_large.sum() == 0:
+                break
+            step_it[too_large] = step_it[too_large] / 2
+
+        ## Adaptive restart of momentum if the step goes against the extrapolation:
+        restart = ((z - theta_new) * (theta_new - theta[inds])).sum(1) > 0
+        momentum_new[restart] = 1
+        change = (theta_new - theta[inds]).abs().max(1)[0] / torch.clamp(theta_new.abs().max(1)[0], min=1)
+
+        ## Update decoders that had not converged yet:
+        upd = active[inds]
+        inds_upd = inds[upd]
+        theta_prev[inds_upd], logits_prev[inds_upd] = theta[inds_upd], logits[inds_upd]
+        theta[inds_upd], logits[inds_upd] = theta_new[upd], logits_new[upd]
+        momentum[inds_upd], step[inds_upd] = momentum_new[upd], step_it[upd]
+        n_iter[inds_upd.numpy()] += 1
+        active[inds_upd[change[upd] < tol]] = False
+        if active.sum() == 0:
+            break
+    if verbose > 0:
+        print(f'FISTA: {int((~active).sum())}/{len(active)} converged, max {n_iter.max()} iterations')
+
+    params = {'coef': theta[:, :n_nodes].numpy().reshape(n_models, n_times, n_nodes),
+              'intercept': theta[:, n_nodes].numpy().reshape(n_models, n_times),
+              'classes': classes, 'n_iter': n_iter.reshape(n_models, n_times),
+              'converged': (~active).numpy().reshape(n_models, n_times), 'C': C,
+              'fit_time': time.time() - t_start}
+    return params
+
+def fit_l1_logistic_warm(activity, labels, C=0.1, max_iter=1000, tol=1e-6, verbose=0):
+    """Fit L1 logistic decoders as fit_l1_logistic(), but time point by time point, initialising the
+    decoder of time point tau at the solution of tau - 1 (warm start along the time axis, where the
+    hidden-state geometry changes little). Per model, the previous solution is only used if its
+    objective at time point tau is lower than that of the zero solution. Models are still fitted
+    in one batch per time point.
+
+    Returns params as fit_l1_logistic(), with additionally 'fit_time_per_time' (n_times).
+    """
+    t_start = time.time()
+    activity = np.asarray(activity, dtype=float)
+    if activity.ndim == 3:
+        activity = activity[None, ...]  # add model axis
+    n_models, n_trials, n_times, n_nodes = activity.shape
+    _, label_codes = np.unique(labels, return_inverse=True)
+    y = torch.from_numpy(label_codes.ravel().astype(float))
+    list_params = []
+    for tau in range(n_times):
+        coef_init, intercept_init = np.zeros((n_models, 1, n_nodes)), np.zeros((n_models, 1))
+        if tau > 0:  # start from previous solution, unless it is worse than the zero solution (e.g. stimulus on/offset)
+            X = torch.from_numpy(activity[:, :, tau, :])
+            obj_prev = l1_logistic_objective(coef=torch.from_numpy(list_params[-1]['coef'][:, 0, :]),
+                                             intercept=torch.from_numpy(list_params[-1]['intercept'][:, 0]), X=X, y=y, C=C)
+            obj_zero = l1_logistic_objective(coef=torch.from_numpy(coef_init[:, 0, :]),
+                                             intercept=torch.from_numpy(intercept_init[:, 0]), X=X, y=y, C=C)
+            use_prev = (obj_prev < obj_zero).numpy()
+            coef_init[use_prev] = list_params[-1]['coef'][use_prev]
+            intercept_init[use_prev] = list_params[-1]['intercept'][use_prev]
+        list_params.append(fit_l1_logistic(activity=activity[:, :, tau:(tau + 1), :], labels=labels, C=C,
+                                           max_iter=max_iter, tol=tol, coef_init=coef_init, intercept_init=intercept_init))
+    params = {key: np.concatenate([p[key] for p in list_params], 1) for key in ['coef', 'intercept', 'n_iter', 'converged']}
+    params['classes'] = list_params[0]['classes']
+    params['C'] = C
+    params['fit_time_per_time'] = np.array([p['fit_time'] for p in list_params])
+    params['fit_time'] = time.time() - t_start
+    if verbose > 0:
+        print(f'FISTA warm start: {int(params["converged"].sum())}/{params["converged"].size} converged, max {params["n_iter"].max()} iterations')
+    return params
+
+def logistic_proba(params, activity):
+    """Class probabilities of the logistic decoders of all (train) time points, evaluated on
+    activity of all (test) time points. Returns np.array of shape
+    (n_models, n_times_train, n_times_test, n_trials, 2)."""
+    activity = np.asarray(activity, dtype=float)
+    if activity.ndim == 3:
+        activity = activity[None, ...]
+    logits = np.einsum('mnsd,mtd->mtsn', activity, params['coef']) + params['intercept'][:, :, None, None]
+    proba_1 = 1 / (1 + np.exp(-1 * logits))
+    return np.stack([1 - proba_1, proba_1], -1)
+
+def train_l1_logistic_crosstemp(activity_train, labels_train, activity_test, labels_test,
+                                C=0.1, max_iter=1000, tol=1e-6, warm_start=False):
+    """Fit L1 logistic decoders at all time points (fit_l1_logistic(), or fit_l1_logistic_warm()
+    if warm_start) and score them cross-temporally.
+
+    Returns
+    -------
+    score_mat : np.array of shape (n_models, n_times, n_times)
+        score of decoder trained at time tau (rows) and tested at time tt (columns).
+    params : dict
+        fitted parameters, see fit_l1_logistic().
+    """
+    fit_function = fit_l1_logistic_warm if warm_start else fit_l1_logistic
+    params = fit_function(activity=activity_train, labels=labels_train, C=C, max_iter=max_iter, tol=tol)
+    proba = logistic_proba(params=params, activity=activity_test)
+    score_mat = score_crosstemp(proba=proba, labels=labels_test, classes=params['classes'])
+    return score_mat, params
+
+
+class LogisticDecoder():
+    def __init__(self, params, i_time, i_model=0):
+        '''Fitted L1 logistic decoder of one time point (and model), taken from the parameters of
+        fit_l1_logistic(). Mirrors the attributes of sklearn LogisticRegression that are used by
+        analyses (classes_, coef_ of shape (1, n_nodes), intercept_, n_iter_ and predict_proba()).'''
+        self.C = params['C']
+        self.classes_ = params['classes']
+        self.coef_ = params['coef'][i_model, i_time][None, :]
+        self.intercept_ = np.atleast_1d(params['intercept'][i_model, i_time])
+        self.n_iter_ = np.atleast_1d(params['n_iter'][i_model, i_time])
+        if 'fit_time_per_time' in params:  # fitted per time point (warm start), batched over models
+            self.fit_time_ = params['fit_time_per_time'][i_time] / params['coef'].shape[0]
+        else:  # share of one batch of all models and time points
+            self.fit_time_ = params['fit_time'] / params['coef'][..., 0].size
+
+    def __repr__(self):
+        return f'L1 logistic regression decoder (FISTA), C={self.C}'
+
+    def decision_function(self, X):
+        return np.dot(X, self.coef_[0]) + self.intercept_[0]
+
+    def predict_proba(self, X):
+        '''Class probabilities of samples X (n_samples x n_nodes).'''
+        proba_1 = 1 / (1 + np.exp(-1 * self.decision_function(X)))
+        return np.stack([1 - proba_1, proba_1], 1)
+
+    def predict(self, X):
+        '''Most likely class of samples X (n_samples x n_nodes).'''
+        return self.classes_[(self.decision_function(X) > 0).astype(int)]
+
+def get_logistic_decoder_dict(params, i_model=0):
+    '''Dictionary of LogisticDecoder per time point (as decoder_dict of train_decoder()).'''
+    return {tau: LogisticDecoder(params=params, i_time=tau, i_model=i_model) for tau in range(params['coef'].shape[1])}
+
+
+
+## sklearn logistic regression per time point, and fit statistics:
+
+def fit_saga_logistic(activity, labels, C=0.1, max_iter=250, warm_start=False):
+    """Fit one sklearn LogisticRegression(solver='saga', penalty='l1') decoder per time point of
+    activity (n_trials x n_times x n_nodes). If warm_start, the decoder of time point tau is
+    initialised at the solution of tau - 1 (if better than the zero solution, as in
+    fit_l1_logistic_warm()). The fit time (s) is stored as attribute fit_time_.
+
+    Returns
+    -------
+    decoder_dict : dict
+        fitted decoder per time point.
+    """
+    decoder_dict = {}
+    _, label_codes = np.unique(labels, return_inverse=True)
+    y = torch.from_numpy(label_codes.ravel().astype(float))
+    for tau in range(activity.shape[1]):  # train time loop
+        decoder_dict[tau] = sklearn.linear_model.LogisticRegression(C=C, solver='saga', penalty='l1',
+                                                                    max_iter=max_iter, warm_start=warm_start)
+        if warm_start and tau > 0 and len(decoder_dict[tau - 1].classes_) > 2:  # multinomial: always previous solution
+            decoder_dict[tau].coef_ = decoder_dict[tau - 1].coef_.copy()
+            decoder_dict[tau].intercept_ = decoder_dict[tau - 1].intercept_.copy()
+        elif warm_start and tau > 0:  # with warm_start, sklearn starts from existing coef_ and intercept_
+            obj_prev = l1_logistic_objective(coef=torch.from_numpy(decoder_dict[tau - 1].coef_.astype(float)),
+                                             intercept=torch.from_numpy(decoder_dict[tau - 1].intercept_.astype(float)),
+                                             X=torch.from_numpy(np.asarray(activity[None, :, tau, :], dtype=float)), y=y, C=C)
+            if float(obj_prev[0]) < C * len(y) * np.log(2):  # better than the zero solution, as in fit_l1_logistic_warm()
+                decoder_dict[tau].coef_ = decoder_dict[tau - 1].coef_.copy()
+                decoder_dict[tau].intercept_ = decoder_dict[tau - 1].intercept_.copy()
+        t_start = time.time()
+        decoder_dict[tau].fit(X=activity[:, tau, :], y=labels)
+        decoder_dict[tau].fit_time_ = time.time() - t_start
+    return decoder_dict
+
+def get_fit_stats(decoder_dict):
+    """Number of iterations and fit time (s) per time point of a decoder_dict (of sklearn
+    LogisticRegression or LogisticDecoder; fit time is nan if not recorded)."""
+    time_points = sorted(decoder_dict.keys())
+    return {'n_iter': np.array([np.max(decoder_dict[tau].n_iter_) for tau in time_points]),
+            'fit_time': np.array([getattr(decoder_dict[tau], 'fit_time_', np.nan) for tau in time_points])}
+
+def compare_warm_start(activity, labels, C=0.1, decoder_type='logistic_regression', verbose=1):
+    """Fit the decoders of all time points of activity (n_trials x n_times x n_nodes) both from
+    scratch and warm-started along the time axis, and compare iterations and fit time.
+
+    Parameters
+    ----------
+    decoder_type : str
+        'logistic_regression' (sklearn saga, see fit_saga_logistic()) or
+        'logistic_regression_fista' (fit_l1_logistic() versus fit_l1_logistic_warm()).
+
+    Returns
+    -------
+    stats : dict
+        'cold' and 'warm': fit statistics per time point (see get_fit_stats()).
+    """
+    stats = {}
+    for warm_start in [False, True]:
+        if decoder_type == 'logistic_regression':
+            decoder_dict = fit_saga_logistic(activity=activity, labels=labels, C=C, warm_start=warm_start)
+        elif decoder_type == 'logistic_regression_fista':
+            fit_function = fit_l1_logistic_warm if warm_start else fit_l1_logistic
+            decoder_dict = get_logistic_decoder_dict(params=fit_function(activity=activity, labels=labels, C=C))
+        else:
+            assert False, f'decoder type {decoder_type} not implemented. Please choose logistic_regression or logistic_regression_fista'
+        stats['warm' if warm_start else 'cold'] = get_fit_stats(decoder_dict=decoder_dict)
+    if verbose > 0:
+        for key, fit_stats in stats.items():
+            print(f'{key} start: {np.sum(fit_stats["n_iter"])} iterations in total (max {np.max(fit_stats["n_iter"])}), ' +
+                  f'{np.sum(fit_stats["fit_time"]):.2f}s over {len(fit_stats["n_iter"])} time points')
+    return stats
+
+def validate_l1_logistic_vs_sklearn(activity, labels, C=0.1, max_iter=1000, tol=1e-6,
+                                    sklearn_max_iter=10000, sklearn_tol=1e-8):
+    """Compare fit_l1_logistic() to the sklearn reference (saga, run to tight tolerance) on
+    each time point of activity (n_trials x n_times x n_nodes).
+
+    Returns
+    -------
+    comparison : dict
+        per time point: objective of both solvers (objective_fista, objective_sklearn),
+        max abs difference of coefficients (max_coef_diff) and of class-1 probabilities
+        (max_proba_diff), fraction of equal predictions (prediction_agreement); and fit times.
+    """
+    activity = np.asarray(activity, dtype=float)
+    n_trials, n_times, n_nodes = activity.shape
+    params = fit_l1_logistic(activity=activity, labels=labels, C=C, max_iter=max_iter, tol=tol)
+    _, label_codes = np.unique(labels, return_inverse=True)
+    y = torch.from_numpy(label_codes.ravel().astype(float))
+    comparison = {key: np.zeros(n_times) for key in ['objective_fista', 'objective_sklearn', 'max_coef_diff',
+                                                    'max_proba_diff', 'prediction_agreement']}
+    t_start = time.time()
+    for tau in range(n_times):
+        ref = sklearn.linear_model.LogisticRegression(C=C, solver='saga', penalty='l1', max_iter=sklearn_max_iter,
+                                                      tol=sklearn_tol).fit(activity[:, tau, :], labels)
+        dec = LogisticDecoder(params=params, i_time=tau)
+        X = torch.from_numpy(activity[None, :, tau, :])
+        for name, coef, intercept in [('fista', dec.coef_, dec.intercept_), ('sklearn', ref.coef_, ref.intercept_)]:
+            comparison[f'objective_{name}'][tau] = float(l1_logistic_objective(coef=torch.from_numpy(coef.astype(float)),
+                                                                              intercept=torch.from_numpy(intercept.astype(float)),
+                                                                              X=X, y=y, C=C)[0])
+        comparison['max_coef_diff'][tau] = np.max(np.abs(dec.coef_ - ref.coef_))
+        comparison['max_proba_diff'][tau] = np.max(np.abs(dec.predict_proba(activity[:, tau, :])[:, 1] -
+                                                          ref.predict_proba(activity[:, tau, :])[:, 1]))
+        comparison['prediction_agreement'][tau] = np.mean(dec.predict(activity[:, tau, :]) == ref.predict(activity[:, tau, :]))
+    comparison['fit_time_fista'] = params['fit_time']
+    comparison['fit_time_sklearn'] = time.time() - t_start
+    return comparison
+
+
+## Cross-temporal decoding with any decoder type:
+
+def train_crosstemp(activity_train, labels_train, activity_test, labels_test,
+                    decoder_type='logistic_regression', C=0.1, warm_start=False,
+                    window=1, window_mode='mean', reg_param=0.0):
+    """Fit decoders of decoder_type at all time points of activity_train (n_trials x n_times x n_nodes)
+    and score each on all time points of activity_test, for one representation (labels).
+    If window > 1, decoders are trained and tested on time windows instead (see window_features()).
+
+    Parameters
+    ----------
+    decoder_type : str
+        'logistic_regression' (sklearn saga), 'logistic_regression_fista', 'LDA' or 'QDA'.
+    C : float
+        inverse regularisation strength of logistic regression decoders.
+    warm_start : bool
+        warm start logistic regression decoders along the time axis (see compare_warm_start()).
+    window : int
+        number of time points per window (1 for single time points).
+    window_mode : str
+        features of window: 'mean' (sliding average) or 'concat' (concatenated time bins).
+    reg_param : float
+        covariance regularisation of LDA/QDA decoders (see fit_discriminant()).
+
+    Returns
+    -------
+    score_mat : np.array of shape (n_times, n_times), or (n_windows, n_windows) if window > 1
+        mean probability of correct class, of decoder trained at time tau (rows) and tested at time tt (columns).
+    decoder_dict : dict
+        fitted decoder per time point (or window).
+    """
+    if window > 1:
+        activity_train = window_features(activity=activity_train, window=window, mode=window_mode)
+        activity_test = window_features(activity=activity_test, window=window, mode=window_mode)
+    n_test, n_times, n_nodes = activity_test.shape
+    if decoder_type == 'LDA' or decoder_type == 'QDA':  # closed form, all time points at once
+        score_mat, params = train_discriminant_crosstemp(activity_train=activity_train, labels_train=labels_train,
+                                                         activity_test=activity_test, labels_test=labels_test,
+                                                         decoder_type=decoder_type, reg_param=reg_param)
+        score_mat = score_mat[0]  # single model
+        decoder_dict = get_decoder_dict(params=params)
+    elif decoder_type == 'logistic_regression_fista':  # same L1 objective, all time points batched in torch
+        score_mat, params = train_l1_logistic_crosstemp(activity_train=activity_train, labels_train=labels_train,
+                                                        activity_test=activity_test, labels_test=labels_test,
+                                                        C=C, warm_start=warm_start)
+        score_mat = score_mat[0]  # single model
+        decoder_dict = get_logistic_decoder_dict(params=params)
+    elif decoder_type == 'logistic_regression':
+        decoder_dict = fit_saga_logistic(activity=activity_train, labels=labels_train,
+                                         C=C, warm_start=warm_start)  # one log reg per time
+        score_mat = np.zeros((len(decoder_dict), n_times))  # T x T
+        activity_test_stacked = activity_test.transpose(1, 0, 2).reshape(n_times * n_test, n_nodes)  # time-major stack of all test times
+        for tau in range(len(decoder_dict)):
+            ## Evaluate on all test times at once:
+            prediction = decoder_dict[tau].predict_proba(X=activity_test_stacked)  # (T * n_test) x n_classes
+            prediction = prediction.reshape(n_times, n_test, prediction.shape[1])
+            prob_correct = get_prob_correct(proba=prediction, labels=labels_test, classes=decoder_dict[tau].classes_)  # T x n_test
+            score_mat[tau, :] = np.mean(prob_correct, 1)
+            # score_mat[tau, :] = np.exp(np.mean(np.log(prob_correct), 1))
+    else:
+        assert False, f'decoder type {decoder_type} not implemented. Please choose logistic_regression, logistic_regression_fista, LDA or QDA'
+    return score_mat, decoder_dict
+
+
+## Time windows: windowed features, and windowed aggregates of score matrices by summed-area tables:
+
+def window_features(activity, window=2, mode='mean'):
+    """Features of all time windows [tau, tau + window) of activity (n_trials x n_times x n_nodes).
+
+    Parameters
+    ----------
+    mode : str
+        'mean': sliding average over the window, computed from the cumulative sum over time
+        (n_trials x n_windows x n_nodes); 'concat': activity of all time bins of the window
+        concatenated (n_trials x n_windows x (window * n_nodes)).
+
+    Returns
+    -------
+    features : np.array with n_windows = n_times - window + 1 windows on axis 1
+    """
+    activity = np.asarray(activity, dtype=float)
+    n_trials, n_times, n_nodes = activity.shape
+    assert window >= 1 and window <= n_times, f'window of {window} time points does not fit in {n_times} time points'
+    n_windows = n_times - window + 1
+    if mode == 'mean':
+        cumsum = np.concatenate([np.zeros((n_trials, 1, n_nodes)), np.cumsum(activity, 1)], 1)
+        return (cumsum[:, window:, :] - cumsum[:, :n_windows, :]) / window
+    elif mode == 'concat':
+        return np.concatenate([activity[:, i_bin:(i_bin + n_windows), :] for i_bin in range(window)], 2)
+    else:
+        assert False, f'window mode {mode} not implemented. Please choose mean or concat'
+
+def summed_area_table(score_mats):
+    """Summed-area table (2D cumulative sum) of score matrices (... x n_train_times x n_test_times),
+    padded with zeros so that sat[..., i, j] is the sum of score_mats[..., :i, :j]. NaNs propagate."""
+    score_mats = np.asarray(score_mats, dtype=float)
+    sat = np.zeros(score_mats.shape[:-2] + (score_mats.shape[-2] + 1, score_mats.shape[-1] + 1))
+    sat[..., 1:, 1:] = np.cumsum(np.cumsum(score_mats, -2), -1)
+    return sat
+
+def patch_mean(sat, train_start, train_stop, test_start, test_stop):
+    """Mean of score matrices over patches [train_start:train_stop, test_start:test_stop], from their
+    summed_area_table() sat. Bounds can be arrays (broadcast), to get many patches at once."""
+    train_start, train_stop = np.asarray(train_start), np.asarray(train_stop)
+    test_start, test_stop = np.asarray(test_start), np.asarray(test_stop)
+    patch_sum = (sat[..., train_stop, test_stop] - sat[..., train_start, test_stop] -
+                 sat[..., train_stop, test_start] + sat[..., train_start, test_start])
+    return patch_sum / ((train_stop - train_start) * (test_stop - test_start))
+
+def sliding_window_mean(score_mats, window=2):
+    """Mean of score matrices (... x n_times x n_times) over all window x window patches; returns
+    (... x n_windows x n_windows), element [i, j] is the mean of [i:i + window, j:j + window]."""
+    sat = summed_area_table(score_mats=score_mats)
+    starts_train = np.arange(sat.shape[-2] - window)[:, None]
+    starts_test = np.arange(sat.shape[-1] - window)[None, :]
+    return patch_mean(sat=sat, train_start=starts_train, train_stop=starts_train + window,
+                      test_start=starts_test, test_stop=starts_test + window)
+
+
+## Cross-validated cross-temporal decoding:
+
+def stratified_kfold(labels, n_folds=5, rng=None):
+    """Random stratified split of trials in n_folds folds (as sklearn StratifiedKFold(shuffle=True)).
+    Returns list of test trial indices per fold."""
+    rng = ru.get_rng(rng=rng)
+    fold_of_trial = np.zeros(len(labels), dtype=int)
+    offset = 0  # continue counting over classes, so that fold sizes differ at most by one
+    for lab in np.unique(labels):
+        inds_lab = rng.permutation(np.where(labels == lab)[0])
+        fold_of_trial[inds_lab] = (np.arange(len(inds_lab)) + offset) % n_folds
+        offset += len(inds_lab)
+    return [np.where(fold_of_trial == i_fold)[0] for i_fold in range(n_folds)]
+
+def score_fold(activity, labels, inds_test, decoder_type='logistic_regression', C=0.1, reg_param=0.0):
+    """Score matrix (see train_crosstemp()) of decoders trained on all trials except inds_test, tested on inds_test."""
+    bool_test = np.zeros(len(labels), dtype=bool)
+    bool_test[inds_test] = True
+    score_mat, _ = train_crosstemp(activity_train=activity[~bool_test], labels_train=labels[~bool_test],
+                                   activity_test=activity[bool_test], labels_test=labels[bool_test],
+                                   decoder_type=decoder_type, C=C, reg_param=reg_param)
+    return score_mat
+
+_fold_activity = None  # activity of train_crosstemp_cv() in worker processes, see init_fold_worker()
+
+def init_fold_worker(activity=None):
+    """One torch thread per worker process, and fresh random state (saga shuffles with np.random).
+    activity is sent once per worker (instead of with every fold) and kept for score_fold_worker()."""
+    global _fold_activity
+    torch.set_num_threads(1)
+    np.random.seed()
+    _fold_activity = activity
+
+def score_fold_worker(labels, inds_test, decoder_type='logistic_regression', C=0.1, reg_param=0.0):
+    """score_fold() of the activity of this worker process (see init_fold_worker())."""
+    return score_fold(activity=_fold_activity, labels=labels, inds_test=inds_test,
+                      decoder_type=decoder_type, C=C, reg_param=reg_param)
+
+def train_crosstemp_cv(activity, labels, decoder_type='logistic_regression', C=0.1,
+                       n_folds=5, n_repeats=1, n_processes=1, rng=None, reg_param=0.0):
+    """Cross-validated cross-temporal decoding: trials of activity (n_trials x n_times x n_nodes) are
+    split in n_folds stratified folds (n_repeats times, with different splits), and for each fold decoders
+    are trained on the other folds and tested on this fold (see train_crosstemp()).
+    Folds are run in parallel if n_processes > 1 (activity is sent to each worker process once).
+
+    Returns
+    -------
+    cv_dict : dict
+        'mean' and 'std' of score matrices (n_times x n_times) over folds, and 'folds', the score
+        matrices of all folds (n_repeats * n_folds x n_times x n_times).
+    """
+    labels = np.asarray(labels)
+    rng = ru.get_rng(rng=rng)
+    list_inds_test = [inds_test for _ in range(n_repeats) for inds_test in stratified_kfold(labels=labels, n_folds=n_folds, rng=rng)]
+    list_args = [(labels, inds_test, decoder_type, C, reg_param) for inds_test in list_inds_test]
+    if n_processes == 1:
+        list_scores = [score_fold(activity, *args) for args in list_args]
+    else:
+        with multiprocessing.Pool(n_processes, initializer=init_fold_worker, initargs=(activity,)) as pool:
+            list_scores = pool.starmap(score_fold_worker, list_args)
+    score_folds = np.stack(list_scores)
+    return {'mean': score_folds.mean(0), 'std': score_folds.std(0), 'folds': score_folds}
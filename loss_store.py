@@ -0,0 +1,163 @@
+## Consolidated store of the test loss curves (test_loss_split) of all models in a ModelCatalog, as one
+## float32 array of shape (n_models, n_loss_keys, n_epochs) that is loaded memory-mapped, with a table of
+## the catalog rows of the models in the same order. Learning indices (see ru.compute_learning_index())
+## of any selection of models (eg the full sparsity x n_nodes x task grid) are then array reductions.
+## Curves of models with fewer epochs (or without a loss key) are padded with nan.
+
+import numpy as np
+import pandas as pd
+import os, json, shutil
+from tqdm import tqdm
+import rnn_io
+import model_catalog
+
+learning_index_methods = ['integral', 'mean_integral', 'final_loss', 'half_time', 'argmin_gradient']
+
+def compute_learning_index_mat(mat, method='integral'):
+    """Learning index of each row (rnn) of loss matrix mat (n_rnns x n_epochs), see ru.compute_learning_index()."""
+    assert method in learning_index_methods, f'Method {method} not implemented!'
+    assert not np.any(np.isnan(mat)), 'loss curves have different numbers of epochs, this is not implemented explicitly when computing the integral'
+    if method == 'integral':
+        return np.mean(mat, 1)  # sum = integral, mean = divide by n epochs
+    elif method == 'mean_integral':
+        return np.zeros(mat.shape[0]) + np.mean(np.mean(mat, 1))
+    elif method == 'final_loss':
+        return np.mean(mat[:, -5:], 1)
+    elif method == 'half_time':
+        return np.argmin(np.diff(mat, axis=1), 1).astype(float)
+    elif method == 'argmin_gradient':
+        return np.argmin(np.gradient(mat, axis=1), 1).astype(float)
+
+def build_loss_store(catalog=None, store_folder='models/loss_store/', verbose=1):
+    """Write the loss store of all models in catalog (ModelCatalog, default catalog if None) to store_folder.
+    Curves of models that did not change since the previous build are copied from the previous store.
+    Returns the LossStore."""
+    if catalog is None:
+        catalog = model_catalog.get_default_catalog()
+    assert catalog is not None, 'no catalog given or set (see model_catalog.set_default_catalog())'
+    df = catalog.get_df().drop(columns=['info_json'])
+    previous_rows = {}
+    if os.path.exists(os.path.join(store_folder, 'meta.json')):
+        previous_store = LossStore(store_folder=store_folder)
+        previous_rows = {(path, mtime, size): i_row for i_row, (path, mtime, size) in enumerate(zip(
+                         previous_store.df['path'], previous_store.df['file_mtime'], previous_store.df['file_size']))}
+    else:
+        previous_store = None
+
+    ## Read loss curves (only of new/changed models):
+    curves = [None] * len(df)
+    for i_row in (tqdm(range(len(df))) if verbose > 0 else range(len(df))):
+        key = (df['path'][i_row], df['file_mtime'][i_row], df['file_size'][i_row])
+        if key not in previous_rows.keys():
+            curves[i_row] = rnn_io.read_fields(path=df['path'][i_row], fields=['test_loss_split'])['test_loss_split']
+    loss_keys = [] if previous_store is None else [x for x in previous_store.loss_keys]
+    n_epochs = 0 if previous_store is None else previous_store.losses.shape[2]
+    for curve_dict in curves:
+        if curve_dict is not None:
+            loss_keys += [x for x in curve_dict.keys() if x not in loss_keys]
+            n_epochs = max([n_epochs] + [len(x) for x in curve_dict.values()])
+
+    ## Write to temporary folder, then replace previous store:
+    tmp_folder = os.path.normpath(store_folder) + f'.tmp_{os.getpid()}'
+    os.makedirs(tmp_folder, exist_ok=True)
+    losses = np.lib.format.open_memmap(os.path.join(tmp_folder, 'losses.npy'), mode='w+', dtype=np.float32,
+                                       shape=(len(df), len(loss_keys), n_epochs))
+    losses[:] = np.nan
+    for i_row in range(len(df)):
+        if curves[i_row] is None:  # copy from previous store
+            old_losses = previous_store.losses[previous_rows[(df['path'][i_row], df['file_mtime'][i_row], df['file_size'][i_row])]]
+            losses[i_row, :len(previous_store.loss_keys), :old_losses.shape[1]] = old_losses
+            del old_losses  # view of memory map of previous store
+        else:
+            for key, curve in curves[i_row].items():
+                losses[i_row, loss_keys.index(key), :len(curve)] = curve
+    losses.flush()
+    del losses
+    df.to_csv(os.path.join(tmp_folder, 'catalog.csv'), index=False)
+    with open(os.path.join(tmp_folder, 'meta.json'), 'w') as f:
+        json.dump({'loss_keys': loss_keys, 'n_models': len(df), 'n_epochs': n_epochs}, f)
+    if previous_store is not None:
+        del previous_store  # close memory map
+        old_folder = os.path.normpath(store_folder) + f'.old_{os.getpid()}'
+        os.rename(store_folder, old_folder)  # move aside, so that store_folder is only missing briefly
+        os.rename(tmp_folder, store_folder)
+        shutil.rmtree(old_folder)
+    else:
+        os.rename(tmp_folder, store_folder)
+    if verbose > 0:
+        print(f'Loss store of {len(df)} models saved in {store_folder}')
+    return LossStore(store_folder=store_folder)
+
+
+class LossStore():
+    def __init__(self, store_folder='models/loss_store/'):
+        '''Loss store in store_folder (see build_loss_store()). Attributes: losses (memory-mapped array of
+        n_models x n_loss_keys x n_epochs), loss_keys and df (catalog rows, in the same order as losses).'''
+        self.store_folder = store_folder
+        with open(os.path.join(self.store_folder, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.loss_keys = meta['loss_keys']
+        self.losses = np.load(os.path.join(self.store_folder, 'losses.npy'), mmap_mode='r')
+        self.df = pd.read_csv(os.path.join(self.store_folder, 'catalog.csv'), float_precision='round_trip')  # exact file_mtime
+        self.df['name_date'] = self.df['name_date'].fillna('')  # file names without date
+        assert len(self.df) == self.losses.shape[0] == meta['n_models'], f'{self.store_folder} is corrupted'
+
+    def __repr__(self):
+        return f'Loss store {self.store_folder} ({self.losses.shape[0]} models, {len(self.loss_keys)} losses, {self.losses.shape[2]} epochs)'
+
+    def select(self, folder=None, date_max=None, date_min=None, **conditions):
+        '''Boolean array of models (rows) in folder, with file name date between date_min and date_max and
+        with columns equal to conditions (value or list of values), see ModelCatalog.select().'''
+        bool_select = np.ones(len(self.df), dtype=bool)
+        if folder is not None:
+            bool_select &= (self.df['folder'] == os.path.abspath(folder)).values
+        if date_max is not None:
+            bool_select &= (self.df['name_date'] <= date_max).values
+        if date_min is not None:
+            bool_select &= (self.df['name_date'] >= date_min).values
+        for col, val in conditions.items():
+            assert col in self.df.columns, f'{col} is not a catalog column. Columns: {list(self.df.columns)}'
+            bool_select &= self.df[col].isin(val if type(val) in [list, tuple, np.ndarray] else [val]).values
+        return bool_select
+
+    def get_rows(self, paths, check_current=True):
+        '''Index array of the rows of model files paths (in the same order). If check_current, asserts that
+        the files did not change since the store was built (see build_loss_store()).'''
+        path_rows = {path: i_row for i_row, path in enumerate(self.df['path'])}
+        rows = np.zeros(len(paths), dtype=int)
+        for i_path, path in enumerate(paths):
+            path = os.path.abspath(path)
+            assert path in path_rows.keys(), f'{path} not in {self}, please rebuild it (see build_loss_store())'
+            rows[i_path] = path_rows[path]
+            if check_current:
+                assert model_catalog.get_file_stat(path=path) == (self.df['file_mtime'][rows[i_path]], self.df['file_size'][rows[i_path]]), \
+                       f'{path} changed since {self} was built, please rebuild it (see build_loss_store())'
+        return rows
+
+    def get_losses(self, loss_key, rows=None):
+        '''Loss curves of loss_key (n_models x n_epochs, nan after the last epoch) of rows (boolean or
+        index array, all models if None).'''
+        assert loss_key in self.loss_keys, f'{loss_key} not saved. List of saved loss names: {self.loss_keys}'
+        mat = self.losses[:, self.loss_keys.index(loss_key), :]
+        mat = mat if rows is None else mat[rows]
+        n_epochs = np.sum(np.any(np.logical_not(np.isnan(mat)), 0))  # trim epochs that no selected model has
+        return np.array(mat[:, :n_epochs], dtype=np.float64)
+
+    def compute_learning_index(self, loss_key, method='integral', rows=None):
+        '''Learning index of loss_key of rows (see get_losses() and ru.compute_learning_index()).'''
+        return compute_learning_index_mat(mat=self.get_losses(loss_key=loss_key, rows=rows), method=method)
+
+    def get_learning_index_df(self, list_loss=['pred'], method='integral', rows=None):
+        '''Catalog rows with a column learning_eff_<loss> per loss of list_loss, for all models (or rows).
+        Models are grouped by their number of epochs (for method mean_integral too); models without
+        a loss get nan.'''
+        df = self.df.copy() if rows is None else self.df[rows].copy()
+        for loss_key in list_loss:
+            mat = self.get_losses(loss_key=loss_key, rows=rows)
+            n_epochs_rnn = np.sum(np.logical_not(np.isnan(mat)), 1)  # curves are nan-padded at the end
+            learn_eff = np.zeros(mat.shape[0]) + np.nan
+            for n_epochs in np.unique(n_epochs_rnn[n_epochs_rnn > 0]):
+                bool_rnn = n_epochs_rnn == n_epochs
+                learn_eff[bool_rnn] = compute_learning_index_mat(mat=mat[bool_rnn, :n_epochs], method=method)
+            df[f'learning_eff_{loss_key}'] = learn_eff
+        return df
@@ -0,0 +1,113 @@
+## In-process cache of loaded models for ru.load_rnn(), so that figure sessions that load the same networks
+## in many plotting functions read each file only once. Entries are keyed by (path, mtime, size), so a file
+## that is rewritten is loaded again; save_model() also invalidates its entry explicitly. Least recently
+## used models are evicted when the (estimated) memory size of the cache exceeds its budget.
+
+import numpy as np
+import os, sys, copy, collections
+import rnn_io
+import model_catalog
+
+def estimate_size(obj, _depth=0):
+    '''Estimated memory size (bytes) of obj: arrays and tensors by their data, containers and models recursively.'''
+    if _depth > 10:
+        return 0
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if type(obj).__module__.split('.')[0] == 'torch' and hasattr(obj, 'nelement'):  # tensor
+        return obj.element_size() * obj.nelement()
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(estimate_size(v, _depth=_depth + 1) for v in obj.values())
+    if isinstance(obj, (list, tuple, set)):
+        return sys.getsizeof(obj) + sum(estimate_size(v, _depth=_depth + 1) for v in obj)
+    if hasattr(obj, '__dict__'):  # models (incl. torch modules via their _parameters/_modules) & decoders
+        return sys.getsizeof(obj) + estimate_size({key: val for key, val in vars(obj).items() if key not in rnn_io.skip_attributes},
+                                                  _depth=_depth + 1)  # without git.Repo
+    return sys.getsizeof(obj)
+
+
+class ModelCache():
+    def __init__(self, max_size_mb=500):
+        '''LRU cache of models of at most max_size_mb megabytes (estimated, see estimate_size()).'''
+        self.max_size = int(max_size_mb * 1e6)
+        self.entries = collections.OrderedDict()  # path: (file key, model, size), least recently used first
+        self.total_size = 0
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def __repr__(self):
+        return f'Model cache ({len(self.entries)} models, {self.total_size / 1e6:.1f}/{self.max_size / 1e6:.1f} MB, {self.n_hits} hits, {self.n_misses} misses)'
+
+    def get_file_key(self, path):
+        return model_catalog.get_file_stat(path=path)  # (mtime, size), of the archive shard for archived models
+
+    def contains(self, path):
+        '''Whether an up-to-date model of path is cached (without counting a hit or miss).'''
+        entry = self.entries.get(os.path.abspath(path), None)  # single lookup, may be called from prefetch threads
+        return entry is not None and entry[0] == self.get_file_key(path=path)
+
+    def get(self, path):
+        '''Cached model of path, or None if not cached or if the file changed.'''
+        path = os.path.abspath(path)
+        if path in self.entries.keys():
+            file_key, model, size = self.entries[path]
+            if file_key == self.get_file_key(path=path):
+                self.entries.move_to_end(path)
+                self.n_hits += 1
+                return model
+            self.invalidate(path=path)
+        self.n_misses += 1
+        return None
+
+    def put(self, path, model):
+        '''Add model of path, then evict least recently used models until the cache fits its budget.'''
+        path = os.path.abspath(path)
+        self.invalidate(path=path)
+        size = estimate_size(model)
+        if size > self.max_size:
+            return
+        self.entries[path] = (self.get_file_key(path=path), model, size)
+        self.total_size += size
+        while self.total_size > self.max_size:
+            _, (__, ___, old_size) = self.entries.popitem(last=False)
+            self.total_size -= old_size
+
+    def invalidate(self, path=None):
+        '''Remove model of path (all models if None).'''
+        if path is None:
+            self.entries.clear()
+            self.total_size = 0
+            return
+        path = os.path.abspath(path)
+        if path in self.entries.keys():
+            self.total_size -= self.entries.pop(path)[2]
+
+_default_cache = ModelCache()  # used by ru.load_rnn()
+
+def set_default_cache(max_size_mb=500):
+    """Replace the cache used by ru.load_rnn() by one of max_size_mb megabytes (None to switch caching off).
+    Returns the cache."""
+    global _default_cache
+    _default_cache = None if max_size_mb is None else ModelCache(max_size_mb=max_size_mb)
+    return _default_cache
+
+def get_default_cache():
+    """Return cache used by ru.load_rnn() (None if switched off)."""
+    return _default_cache
+
+def invalidate(path):
+    """Remove model of path from the default cache (eg when it is saved again)."""
+    if _default_cache is not None:
+        _default_cache.invalidate(path=path)
+
+def load_model(path, shared=False, data=None):
+    """Load model of path via the default cache (see rnn_io.load_model()). A copy of the cached model is returned,
+    which can be changed (eg load_state_dict(), forward runs, decoders saved inplace). If shared, the cached model itself
+    is returned (without copying), which must not be changed: only for read-only use, eg loops over many models.
+    data are the bytes of the file if these were already read (see model_prefetch.py)."""
+    model = None if _default_cache is None else _default_cache.get(path=path)
+    if model is None:
+        model = rnn_io.load_model(path=path) if data is None else rnn_io.load_model_bytes(data=data, path=path)
+        if _default_cache is not None:
+            _default_cache.put(path=path, model=model)
+    return copy.deepcopy(model) if (not shared and _default_cache is not None) else model
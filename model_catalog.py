@@ -0,0 +1,277 @@
+## SQLite catalog of saved models, so that analyses can select models by query (task, nature_stim,
+## l1_param, n_nodes etc.) instead of walking the models/ folders. One row per model file with its main
+## info_dict fields, the date of its file name and summary metrics (final losses). Models in archives
+## (see rnn_archive.py) are listed under the path of their original folder.
+## The catalog is updated by rescan() (only files that changed are read, with rnn_io.read_fields()) and,
+## if set with set_default_catalog(), by save_model(). ru.get_list_rnns() rescans a folder first if its
+## listing changed since it was last scanned (see is_current()). Rescan from the command line with:
+##   python model_catalog.py --root models/ --db models/model_catalog.sqlite
+
+import numpy as np
+import pandas as pd
+import os, json, sqlite3, argparse
+from tqdm import tqdm
+import rnn_io
+import rnn_archive
+
+info_dict_columns = {'task': 'TEXT', 'type_task': 'TEXT', 'train_task': 'TEXT', 'nature_stim': 'TEXT',
+                     'l1_param': 'REAL', 'n_nodes': 'INTEGER', 'ratio_exp': 'REAL', 'late_s2': 'INTEGER',
+                     'simulated_annealing': 'INTEGER', 'n_epochs': 'INTEGER', 'trained_epochs': 'INTEGER',
+                     'converged': 'INTEGER', 'timestamp': 'TEXT'}
+metric_columns = {'final_train_loss': 'REAL', 'final_test_loss': 'REAL', 'final_pred_loss': 'REAL',
+                  'final_spec_loss': 'REAL', 'final_l1_loss': 'REAL'}
+catalog_columns = {**{'path': 'TEXT PRIMARY KEY', 'folder': 'TEXT', 'file_name': 'TEXT', 'file_mtime': 'REAL',
+                      'file_size': 'INTEGER', 'name_date': 'TEXT'},
+                   **info_dict_columns, **metric_columns, **{'info_json': 'TEXT'}}
+
+_default_catalog = None  # catalog updated by save_model(), see set_default_catalog()
+
+def set_default_catalog(db_path='models/model_catalog.sqlite'):
+    """Update the ModelCatalog in db_path whenever a model is saved, and use it in ru.get_list_rnns().
+    Returns the catalog. Use db_path=None to switch off."""
+    global _default_catalog
+    _default_catalog = None if db_path is None else ModelCatalog(db_path=db_path)
+    return _default_catalog
+
+def get_default_catalog():
+    """Return catalog set by set_default_catalog() (None if not set)."""
+    return _default_catalog
+
+def update_default_catalog(path):
+    """Add/update model file path in the default catalog, if set."""
+    if _default_catalog is not None:
+        _default_catalog.update_model(path=path)
+
+def get_name_date(file_name):
+    """Date (yyyy-mm-dd) of the timestamp in file_name (rnn-mnm_yyyy-mm-dd-hhmm.data), as used by ru.timestamp_max_date()."""
+    date = file_name[8:18]
+    return date if len(date) == 10 and date[4] == '-' and date[7] == '-' else None
+
+def _json_default(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return str(obj)
+
+def _to_sql_value(value):
+    if isinstance(value, (bool, np.bool_)):
+        return int(value)
+    if isinstance(value, np.generic):
+        return value.item()
+    if value is None or isinstance(value, (int, float, str)):
+        return value
+    return str(value)
+
+def get_file_stat(path):
+    """(mtime, size) of model file path, or of the archive shard that holds it if its folder is archived."""
+    archived = rnn_archive.find_archived(path=path)
+    if archived is not None:
+        path = rnn_archive.get_archive(archive_path=archived[0]).get_shard_path(name=archived[1])
+    stat = os.stat(path)
+    return stat.st_mtime, stat.st_size
+
+def get_folder_signature(folder):
+    """Json string of the mtimes of folder and its archive (None if they do not exist), which change when
+    model files are added, removed or renamed (or shards added to the archive)."""
+    mtimes = []
+    for path in [folder, rnn_archive.get_archive_path(folder)]:
+        try:
+            mtimes.append(os.stat(path).st_mtime_ns)
+        except FileNotFoundError:
+            mtimes.append(None)
+    return json.dumps(mtimes)
+
+def _list_archive(archive_path):
+    """Paths (under the original folder) and stats (of their shards) of the models in archive_path."""
+    folder = archive_path[:-len(rnn_archive.archive_suffix)]
+    list_paths, list_stats = [], []
+    for name, shard in rnn_archive.get_archive(archive_path=archive_path).get_model_shards().items():
+        stat = os.stat(os.path.join(archive_path, shard))
+        list_paths.append(os.path.join(folder, name))
+        list_stats.append((stat.st_mtime, stat.st_size))
+    return list_paths, list_stats
+
+def _list_files(folder, files):
+    """Paths and stats of the model files of folder (with file names files)."""
+    list_paths, list_stats = [], []
+    for x in files:
+        if x[-5:] == '.data' and x[:5] != '.tmp_':
+            stat = os.stat(os.path.join(folder, x))
+            list_paths.append(os.path.join(folder, x))
+            list_stats.append((stat.st_mtime, stat.st_size))
+    return list_paths, list_stats
+
+def _final_value(arr):
+    return float(arr[-1]) if arr is not None and len(arr) > 0 else None
+
+
+class ModelCatalog():
+    def __init__(self, db_path='models/model_catalog.sqlite'):
+        '''Catalog of model files in SQLite database db_path (created if it does not exist).'''
+        self.db_path = db_path
+        db_folder = os.path.dirname(os.path.abspath(self.db_path))
+        if not os.path.exists(db_folder):
+            os.makedirs(db_folder)
+        with self.connect() as conn:
+            conn.execute(f'CREATE TABLE IF NOT EXISTS models ({", ".join(f"{col} {col_type}" for col, col_type in catalog_columns.items())})')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_folder ON models (folder)')
+            conn.execute('CREATE TABLE IF NOT EXISTS folders (folder TEXT PRIMARY KEY, signature TEXT)')  # see rescan_folder()
+
+    def __repr__(self):
+        return f'Model catalog {self.db_path} ({self.count()} models)'
+
+    def connect(self):
+        return sqlite3.connect(self.db_path, timeout=60)  # wait for concurrent writers (eg parallel decoding)
+
+    def count(self):
+        with self.connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM models').fetchone()[0]
+
+    def get_row(self, path):
+        '''Catalog row (dict of column: value) of model file path (or archived model, see rnn_archive.py).'''
+        path = os.path.abspath(path)
+        stat = get_file_stat(path=path)
+        rnn_fields = rnn_io.read_fields(path=path, fields=['info_dict', 'train_loss_arr', 'test_loss_arr', 'test_loss_split'])
+        info_dict = rnn_fields['info_dict']
+        row = {'path': path, 'folder': os.path.dirname(path), 'file_name': os.path.basename(path),
+               'file_mtime': stat[0], 'file_size': stat[1], 'name_date': get_name_date(os.path.basename(path)),
+               'info_json': json.dumps(info_dict, default=_json_default)}
+        for col in info_dict_columns.keys():
+            row[col] = _to_sql_value(info_dict.get(col, None))
+        split = rnn_fields['test_loss_split']
+        spec_name = info_dict.get('spec_task_name', info_dict.get('type_task', None))
+        row['final_train_loss'] = _final_value(rnn_fields['train_loss_arr'])
+        row['final_test_loss'] = _final_value(rnn_fields['test_loss_arr'])
+        row['final_pred_loss'] = _final_value(split.get('pred', None))
+        row['final_spec_loss'] = _final_value(split.get(spec_name, None))
+        row['final_l1_loss'] = _final_value(split.get('L1', None))
+        return row
+
+    def _insert_rows(self, conn, rows):
+        columns = list(catalog_columns.keys())
+        conn.executemany(f'INSERT OR REPLACE INTO models ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})',
+                         [[row[col] for col in columns] for row in rows])
+
+    def update_model(self, path):
+        '''Add or update the row of model file path.'''
+        row = self.get_row(path=path)
+        with self.connect() as conn:
+            self._insert_rows(conn=conn, rows=[row])
+
+    def rescan(self, root='models/', remove_missing=True, verbose=1):
+        '''Index all model files (.data) under folder root. Only files that are new or changed (mtime or
+        size) since the last scan are read. If remove_missing, rows of files under root that no longer
+        exist are deleted. Returns the number of files (re)indexed.'''
+        root = os.path.abspath(root)
+        with self.connect() as conn:
+            indexed = {path: (mtime, size) for path, mtime, size in conn.execute(
+                        'SELECT path, file_mtime, file_size FROM models WHERE path LIKE ?', (os.path.join(root, '') + '%',))}
+        list_paths, list_stats = [], []
+        for folder, _, files in os.walk(root):
+            if folder[-len(rnn_archive.archive_suffix):] == rnn_archive.archive_suffix:  # archived models, under their original folder
+                folder_paths, folder_stats = _list_archive(archive_path=folder)
+            else:
+                folder_paths, folder_stats = _list_files(folder=folder, files=files)
+            list_paths += folder_paths
+            list_stats += folder_stats
+        return self._index(list_paths=list_paths, list_stats=list_stats, indexed=indexed,
+                           remove_missing=remove_missing, verbose=verbose)
+
+    def rescan_folder(self, folder, verbose=0):
+        '''Index the model files of folder (not of its subfolders) and its archive, as rescan(), and store
+        its signature (see is_current()). Returns the number of files (re)indexed.'''
+        folder = os.path.abspath(folder)
+        signature = get_folder_signature(folder=folder)  # before listing, so that files added meanwhile give a new signature
+        list_paths, list_stats = _list_files(folder=folder, files=os.listdir(folder)) if os.path.isdir(folder) else ([], [])
+        archive_path = rnn_archive.get_archive_path(folder)
+        if os.path.isdir(archive_path):
+            set_files = set(list_paths)
+            for path, stat in zip(*_list_archive(archive_path=archive_path)):
+                if path not in set_files:  # files take precedence, as in rnn_archive.find_archived()
+                    list_paths.append(path)
+                    list_stats.append(stat)
+        with self.connect() as conn:
+            indexed = {path: (mtime, size) for path, mtime, size in conn.execute(
+                        'SELECT path, file_mtime, file_size FROM models WHERE folder = ?', (folder,))}
+        n_indexed = self._index(list_paths=list_paths, list_stats=list_stats, indexed=indexed,
+                                remove_missing=True, verbose=verbose)
+        with self.connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO folders (folder, signature) VALUES (?, ?)', (folder, signature))
+        return n_indexed
+
+    def is_current(self, folder):
+        '''Whether the listing of folder (and its archive) is unchanged since its last rescan_folder().'''
+        folder = os.path.abspath(folder)
+        with self.connect() as conn:
+            row = conn.execute('SELECT signature FROM folders WHERE folder = ?', (folder,)).fetchone()
+        return row is not None and row[0] == get_folder_signature(folder=folder)
+
+    def _index(self, list_paths, list_stats, indexed, remove_missing=True, verbose=1):
+        '''Index the files of list_paths whose (mtime, size) in list_stats differ from indexed (dict of
+        path: (mtime, size) of catalog rows), and delete rows of indexed that are not in list_paths if remove_missing.'''
+        new_rows, n_indexed = [], 0
+        for path, stat in (tqdm(list(zip(list_paths, list_stats))) if verbose > 0 else zip(list_paths, list_stats)):
+            if path in indexed.keys() and indexed[path] == stat:
+                continue
+            try:
+                new_rows.append(self.get_row(path=path))
+            except Exception as e:  # eg unreadable file, do not stop scanning the tree
+                print(f'WARNING: could not index {path}: {e}')
+            if len(new_rows) >= 500:
+                with self.connect() as conn:
+                    self._insert_rows(conn=conn, rows=new_rows)
+                n_indexed += len(new_rows)
+                new_rows = []
+        with self.connect() as conn:
+            self._insert_rows(conn=conn, rows=new_rows)
+            n_indexed += len(new_rows)
+            if remove_missing:
+                missing = set(indexed.keys()).difference(set(list_paths))
+                conn.executemany('DELETE FROM models WHERE path = ?', [(path,) for path in missing])
+        if verbose > 0:
+            print(f'{n_indexed} files indexed, {self.count()} models in catalog')
+        return n_indexed
+
+    def _get_where(self, folder=None, date_max=None, date_min=None, **conditions):
+        clauses, params = [], []
+        if folder is not None:
+            clauses.append('folder = ?')
+            params.append(os.path.abspath(folder))
+        if date_max is not None:
+            clauses.append('(name_date <= ? OR name_date IS NULL)')  # inclusive, like ru.timestamp_max_date(); file names without date are kept
+            params.append(date_max)
+        if date_min is not None:
+            clauses.append('(name_date >= ? OR name_date IS NULL)')
+            params.append(date_min)
+        for col, val in conditions.items():
+            assert col in catalog_columns.keys(), f'{col} is not a catalog column. Columns: {list(catalog_columns.keys())}'
+            if type(val) in [list, tuple, np.ndarray]:
+                clauses.append(f'{col} IN ({", ".join("?" * len(val))})')
+                params += [_to_sql_value(x) for x in val]
+            else:
+                clauses.append(f'{col} = ?')
+                params.append(_to_sql_value(val))
+        return (' WHERE ' + ' AND '.join(clauses) if len(clauses) > 0 else ''), params
+
+    def select(self, folder=None, date_max=None, date_min=None, **conditions):
+        '''Paths of models that match all conditions (column=value, or column=list of values),
+        in folder and with file name date between date_min and date_max (yyyy-mm-dd) if given.
+        Eg select(type_task='dmc', nature_stim='onehot', l1_param=1e-3, train_task='pred_only').'''
+        where, params = self._get_where(folder=folder, date_max=date_max, date_min=date_min, **conditions)
+        with self.connect() as conn:
+            return [x[0] for x in conn.execute(f'SELECT path FROM models{where} ORDER BY path', params)]
+
+    def get_df(self, folder=None, date_max=None, date_min=None, **conditions):
+        '''Data frame of catalog rows, selected as in select().'''
+        where, params = self._get_where(folder=folder, date_max=date_max, date_min=date_min, **conditions)
+        with self.connect() as conn:
+            return pd.read_sql_query(f'SELECT * FROM models{where} ORDER BY path', conn, params=params)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index all model files under root in the model catalog.')
+    parser.add_argument('--root', default='models/', help='folder to scan')
+    parser.add_argument('--db', default='models/model_catalog.sqlite', help='catalog database')
+    args = parser.parse_args()
+    ModelCatalog(db_path=args.db).rescan(root=args.root)
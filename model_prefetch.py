@@ -0,0 +1,64 @@
+## Prefetching loaders for loops over many model files. The bytes of the next `readahead` files are read on
+## a thread pool while the current model is deserialised in the main thread, so that disk and CPU work
+## overlap instead of alternating. Models come out in the order of the given paths:
+##   for path, rnn in iter_models(paths=[os.path.join(rnn_folder, x) for x in list_rnns]):
+## or, with file names and rnn.eval(), ru.iter_rnns(rnn_folder). iter_fields() does the same for
+## rnn_io.read_fields(), eg for loss curves.
+
+import os, collections
+from concurrent.futures import ThreadPoolExecutor
+import rnn_io
+import model_cache
+
+default_readahead = 4
+
+def read_file(path):
+    '''Bytes of model file path, or None if it is not a file (archived model, loaded by rnn_io.load_model()).'''
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+def prefetch(function, items, readahead=default_readahead, n_threads=None):
+    '''Yield function(item) for all items in order, while computing the next readahead results on a
+    thread pool of n_threads (default readahead) threads.'''
+    assert readahead >= 1, f'readahead should be at least 1, not {readahead}'
+    executor = ThreadPoolExecutor(max_workers=readahead if n_threads is None else n_threads)
+    futures = collections.deque()
+    try:
+        for item in items:
+            futures.append(executor.submit(function, item))
+            if len(futures) > readahead:
+                yield futures.popleft().result()
+        while len(futures) > 0:
+            yield futures.popleft().result()
+    finally:  # also when the loop is stopped early
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+def iter_models(paths, readahead=default_readahead, n_threads=None, use_cache=True, shared=False):
+    '''Yield (path, model) for all model files paths, reading readahead files ahead (see prefetch()).
+    If use_cache, models go through the default model cache (see model_cache.load_model()) and cached
+    models are not read again (copies are yielded, or the cached models themselves if shared, see model_cache.load_model()).'''
+    paths = list(paths)
+    cache = model_cache.get_default_cache() if use_cache else None
+
+    def read_uncached(path):
+        return None if (cache is not None and cache.contains(path=path)) else read_file(path=path)
+
+    for path, data in zip(paths, prefetch(function=read_uncached, items=paths, readahead=readahead, n_threads=n_threads)):
+        if use_cache:
+            model = model_cache.load_model(path=path, shared=shared, data=data)
+        else:
+            model = rnn_io.load_model(path=path) if data is None else rnn_io.load_model_bytes(data=data, path=path)
+        yield path, model
+
+def iter_fields(paths, fields, readahead=default_readahead, n_threads=None):
+    '''Yield (path, values) for all model files paths, with values the fields read by rnn_io.read_fields()
+    (on the thread pool, see prefetch()).'''
+    paths = list(paths)
+    values = prefetch(function=lambda path: rnn_io.read_fields(path=path, fields=fields), items=paths,
+                      readahead=readahead, n_threads=n_threads)
+    for path, rnn_fields in zip(paths, values):
+        yield path, rnn_fields
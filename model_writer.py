@@ -0,0 +1,161 @@
+## Background writer of model files, so that training does not wait for serialisation and disk I/O.
+## save_model(writer=writer) takes a snapshot of the model (rnn_io.snapshot_model(), in the caller's thread)
+## and puts it in a bounded queue; a background thread compresses (see compression.py) and writes it (atomically, see
+## rnn_io.write_atomic()). close() waits for all writes, fsyncs the folders and raises any write errors:
+##   with AsyncModelWriter() as writer:
+##       for ..:
+##           rnn = bptt_training(..)
+##           future = rnn.save_model(folder=save_folder, writer=writer)  # future.result() is the final path
+## Pool workers each get their own writer, see get_process_writer(); their errors reach the parent
+## through init_pool_worker() and raise_pool_errors().
+
+import os, queue, threading, concurrent.futures, multiprocessing.util
+import rnn_io
+import model_catalog
+import compression
+
+
+class AsyncModelWriter():
+    def __init__(self, max_queue=4, codec='default', level=None, fsync=True):
+        '''Write models in a background thread. At most max_queue snapshots wait to be written (save_model()
+        blocks when the queue is full, which bounds memory use). Files are compressed with codec at level
+        (see compression.py, None for no compression) and flushed to disk if fsync.'''
+        self.codec = compression.resolve_codec(codec)  # fail now if not installed
+        self.level = level
+        self.fsync = fsync
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.errors = []  # (path, exception) of failed writes
+        self.written = []  # paths of written files
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name='AsyncModelWriter', daemon=True)
+        self.thread.start()
+
+    def __repr__(self):
+        return f'Async model writer ({len(self.written)} written, {self.queue.qsize()} queued, {len(self.errors)} errors)'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(raise_errors=exc_type is None)  # do not hide the exception of the with block
+
+    def submit(self, rnn, allow_name_change=True, verbose=True):
+        '''Queue a snapshot of rnn (with full_path set, see RNN_MTL.save_model()) to be written. Raises errors
+        of earlier writes, so that these are not only found at close(). Returns a concurrent.futures.Future
+        of the path of the written file (which has a suffix if allow_name_change and the name was taken);
+        rnn itself is not changed by the background thread.'''
+        assert not self.closed, 'writer is closed'
+        self.raise_errors()
+        future = concurrent.futures.Future()
+        self.queue.put((rnn.full_path, rnn_io.snapshot_model(rnn=rnn), allow_name_change, verbose, future))
+        return future
+
+    def _write(self, path, encoded, allow_name_change, verbose):
+        header, arrays, pickled = encoded
+
+        def write_function(file_handle, path):
+            header['attributes']['full_path'] = path
+            rnn_io.write_encoded(header=header, arrays=arrays, pickled=pickled, file_handle=file_handle,
+                                 codec=self.codec, level=self.level)
+
+        if allow_name_change:
+            path = rnn_io.write_unique(path=path, write_function=write_function, fsync=self.fsync)  # may have a suffix
+        else:
+            rnn_io.write_atomic(path=path, write_function=lambda file_handle: write_function(file_handle, path),
+                                fsync=self.fsync)
+        model_catalog.update_default_catalog(path=path)
+        self.written.append(path)
+        if verbose > 0:
+            print(f'RNN-MTL model saved as {os.path.basename(path)}')
+        return path
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:  # sent by close()
+                    return
+                path, encoded, allow_name_change, verbose, future = item
+                try:
+                    future.set_result(self._write(path=path, encoded=encoded, allow_name_change=allow_name_change, verbose=verbose))
+                except Exception as e:  # keep writing the other models, errors are raised in the caller
+                    self.errors.append((path, e))
+                    future.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        '''Wait until all queued models are written.'''
+        self.queue.join()
+
+    def raise_errors(self):
+        if len(self.errors) > 0:
+            errors, self.errors = self.errors, []
+            raise RuntimeError(f'{len(errors)} model(s) could not be written: ' +
+                               '; '.join(f'{path}: {repr(e)}' for path, e in errors)) from errors[0][1]
+
+    def close(self, raise_errors=True):
+        '''Write all queued models, stop the background thread and fsync the folders (so that the new
+        file names are on disk too). Raises a RuntimeError if any write failed (if raise_errors).'''
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        if self.fsync:
+            for folder in set(os.path.dirname(os.path.abspath(path)) for path in self.written):
+                dir_fd = os.open(folder, os.O_RDONLY)
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+        if raise_errors:
+            self.raise_errors()
+
+_process_writer = None  # writer of this (Pool worker) process, see get_process_writer()
+_process_writer_pid = None
+_error_queue = None  # multiprocessing queue of the parent for write errors of this worker, see init_pool_worker()
+
+def init_pool_worker(error_queue):
+    """Pool initializer: write errors of the process writer of this worker that are only found when it is
+    closed at exit are put on error_queue (multiprocessing.Queue() of the parent, see raise_pool_errors())."""
+    global _error_queue
+    _error_queue = error_queue
+
+def raise_pool_errors(error_queue):
+    """Raise a RuntimeError with the write errors that pool workers put on error_queue (call after pool.join())."""
+    errors = []
+    while True:
+        try:
+            errors.append(error_queue.get(timeout=0.1))
+        except queue.Empty:
+            break
+    if len(errors) > 0:
+        raise RuntimeError(f'{len(errors)} model(s) could not be written by pool workers: ' +
+                           '; '.join(f'{path}: {e}' for path, e in errors))
+
+def _close_at_exit(writer):
+    """Close writer when this process exits, sending its errors to the parent if this is a pool worker
+    (errors raised here would only be printed)."""
+    writer.close(raise_errors=(_error_queue is None))
+    if _error_queue is not None:
+        for path, e in writer.errors:
+            _error_queue.put((path, repr(e)))  # flushed to the parent before the worker exits
+
+def get_process_writer(max_queue=4, codec='default', level=None, fsync=True):
+    """Writer of this process, created on first use. It is closed by close_process_writer() or when a
+    multiprocessing worker process exits (after pool.close() & pool.join()); errors of earlier writes are
+    raised by the next save_model(), errors of the last writes of a worker by raise_pool_errors()."""
+    global _process_writer, _process_writer_pid
+    if _process_writer is None or _process_writer_pid != os.getpid():  # the thread of a parent writer is not forked
+        _process_writer = AsyncModelWriter(max_queue=max_queue, codec=codec, level=level, fsync=fsync)
+        _process_writer_pid = os.getpid()
+        multiprocessing.util.Finalize(_process_writer, _close_at_exit, args=(_process_writer,), exitpriority=10)
+    return _process_writer
+
+def close_process_writer():
+    """Close the writer of this process (if any), raising its write errors."""
+    global _process_writer
+    if _process_writer is not None and _process_writer_pid == os.getpid():
+        writer, _process_writer = _process_writer, None
+        writer.close()
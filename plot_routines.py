@@ -14,11 +14,12 @@ import matplotlib.patches as patches
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from mpl_toolkits.axes_grid1.colorbar import colorbar as mpl_colorbar
 import seaborn as sns
-import pickle, os, sys
+import os, sys
 import scipy.cluster, scipy.spatial
 import sklearn.decomposition
 import bptt_rnn as bp
 import rot_utilities as ru
+import model_prefetch
 import pandas as pd
 from cycler import cycler
 ## Create list with standard colors:
@@ -149,19 +150,19 @@ def plot_split_perf(rnn_name=None, rnn_folder=None, ax_top=None, ax_bottom=None,
     else:
         list_rnns = [x for x in os.listdir(rnn_folder) if x[-5:] == '.data']
     n_rnn = len(list_rnns)
-    for i_rnn, rnn_name in enumerate(list_rnns):
-        rnn = ru.load_rnn(rnn_name=os.path.join(rnn_folder, rnn_name))
+    for i_rnn, (_, rnn_fields) in enumerate(model_prefetch.iter_fields(paths=[os.path.join(rnn_folder, x) for x in list_rnns],
+                                                                       fields=['info_dict', 'test_loss_split'])):
         if i_rnn == 0:
-            n_tp = len(rnn.test_loss_split['B'])
-            if 'simulated_annealing' in list(rnn.info_dict.keys()) and rnn.info_dict['simulated_annealing']:
+            n_tp = len(rnn_fields['test_loss_split']['B'])
+            if 'simulated_annealing' in list(rnn_fields['info_dict'].keys()) and rnn_fields['info_dict']['simulated_annealing']:
                 pass
             else:
-                assert n_tp == rnn.info_dict['n_epochs']  # double check and  assume it is the same for all rnns in rnn_folder\
-            conv_dict = {key: np.zeros((n_rnn, n_tp)) for key in rnn.test_loss_split.keys()}
+                assert n_tp == rnn_fields['info_dict']['n_epochs']  # double check and  assume it is the same for all rnns in rnn_folder\
+            conv_dict = {key: np.zeros((n_rnn, n_tp)) for key in rnn_fields['test_loss_split'].keys()}
             if plot_total:
                 conv_dict['pred'] = np.zeros((n_rnn, n_tp))
-        for key, arr in rnn.test_loss_split.items():
-            conv_dict[key][i_rnn, :] = arr.copy()
+        for key, arr in rnn_fields['test_loss_split'].items():
+            conv_dict[key][i_rnn, :] = arr
         if plot_total:
             conv_dict['pred'][i_rnn, :] = np.sum([conv_dict[key][i_rnn, :] for key in ['0', 'B', 'C', 'D']], 0)
 
@@ -731,7 +732,7 @@ def plot_multiple_rnn_properties(rnn_name_dict, rnn_folder, fontsize=10):
     swap_y_dict = {'low': False, 'med': True, 'high': True}
     ax_rast, ax_single, ax_ss, ax_ss_arr, ax_ctmat, ol = {}, {}, {}, {}, {}, {}
     for key, rnn_name in rnn_name_dict.items():
-        rnn[key] = ru.load_rnn(os.path.join(rnn_folder, rnn_name))
+        rnn[key] = ru.load_rnn(os.path.join(rnn_folder, rnn_name))  # copy, forward runs change the state
         _, __, forw  = bp.train_single_decoder_new_data(rnn=rnn[key], ratio_expected=0.5,
                                                         sparsity_c=0.1, bool_train_decoder=False)
         labels_use_1 = np.array([x[0] == '1' for x in forw['labels_test']])
@@ -1016,8 +1017,7 @@ def plot_distr_networks(rnn_name_dict, rnn_folder='models/75-25_100models/', ver
     rnn, ax_ctmat = {}, {}
     i_rnn = 0
     for key, rnn_name in rnn_name_dict.items():
-        with open(rnn_folder + rnn_name, 'rb') as f:
-            rnn[key] = pickle.load(f)
+        rnn[key] = ru.load_rnn(rnn_name=rnn_folder + rnn_name)
 
         ## CT matrix
         ax_ctmat[key] = fig.add_subplot(gs_top[i_rnn])
@@ -1511,7 +1511,10 @@ def plot_compare_early_late_beta(early_folder='models/75-25_SplitLoss_Xmodels/10
     ax.set_title('Delaying the ' + r'$C_{\beta}$' + ' stimulus hardly influences \nprediction task performance ' + r'$(P(\alpha = \beta) = 0.75)$')
     return ax
 
-def plot_explore_one_rnn(rnn, plot_mnm_matrix=True, decoder_type='LDA'):
+def plot_explore_one_rnn(rnn, plot_mnm_matrix=True, decoder_type='QDA', data_seed=None, reg_param=0.0):
+    '''If data_seed is given, the alpha and beta decoders use the same data set, and forward
+    activity is read from the activity cache if it exists (see activity_cache.set_default_cache()).
+    reg_param regularises the covariances of LDA/QDA decoders (see decoders.fit_discriminant()).'''
     print(rnn)
 
     if 'late_beta' in rnn.info_dict.keys():
@@ -1530,7 +1533,8 @@ def plot_explore_one_rnn(rnn, plot_mnm_matrix=True, decoder_type='LDA'):
 
     _, __, forw  = bp.train_single_decoder_new_data(rnn=rnn, ratio_expected=0.5,
                                                     sparsity_c=0.1, bool_train_decoder=True,
-                                                    late_beta=late_beta, decoder_type=decoder_type)
+                                                    late_beta=late_beta, decoder_type=decoder_type,
+                                                    data_seed=data_seed, reg_param=reg_param)
 
     fig = plt.figure(constrained_layout=False, figsize=(9, 8))
     gs_rasters = fig.add_gridspec(ncols=3, nrows=1, left=0.05, right=0.95,
@@ -1596,10 +1600,10 @@ def plot_explore_one_rnn(rnn, plot_mnm_matrix=True, decoder_type='LDA'):
     ## plot weights of alpha decoder over time
     decoder_weight_mat = np.zeros((rnn.info_dict['n_nodes'], len(time_axis_labels)))
     for tp in range(decoder_weight_mat.shape[1]):
-        if decoder_type == 'LDA':
+        if decoder_type == 'LDA' or decoder_type == 'QDA':
             decoder_weight_mat[:, tp] = np.squeeze(rnn.decoder_dict['alpha'][tp].means_[1, :] -
                                                 rnn.decoder_dict['alpha'][tp].means_[0, :])[ol]
-        elif decoder_type == 'logistic_regression':
+        elif decoder_type == 'logistic_regression' or decoder_type == 'logistic_regression_fista':
             decoder_weight_mat[:, tp] = np.squeeze(rnn.decoder_dict['alpha'][tp].coef_)[ol]
 
     ax_decoder_alpha_weights = fig.add_subplot(gs_decoding[1])
@@ -1625,7 +1629,7 @@ def plot_explore_one_rnn(rnn, plot_mnm_matrix=True, decoder_type='LDA'):
     _, __, ___  = bp.train_single_decoder_new_data(rnn=rnn, ratio_expected=0.5,
                                                 sparsity_c=0.1, bool_train_decoder=True,
                                                 late_beta=late_beta, label='beta',
-                                                decoder_type=decoder_type)
+                                                decoder_type=decoder_type, data_seed=data_seed, reg_param=reg_param)
     _, hm = plot_decoder_crosstemp_perf(score_matrix=rnn.decoding_crosstemp_score['beta'],
                             ax=ax_beta_dec, c_bar=True, fontsize_ticks=8,
                             ticklabels=time_axis_labels, v_max=1)
@@ -1638,10 +1642,7 @@ def plot_distr_rotation_inds(rnn_folder, times_early=[6, 7], times_late=[10, 11]
     rnn_list = [x for x in os.listdir(rnn_folder) if x[-5:] == '.data']
 
     rot_ind_arr = np.zeros(len(rnn_list))
-    for i_rnn, rnn_name in enumerate(rnn_list):
-        ## Load RNN:
-        with open(rnn_folder + rnn_name, 'rb') as f:
-            rnn = pickle.load(f)
+    for i_rnn, (rnn_name, rnn) in enumerate(ru.iter_rnns(rnn_folder=rnn_folder, list_rnns=rnn_list, shared=True)):
         rot_ind_arr[i_rnn] = ru.rotation_index(mat=rnn.rep_corr_mat_dict['alpha'],
                                                times_early=times_early, times_late=times_late)
         
@@ -1680,8 +1681,7 @@ def plot_many_corr_dec_mats(rnn_folder, n_rnns=3, save_fig=False, figname='figur
             return fig
 
         ## Load RNN:
-        with open(rnn_folder + rnn_name, 'rb') as f:
-            rnn = pickle.load(f)
+        rnn = ru.load_rnn(rnn_name=rnn_folder + rnn_name)
 
         if 'late_beta' in rnn.info_dict.keys():
             late_beta = rnn.info_dict['late_beta']
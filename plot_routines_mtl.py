@@ -16,6 +16,7 @@ import pickle, os, sys, copy
 import scipy.stats
 import sklearn.decomposition
 import bptt_rnn_mtl as bpm
+import model_prefetch
 import rot_utilities as ru
 import pandas as pd
 from cycler import cycler
@@ -165,21 +166,21 @@ def plot_split_perf(rnn_name=None, rnn_folder=None, ax_top=None, ax_bottom=None,
 
     ## Get loss function per RNN
     n_rnn = len(list_rnns)
-    for i_rnn, rnn_name in enumerate(list_rnns):
-        rnn = ru.load_rnn(rnn_name=os.path.join(rnn_folder, rnn_name))
+    for i_rnn, (_, rnn_fields) in enumerate(model_prefetch.iter_fields(paths=[os.path.join(rnn_folder, x) for x in list_rnns],
+                                                                       fields=['info_dict', 'test_loss_split'])):
         if i_rnn == 0:
-            n_tp = rnn.info_dict['n_epochs']
+            n_tp = rnn_fields['info_dict']['n_epochs']
             # if 'simulated_annealing' in list(rnn.info_dict.keys()) and rnn.info_dict['simulated_annealing']:
             #     pass
             # else:
             #     assert n_tp == rnn.info_dict['n_epochs']  # double check and  assume it is the same for all rnns in rnn_folder\
-            conv_dict = {key: np.zeros((n_rnn, n_tp)) for key in rnn.test_loss_split.keys()}
+            conv_dict = {key: np.zeros((n_rnn, n_tp)) for key in rnn_fields['test_loss_split'].keys()}
             if plot_total:
                 conv_dict['pred_sep'] = np.zeros((n_rnn, n_tp))
         else:
-            assert rnn.info_dict['n_epochs'] == n_tp
-        for key, arr in rnn.test_loss_split.items():
-            conv_dict[key][i_rnn, :] = arr.copy()
+            assert rnn_fields['info_dict']['n_epochs'] == n_tp
+        for key, arr in rnn_fields['test_loss_split'].items():
+            conv_dict[key][i_rnn, :] = arr
         if plot_total:
             conv_dict['pred_sep'][i_rnn, :] = np.sum([conv_dict[key][i_rnn, :] for key in ['0', 'S2', 'G']], 0)
 
@@ -910,9 +911,7 @@ def plot_sa_convergence(sa_folder_list=['/home/tplas/repos/eavesdropping/models/
 
         ax_conv[i_col] = fig.add_subplot(gs_conv[i_col])
         ax_ratio[i_col] = fig.add_subplot(gs_ratio[i_col])
-        list_rnns = ru.get_list_rnns(rnn_folder=sa_folder)
-        for i_rnn, rnn_name in enumerate(list_rnns):
-            rnn = ru.load_rnn(os.path.join(sa_folder, rnn_name))
+        for i_rnn, (rnn_name, rnn) in enumerate(ru.iter_rnns(rnn_folder=sa_folder, shared=True)):
             assert rnn.info_dict['simulated_annealing']
             if i_rnn == 0:
                 ratio_exp_array[i_col] = rnn.info_dict['ratio_exp_array']
@@ -957,9 +956,7 @@ def plot_sa_convergence_small(sa_folder_list=['/home/tplas/repos/eavesdropping/m
     ax_ratio = fig.add_subplot(gs_ratio[0])
     ratio_exp_array = {}
     for i_col, sa_folder in enumerate(sa_folder_list):
-        list_rnns = ru.get_list_rnns(rnn_folder=sa_folder)
-        for i_rnn, rnn_name in enumerate(list_rnns):
-            rnn = ru.load_rnn(os.path.join(sa_folder, rnn_name))
+        for i_rnn, (rnn_name, rnn) in enumerate(ru.iter_rnns(rnn_folder=sa_folder, shared=True)):
             assert rnn.info_dict['simulated_annealing']
             if i_rnn == 0:
                 ratio_exp_array[i_col] = rnn.info_dict['ratio_exp_array']
@@ -1011,8 +1008,7 @@ def plot_autotemp_s1_decoding(parent_folder='/home/tplas/repos/eavesdropping/mod
         rnn_folder = os.path.join(parent_folder, cf + '/')
         list_rnns =  ru.get_list_rnns(rnn_folder=rnn_folder)
         autotemp_dec_dict[cf] = np.zeros((len(list_rnns), n_tp))
-        for i_rnn, rnn_name in enumerate(list_rnns):
-            rnn = ru.load_rnn(os.path.join(rnn_folder, rnn_name))
+        for i_rnn, (rnn_name, rnn) in enumerate(ru.iter_rnns(rnn_folder=rnn_folder, list_rnns=list_rnns, shared=True)):
             autotemp_score = rnn.decoding_crosstemp_score['s1'].diagonal()
             autotemp_dec_dict[cf][i_rnn, :] = autotemp_score
         mean_dec = autotemp_dec_dict[cf].mean(0)
@@ -1037,15 +1033,9 @@ def plot_autotemp_all_reps_decoding(rnn_folder='/home/tplas/repos/eavesdropping/
         ax = plt.subplot(111)
 
 
-    for i_rep, rep in enumerate(['s1', 's2', 'go']):
-        print(rep)
-        if reset_decoders:
-            res = (i_rep == 0)
-        else:
-            res = False
-        bpm.train_multiple_decoders(rnn_folder=rnn_folder, ratio_expected=0.5,
-                                    n_samples=None, ratio_train=0.8, label=rep,
-                                    reset_decoders=res, skip_if_already_decoded=skip_if_already_decoded)  # check if decoding has been done before
+    bpm.train_multiple_decoders(rnn_folder=rnn_folder, ratio_expected=0.5,
+                                n_samples=None, ratio_train=0.8, label=['s1', 's2', 'go'],  # all from one forward pass
+                                reset_decoders=reset_decoders, skip_if_already_decoded=skip_if_already_decoded)  # check if decoding has been done before
     autotemp_dec_dict = {}
     n_tp = 13  # for t_stim = 2 and t_dleay = 2
     colour_dict = {'s1': pred_spec_colour, 's2': pred_spec_colour,
@@ -1055,8 +1045,7 @@ def plot_autotemp_all_reps_decoding(rnn_folder='/home/tplas/repos/eavesdropping/
     for i_rep, rep in enumerate(['go', 's1', 's2']):
         list_rnns =  ru.get_list_rnns(rnn_folder=rnn_folder)
         autotemp_dec_dict[rep] = np.zeros((len(list_rnns), n_tp))
-        for i_rnn, rnn_name in enumerate(list_rnns):
-            rnn = ru.load_rnn(os.path.join(rnn_folder, rnn_name))
+        for i_rnn, (rnn_name, rnn) in enumerate(ru.iter_rnns(rnn_folder=rnn_folder, list_rnns=list_rnns, shared=True)):
             autotemp_score = rnn.decoding_crosstemp_score[rep].diagonal()
             autotemp_dec_dict[rep][i_rnn, :] = autotemp_score
         mean_dec = autotemp_dec_dict[rep].mean(0)
@@ -1075,17 +1064,18 @@ def plot_autotemp_all_reps_decoding(rnn_folder='/home/tplas/repos/eavesdropping/
     despine(ax)
 
 def plot_correlation_matrix(rnn, representation='s1', ax=None, hard_reset=False,
-                            plot_mat=True, alpha=1, plot_diag=True, plot_cbar=True):
+                            plot_mat=True, alpha=1, plot_diag=True, plot_cbar=True, data_seed=None):
     """Plot cross correlation matrix of rnn, of given representation. If plot_mat is False ,
-    then plot the neural code (S1 cross corr over time). if hard_reset, recompute cross corr.
+    then plot the neural code (S1 cross corr over time). if hard_reset, recompute cross corr
+    (from cached forward activity if data_seed is given, see activity_cache.set_default_cache()).
     """
     if ax is None:
         ax = plt.subplot(111)
 
     if hard_reset:
-        bpm.save_pearson_corr(rnn=rnn, representation=representation)
+        bpm.save_pearson_corr(rnn=rnn, representation=representation, data_seed=data_seed)
     else:
-        ru.ensure_corr_mat_exists(rnn=rnn, representation=representation)
+        ru.ensure_corr_mat_exists(rnn=rnn, representation=representation, data_seed=data_seed)
 
     n_tp = 13
     if plot_mat:
@@ -1161,10 +1151,8 @@ def plot_hist_rot_indices(rnn_folder, representation='s1', ax=None, verbose=0):
     list_rnns = ru.get_list_rnns(rnn_folder=rnn_folder)
     rot_ind_arr = np.zeros(len(list_rnns))
     print(len(list_rnns))
-    for i_rnn, rnn_name in tqdm(enumerate(list_rnns)):
-        rnn = ru.load_rnn(os.path.join(rnn_folder, rnn_name))
-        ru.ensure_corr_mat_exists(rnn=rnn, representation=representation)
-        corr_mat = rnn.rep_corr_mat_dict[representation]
+    for i_rnn, (rnn_name, rnn) in tqdm(enumerate(ru.iter_rnns(rnn_folder=rnn_folder, list_rnns=list_rnns, shared=True))):
+        corr_mat = ru.get_corr_mat(rnn=rnn, representation=representation)  # does not change the cached model
         corr_s1s2_block = corr_mat[np.array([2, 3]), :][:, np.array([6, 7])]  # extract s1-s2 cross correlation.
         assert corr_s1s2_block.shape == (2, 2)
         rot_ind_arr[i_rnn] = np.mean(corr_s1s2_block)
@@ -1202,9 +1190,8 @@ def plot_autotemp_s1_different_epochs(rnn_folder='/home/tplas/repos/eavesdroppin
     n_rnns = len(rnn_list)
     if autotemp_dec_mat_dict is None:
         autotemp_dec_mat_dict = {x: np.zeros((n_rnns, n_tp)) for x in epoch_list}
-        for i_rnn, rnn_name in enumerate(rnn_list):
+        for i_rnn, (rnn_name, rnn) in enumerate(ru.iter_rnns(rnn_folder=rnn_folder, list_rnns=rnn_list)):  # copies, loads states of epochs
             print(f'RNN {i_rnn + 1}/{len(rnn_list)}')
-            rnn = ru.load_rnn(os.path.join(rnn_folder, rnn_name))
             tmp_autotemp_dec_dict = ru.calculate_autotemp_different_epochs(rnn=rnn, epoch_list=epoch_list,
                                                                       autotemp_dec_dict=None)
             for k, v in tmp_autotemp_dec_dict.items():
@@ -1352,7 +1339,7 @@ def plot_example_codes(one_ax=True, specify_irnn_list=None, sorting_rnns=None):
         if specify_irnn_list is not None:
             if i_rnn not in specify_irnn_list:
                 continue
-        rnn = ru.load_rnn(os.path.join(rnn_folder, rnn_name))
+        rnn = ru.load_rnn(os.path.join(rnn_folder, rnn_name))  # copy, correlation matrix is recomputed inplace
         rnn.eval()
 
         if one_ax:
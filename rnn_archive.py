@@ -0,0 +1,262 @@
+## Archive of all models of one sweep cell (eg models/7525/dmc_task/onehot/sparsity_1e-03/pred_only/),
+## instead of one .data file per seed. The archive is a folder <cell>.rnnarchive/ of shard files:
+## each shard is a zip archive (like rnn_io.py) holding the models of one append() call, with
+##   index.json               names & rnn_io header of each model
+##   stacked/<member>.npy     arrays that all models of the shard have with equal shape (weights, loss
+##                            curves, decoding scores etc.), stacked with model as first axis
+##   models/<name>/<member>   arrays of single models that could not be stacked, and pickled attributes
+## Shards are never modified: every append() writes a new shard (atomically), so concurrent writers do
+## not interfere. If a model name occurs in multiple shards, the newest shard is used. compact() merges shards.
+## Once a folder is archived (archive_folder(folder, remove_files=True)), paths folder/<name> can still be
+## used with ru.get_list_rnns(), ru.load_rnn() and rnn_io.read_fields().
+
+import numpy as np
+import os, io, json, time, zipfile, glob
+import rnn_io
+import compression
+
+archive_suffix = '.rnnarchive'
+shard_format_name = 'rnn_archive_shard'
+shard_format_version = 1
+_archives = {}  # archive path: RNNArchive, see get_archive()
+
+def get_archive_path(folder):
+    '''Path of archive of (sweep cell) folder.'''
+    return os.path.normpath(folder) + archive_suffix
+
+def get_archive(archive_path):
+    '''RNNArchive of archive_path, shared between calls so that its shard indices are only read once.'''
+    archive_path = os.path.normpath(archive_path)
+    if archive_path not in _archives.keys():
+        _archives[archive_path] = RNNArchive(archive_path=archive_path)
+    return _archives[archive_path]
+
+def find_archived(path):
+    '''(archive path, model name) if path is not a file but is stored in the archive of its folder, else None.'''
+    folder, name = os.path.split(os.path.normpath(path))
+    archive_path = get_archive_path(folder)
+    if os.path.exists(path) or not os.path.isdir(archive_path):
+        return None
+    return archive_path, name
+
+def _read_encoded(path):
+    '''Header, arrays & pickled bytes (see rnn_io.encode_model()) of model file path, without
+    reconstructing the model if it is in the structured format.'''
+    if not rnn_io.is_structured(path=path):
+        return rnn_io.encode_model(rnn=rnn_io.load_model(path=path))
+    with zipfile.ZipFile(path, mode='r') as zip_file:
+        header = rnn_io.decode_header(header_bytes=zip_file.read('header.json'), path=path)
+        pickled = {member: rnn_io.ZipSource(zip_file=zip_file).read_bytes(member=member) for member in header['pickled'].values()}
+        arrays = {member: rnn_io.ZipSource(zip_file=zip_file).read_array(member=member) for member in zip_file.namelist()
+                  if member != 'header.json' and member not in pickled.keys()}
+    return header, arrays, pickled
+
+
+class ShardSource():
+    def __init__(self, zip_file, index, name, stacked_cache=None):
+        '''Members of model name in shard (open zipfile.ZipFile with index), see rnn_io.ZipSource.
+        Stacked arrays are kept in stacked_cache (dict), which can be shared by sources of the same shard.'''
+        self.zip_file = zip_file
+        self.name = name
+        self.i_model = index['names'].index(name)
+        self.stacked = set(index['stacked'])
+        self.stacked_cache = {} if stacked_cache is None else stacked_cache
+
+    def read_bytes(self, member):
+        return self.zip_file.read(f'models/{self.name}/{member}')
+
+    def read_array(self, member):
+        if member in self.stacked:
+            if member not in self.stacked_cache.keys():
+                self.stacked_cache[member] = rnn_io.ZipSource(zip_file=self.zip_file).read_array(member=f'stacked/{member}')
+            return self.stacked_cache[member][self.i_model]
+        return np.load(io.BytesIO(self.read_bytes(member=member)), allow_pickle=False)
+
+
+class RNNArchive():
+    def __init__(self, archive_path):
+        '''Archive of models in folder archive_path (see get_archive_path()).'''
+        self.archive_path = archive_path
+        self._shard_indices = {}  # shards are never modified, so their indices can be kept
+        self._model_shards = (None, {})  # (mtime of archive folder, get_model_shards()), see get_model_shards()
+
+    def __repr__(self):
+        return f'RNN archive {self.archive_path} ({len(self.list_models())} models in {len(self.list_shards())} shards)'
+
+    def list_shards(self):
+        '''Shard files, oldest first.'''
+        if not os.path.isdir(self.archive_path):
+            return []
+        return sorted(os.path.basename(x) for x in glob.glob(os.path.join(self.archive_path, 'shard-*.zip')))
+
+    def get_shard_index(self, shard):
+        if shard not in self._shard_indices.keys():
+            with zipfile.ZipFile(os.path.join(self.archive_path, shard), mode='r') as zip_file:
+                index = json.loads(zip_file.read('index.json'), object_hook=rnn_io._json_object_hook)
+            assert index['format'] == shard_format_name, f'{shard} is not an archive shard'
+            assert index['format_version'] <= shard_format_version, f'{shard} has format version {index["format_version"]}, please update rnn_archive.py'
+            self._shard_indices[shard] = index
+        return self._shard_indices[shard]
+
+    def get_model_shards(self):
+        '''Dict of model name: shard (newest shard that has the model). Kept until the mtime of the archive
+        folder changes, which happens when shards are added or removed (by any process).'''
+        try:
+            mtime = os.stat(self.archive_path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime is None or mtime != self._model_shards[0]:
+            list_shards = self.list_shards()
+            self._shard_indices = {shard: index for shard, index in self._shard_indices.items() if shard in list_shards}  # drop removed shards
+            model_shards = {name: shard for shard in list_shards for name in self.get_shard_index(shard=shard)['names']}
+            self._model_shards = (mtime, model_shards)
+        return dict(self._model_shards[1])
+
+    def list_models(self):
+        return sorted(self.get_model_shards().keys())
+
+    def get_shard_path(self, name):
+        model_shards = self.get_model_shards()
+        assert name in model_shards.keys(), f'{name} not in {self}'
+        return os.path.join(self.archive_path, model_shards[name])
+
+    def _write_shard(self, encoded_models, timestamp=None):
+        '''Write new shard with encoded_models (dict of name: (header, arrays, pickled)). Returns shard name.'''
+        names = list(encoded_models.keys())
+        assert len(names) > 0, 'no models to write'
+        members = [set(encoded_models[name][1].keys()) for name in names]
+        stacked = []
+        for member in sorted(set.intersection(*members)):  # stack if equal shape & dtype in all models
+            shapes = set((encoded_models[name][1][member].shape, encoded_models[name][1][member].dtype.str) for name in names)
+            if len(shapes) == 1:
+                stacked.append(member)
+        index = {'format': shard_format_name, 'format_version': shard_format_version, 'names': names,
+                 'headers': {name: encoded_models[name][0] for name in names}, 'stacked': stacked}
+        if timestamp is None:
+            timestamp = f'{time.time_ns():020d}'
+        shard = f'shard-{timestamp}-{os.getpid()}-{np.random.randint(int(1e9)):09d}.zip'
+        os.makedirs(self.archive_path, exist_ok=True)
+        tmp_path = os.path.join(self.archive_path, '.tmp_' + shard)
+        try:
+            with zipfile.ZipFile(tmp_path, mode='w', compression=zipfile.ZIP_STORED) as zip_file:
+                zip_file.writestr('index.json', json.dumps(index, default=rnn_io._json_default))
+                for member in stacked:
+                    zip_file.writestr(f'stacked/{member}', compression.save_array_bytes(
+                                      arr=np.stack([encoded_models[name][1][member] for name in names])))
+                for name in names:
+                    header, arrays, pickled = encoded_models[name]
+                    for member, arr in arrays.items():
+                        if member not in stacked:
+                            zip_file.writestr(f'models/{name}/{member}', compression.save_array_bytes(arr=arr))
+                    for member, pickle_bytes in pickled.items():
+                        zip_file.writestr(f'models/{name}/{member}', pickle_bytes)
+            os.replace(tmp_path, os.path.join(self.archive_path, shard))  # atomic, so readers never see half a shard
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return shard
+
+    def append(self, rnns):
+        '''Add torch models rnns (list, named by their file_name) as a new shard. Returns shard name.'''
+        encoded_models = {}
+        for rnn in rnns:
+            assert rnn.file_name is not None, f'{rnn} has no file name, save it first'
+            encoded_models[rnn.file_name] = rnn_io.encode_model(rnn=rnn)
+        return self._write_shard(encoded_models=encoded_models)
+
+    def append_files(self, paths):
+        '''Add model files paths (structured or pickled) as a new shard. Returns shard name.'''
+        return self._write_shard(encoded_models={os.path.basename(path): _read_encoded(path=path) for path in paths})
+
+    def _read(self, name, function):
+        '''function(source, header) of model name.'''
+        for i_try in range(2):
+            try:
+                shard_path = self.get_shard_path(name=name)
+                with zipfile.ZipFile(shard_path, mode='r') as zip_file:
+                    index = self.get_shard_index(shard=os.path.basename(shard_path))
+                    return function(ShardSource(zip_file=zip_file, index=index, name=name), index['headers'][name])
+            except FileNotFoundError:  # shard removed by compact() in the mean time, look again
+                if i_try == 1:
+                    raise
+
+    def read_header(self, name):
+        return self._read(name=name, function=lambda source, header: header)
+
+    def read_fields(self, name, fields):
+        '''Fields of model name, see rnn_io.read_fields().'''
+        return self._read(name=name, function=lambda source, header: {field: rnn_io.read_field(
+                            source=source, header=header, field=field, path=os.path.join(self.archive_path, name)) for field in fields})
+
+    def load_model(self, name):
+        '''Reconstruct torch model name.'''
+        return self._read(name=name, function=lambda source, header: rnn_io.build_model(source=source, header=header))
+
+    def read_stacked(self, member):
+        '''Array member (eg 'weights/lin_input.weight.npy', 'losses/test_loss_split/pred.npy') of all
+        models, stacked with model as first axis (in order of list_models()).'''
+        model_shards = self.get_model_shards()
+        names = sorted(model_shards.keys())
+        arrays = {}
+        for shard in sorted(set(model_shards.values())):
+            index = self.get_shard_index(shard=shard)
+            shard_names = [name for name in index['names'] if model_shards[name] == shard]
+            with zipfile.ZipFile(os.path.join(self.archive_path, shard), mode='r') as zip_file:
+                if member in index['stacked']:
+                    stacked_arr = rnn_io.ZipSource(zip_file=zip_file).read_array(member=f'stacked/{member}')
+                    arrays.update({name: stacked_arr[index['names'].index(name)] for name in shard_names})
+                else:
+                    arrays.update({name: ShardSource(zip_file=zip_file, index=index, name=name).read_array(member=member)
+                                   for name in shard_names})
+        return np.stack([arrays[name] for name in names])
+
+    def compact(self):
+        '''Merge all shards into one. Returns the new shard name.'''
+        list_shards = self.list_shards()
+        if len(list_shards) < 2:
+            return None
+        model_shards = self.get_model_shards()
+        stacked_caches = {shard: {} for shard in list_shards}
+        encoded_models = {}
+        for name in sorted(model_shards.keys()):
+            with zipfile.ZipFile(os.path.join(self.archive_path, model_shards[name]), mode='r') as zip_file:
+                index = self.get_shard_index(shard=model_shards[name])
+                source = ShardSource(zip_file=zip_file, index=index, name=name, stacked_cache=stacked_caches[model_shards[name]])
+                header = index['headers'][name]
+                pickled = {member: source.read_bytes(member=member) for member in header['pickled'].values()}
+                members = index['stacked'] + [x[len(f'models/{name}/'):] for x in zip_file.namelist()
+                                                           if x.startswith(f'models/{name}/')]
+                arrays = {member: source.read_array(member=member) for member in members if member not in pickled.keys()}
+                encoded_models[name] = (header, arrays, pickled)
+        shard = self._write_shard(encoded_models=encoded_models, timestamp=list_shards[-1].split('-')[1])  # same age as newest merged shard, so newer shards still win
+        for old_shard in list_shards:
+            os.remove(os.path.join(self.archive_path, old_shard))
+            self._shard_indices.pop(old_shard, None)
+        return shard
+
+def archive_folder(folder, remove_files=False):
+    '''Add all model files (.data) of folder to its archive (one new shard). If remove_files, delete
+    the files (and folder if empty) afterwards. Returns the archive.'''
+    list_paths = sorted(os.path.join(folder, x) for x in os.listdir(folder) if x[-5:] == '.data' and x[:5] != '.tmp_')
+    archive = get_archive(archive_path=get_archive_path(folder))
+    if len(list_paths) > 0:
+        archive.append_files(paths=list_paths)
+    if remove_files:
+        for path in list_paths:
+            os.remove(path)
+        if len(os.listdir(folder)) == 0:
+            os.rmdir(folder)
+    return archive
+
+def load_archived(path):
+    '''Load model path (folder/name) from the archive of folder.'''
+    archived = find_archived(path=path)
+    assert archived is not None, f'{path} does not exist'
+    return get_archive(archive_path=archived[0]).load_model(name=archived[1])
+
+def read_fields_archived(path, fields):
+    '''read_fields() of model path (folder/name) from the archive of folder.'''
+    archived = find_archived(path=path)
+    assert archived is not None, f'{path} does not exist'
+    return get_archive(archive_path=archived[0]).read_fields(name=archived[1], fields=fields)
@@ -0,0 +1,404 @@
+## Structured model file format, replacing the pickle of the whole RNN object.
+## A model file is a zip archive of:
+##   header.json          format version, class, layer shapes, info_dict, names, git commit & all other small attributes
+##   weights/<param>.npy  state_dict of the network
+##   losses/<attr>/...    loss histories (train_loss_arr, test_loss_split etc.)
+##   analysis/<attr>/...  analysis results (decoding scores, decoders, saved states etc.), one folder per attribute
+##   pickled/<attr>.pkl   any attribute that cannot be stored as json or arrays
+## Every section or field can be read on its own with numpy only (read_header(), read_fields()); load_model()
+## reconstructs the network (and reads old pickled model files and archived models too).
+## Decoders are stored by their parameters and loaded as the decoder type that decoder_store.py registers
+## (StoredDecoder, see register_decoder_type()).
+## Members can be compressed (zip deflate, or zstd/lz4 frames, see compression.py); header.json never is.
+
+import numpy as np
+import os, io, json, zipfile, pickle, datetime, importlib, tempfile, shutil, errno, uuid, copy, threading
+import compression
+
+format_name = 'rnn_model'
+format_version = 1
+zip_magic = b'PK\x03\x04'
+loss_attributes = ['train_loss_arr', 'test_loss_arr', 'test_loss_ratio_reg', 'test_loss_ratio_ce', 'test_loss_split']
+skip_attributes = ['training', '__git_repo__']  # torch train/eval flag (models are loaded in eval mode) & git.Repo object
+_umask_lock = threading.Lock()
+_decoder_type = None  # (class, attributes) of stored decoders, see register_decoder_type()
+
+def register_decoder_type(decoder_class, attributes):
+    '''Dicts of decoders (per time point) are saved by their attributes (if all decoders have them) and
+    loaded as decoder_class(arrays=arrays, i_time=i_time). Called by decoder_store.py.'''
+    global _decoder_type
+    _decoder_type = (decoder_class, list(attributes))
+
+def _get_decoder_type():
+    if _decoder_type is None:
+        importlib.import_module('decoder_store')  # registers StoredDecoder
+    return _decoder_type
+
+def get_umask():
+    '''Current umask of this process (from /proc on Linux, else by setting and resetting it).'''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+    except OSError:
+        pass
+    with _umask_lock:  # os.umask() can only be read by setting it
+        umask = os.umask(0)
+        os.umask(umask)
+    return umask
+
+def is_structured(path):
+    '''Whether model file path is in the structured (zip) format, as opposed to a pickle.'''
+    with open(path, 'rb') as f:
+        return f.read(len(zip_magic)) == zip_magic
+
+def _json_default(obj):
+    if isinstance(obj, datetime.datetime):
+        return {'__datetime__': obj.isoformat()}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f'{type(obj)} is not json serialisable')
+
+def _json_object_hook(obj):
+    if len(obj) == 1 and '__datetime__' in obj:
+        return datetime.datetime.fromisoformat(obj['__datetime__'])
+    return obj
+
+def _to_json(value):
+    '''Json string of value, or None if value does not survive a json round trip unchanged.'''
+    try:
+        json_str = json.dumps(value, default=_json_default)
+        if json.loads(json_str, object_hook=_json_object_hook) == value:
+            return json_str
+    except (TypeError, ValueError):
+        pass
+    return None
+
+def _is_storable(arr):
+    return arr.dtype.kind in 'biufU'
+
+def _is_decoder(obj):
+    return hasattr(obj, 'coef_') or hasattr(obj, 'means_')
+
+def _encode(value, member, arrays):
+    '''Spec (json-able dict) to decode value from zip members, which are added to arrays
+    (dict of member name: array). Returns None if value cannot be stored as arrays.'''
+    if hasattr(value, 'detach'):  # torch tensor
+        arrays[member + '.npy'] = value.detach().cpu().numpy()
+        return {'type': 'tensor', 'member': member + '.npy'}
+    if isinstance(value, np.ndarray) and _is_storable(value):
+        arrays[member + '.npy'] = value
+        return {'type': 'array', 'member': member + '.npy'}
+    if isinstance(value, list) and np.all([isinstance(x, (int, float, np.number)) and not isinstance(x, bool) for x in value]):
+        arrays[member + '.npy'] = np.array(value)
+        return {'type': 'list', 'member': member + '.npy'}
+    if not isinstance(value, dict) or len(value) == 0:
+        return None
+    keys = list(value.keys())
+    if not np.all([isinstance(k, (str, int)) and not isinstance(k, bool) for k in keys]) or len(set(str(k) for k in keys)) < len(keys):
+        return None
+    if np.all([_is_decoder(v) for v in value.values()]):  # dict of decoders per time point, stacked like decoder_store.py
+        class_names = list(set(type(v).__name__ for v in value.values()))
+        spec = {'type': 'decoders', 'keys': keys, 'decoder_type': class_names[0] if len(class_names) == 1 else 'mixed', 'members': {}}
+        for attr in _get_decoder_type()[1]:
+            if np.all([hasattr(v, attr) for v in value.values()]):
+                try:
+                    arr = np.stack([np.asarray(getattr(value[k], attr)) for k in keys])
+                except ValueError:  # different shapes
+                    return None
+                if not _is_storable(arr):
+                    return None
+                arrays[f'{member}/{attr}.npy'] = arr
+                spec['members'][attr] = f'{member}/{attr}.npy'
+        return spec
+    items = []
+    for k in keys:
+        item_spec = _encode(value=value[k], member=f'{member}/{k}', arrays=arrays)
+        if item_spec is None:
+            return None
+        items.append(item_spec)
+    return {'type': 'dict', 'keys': keys, 'items': items}
+
+class ZipSource():
+    def __init__(self, zip_file):
+        '''Members of a structured model file (open zipfile.ZipFile). Other containers (see rnn_archive.py)
+        implement the same read_array() and read_bytes().'''
+        self.zip_file = zip_file
+
+    def read_bytes(self, member):
+        return compression.decompress(self.zip_file.read(member))
+
+    def read_array(self, member):
+        with self.zip_file.open(member) as f:
+            return compression.load_array(file_obj=f)  # decompressed while reading
+
+def _decode(spec, source):
+    '''Inverse of _encode(); tensors are returned as arrays.'''
+    if spec['type'] in ['tensor', 'array']:
+        return source.read_array(member=spec['member'])
+    if spec['type'] == 'list':
+        return source.read_array(member=spec['member']).tolist()
+    if spec['type'] == 'dict':
+        return {k: _decode(spec=item_spec, source=source) for k, item_spec in zip(spec['keys'], spec['items'])}
+    if spec['type'] == 'decoders':
+        arrays = {attr: source.read_array(member=member) for attr, member in spec['members'].items()}
+        arrays['decoder_type'] = np.array(spec['decoder_type'])
+        decoder_class = _get_decoder_type()[0]
+        return {k: decoder_class(arrays=arrays, i_time=i_k) for i_k, k in enumerate(spec['keys'])}
+    assert False, f'section type {spec["type"]} not recognised'
+
+def _get_model_attributes(rnn):
+    '''Attributes of rnn, except torch.nn.Module internals (parameters are saved via the state_dict).'''
+    mangled_prefixes = tuple(f'_{cls.__name__}__' for cls in type(rnn).__mro__)  # private attributes like __datetime_created
+    return {key: val for key, val in rnn.__dict__.items() if key not in skip_attributes and
+            (key[0] != '_' or key.startswith(mangled_prefixes) or (key[:2] == '__' and key[-2:] == '__'))}
+
+def encode_model(rnn):
+    '''Encode torch model rnn (RNN_MTL, RNN or RNN_MNM) as header (json-able dict), arrays (dict of
+    member name: array) and pickled (dict of member name: bytes), see write_model().'''
+    header = {'format': format_name, 'format_version': format_version,
+              'class': {'module': type(rnn).__module__, 'name': type(rnn).__name__},
+              'modules': {}, 'weights': {}, 'attributes': {}, 'sections': {}, 'pickled': {}}
+    arrays = {}
+    for name, module in rnn._modules.items():
+        assert type(module).__name__ == 'Linear', f'layer {name} of type {type(module)} not implemented'
+        header['modules'][name] = {'type': 'Linear', 'in_features': module.in_features,
+                                   'out_features': module.out_features, 'bias': module.bias is not None}
+    for name, param in rnn.state_dict().items():
+        header['weights'][name] = f'weights/{name}.npy'
+        arrays[header['weights'][name]] = param.detach().cpu().numpy()
+    pickled = {}
+    for key, val in _get_model_attributes(rnn).items():
+        if key in loss_attributes or hasattr(val, 'detach') or isinstance(val, np.ndarray) or _to_json(val) is None:  # arrays go in sections
+            spec = _encode(value=val, member=f'{"losses" if key in loss_attributes else "analysis"}/{key}', arrays=arrays)
+            if spec is None:
+                header['pickled'][key] = f'pickled/{key}.pkl'
+                pickled[header['pickled'][key]] = pickle.dumps(val)
+            else:
+                header['sections'][key] = spec
+        else:
+            header['attributes'][key] = val
+    return header, arrays, pickled
+
+def snapshot_model(rnn):
+    '''encode_model() of rnn with copies of all arrays (which otherwise share memory with the tensors), so
+    that it can be written, eg in another thread, while rnn keeps changing.'''
+    header, arrays, pickled = encode_model(rnn=rnn)
+    return copy.deepcopy(header), {member: np.array(arr, copy=True) for member, arr in arrays.items()}, pickled
+
+def write_encoded(header, arrays, pickled, file_handle, codec=None, level=None):
+    '''Write encoded model (see encode_model()) to open binary file_handle. Members are compressed with codec
+    (None, 'zlib' (zip deflate), 'zstd', 'lz4' or 'default') at level, see compression.py.'''
+    codec = compression.resolve_codec(codec)
+    zip_kwargs = {'compression': zipfile.ZIP_STORED}
+    if codec == 'zlib':  # by zipfile itself
+        zip_kwargs = {'compression': zipfile.ZIP_DEFLATED, 'compresslevel': compression.get_level(codec=codec, level=level)}
+        codec = None
+    with zipfile.ZipFile(file_handle, mode='w', **zip_kwargs) as zip_file:
+        zip_file.writestr('header.json', json.dumps(header, default=_json_default, indent=1))
+        for member, arr in arrays.items():
+            zip_file.writestr(member, compression.save_array_bytes(arr=arr, codec=codec, level=level))
+        for member, pickle_bytes in pickled.items():
+            zip_file.writestr(member, compression.compress(data=pickle_bytes, codec=codec, level=level))
+
+def write_model(rnn, file_handle, codec=None, level=None):
+    '''Write torch model rnn (RNN_MTL, RNN or RNN_MNM) in the structured format to open binary file_handle,
+    with members compressed with codec at level (see write_encoded()).'''
+    header, arrays, pickled = encode_model(rnn=rnn)
+    write_encoded(header=header, arrays=arrays, pickled=pickled, file_handle=file_handle, codec=codec, level=level)
+
+def decode_header(header_bytes, path):
+    header = json.loads(header_bytes, object_hook=_json_object_hook)
+    assert header['format'] == format_name, f'{path} is not a model file'
+    assert header['format_version'] <= format_version, f'{path} has format version {header["format_version"]}, please update rnn_io.py (version {format_version})'
+    return header
+
+def read_header(path):
+    '''Header dict of structured model file path (info_dict, names etc. are in header['attributes']).'''
+    with zipfile.ZipFile(path, mode='r') as zip_file:
+        return decode_header(header_bytes=zip_file.read('header.json'), path=path)
+
+def _get_item(dict_value, key, field, path):
+    '''dict_value[key], where key is the str of the (str or int) dictionary key.'''
+    for k in dict_value.keys():
+        if str(k) == key:
+            return dict_value[k]
+    assert False, f'{field} not in {path}. Keys: {list(dict_value.keys())}'
+
+def read_field(source, header, field, path):
+    '''Read field (see read_fields()) of the model with header from source (eg ZipSource).'''
+    name, _, key = field.partition('.')  # key may contain dots itself (weights.lin_input.weight)
+    if name == 'weights':
+        members = header['weights'] if key == '' else {key: _get_item(dict_value=header['weights'], key=key, field=field, path=path)}
+        arrays = {param: source.read_array(member=member) for param, member in members.items()}
+        return arrays if key == '' else arrays[key]
+    if name in header['attributes'].keys():
+        value = header['attributes'][name]
+    elif name in header['pickled'].keys():
+        value = pickle.loads(source.read_bytes(member=header['pickled'][name]))
+    else:
+        assert name in header['sections'].keys(), f'{name} not in {path}'
+        spec = header['sections'][name]
+        if key != '' and spec['type'] == 'dict':  # only read the requested item
+            item_spec = _get_item(dict_value=dict(zip(spec['keys'], spec['items'])), key=key, field=field, path=path)
+            return _decode(spec=item_spec, source=source)
+        value = _decode(spec=spec, source=source)
+    return value if key == '' else _get_item(dict_value=value, key=key, field=field, path=path)
+
+def _read_fields_pickle(path, fields):
+    '''read_fields() for old pickled model files, by loading the whole model.'''
+    rnn = load_model(path=path)
+    values = {}
+    for field in fields:
+        name, _, key = field.partition('.')
+        if name == 'weights':
+            value = {param: arr.detach().cpu().numpy() for param, arr in rnn.state_dict().items()}
+        else:
+            assert hasattr(rnn, name), f'{name} not in {path}'
+            value = getattr(rnn, name)
+        if key != '':
+            value = _get_item(dict_value=value, key=key, field=field, path=path)
+        values[field] = value.detach().cpu().numpy() if hasattr(value, 'detach') else value
+    return values
+
+def read_fields(path, fields):
+    '''Read only the given fields of model file path, without reconstructing the model (no torch needed
+    for structured files; old pickles are loaded completely). A field is an attribute name (eg 'info_dict',
+    'test_loss_arr'), an item of an attribute dictionary (eg 'info_dict.n_epochs', 'test_loss_split.pred'),
+    'weights' (state_dict as arrays) or a single parameter (eg 'weights.lin_input.weight').
+
+    Returns
+    -------
+    values : dict
+        value per field (tensors as arrays).
+    '''
+    if not os.path.exists(path):  # model of an archived folder
+        import rnn_archive
+        return rnn_archive.read_fields_archived(path=path, fields=fields)
+    if not is_structured(path=path):
+        return _read_fields_pickle(path=path, fields=fields)
+    with zipfile.ZipFile(path, mode='r') as zip_file:
+        header = decode_header(header_bytes=zip_file.read('header.json'), path=path)
+        return {field: read_field(source=ZipSource(zip_file=zip_file), header=header, field=field, path=path) for field in fields}
+
+def read_section(path, section):
+    '''Read one section of model file path: 'weights' (state_dict as arrays), or the name of an
+    attribute (eg 'test_loss_split', 'decoding_crosstemp_score'). See read_fields().'''
+    return read_fields(path=path, fields=[section])[section]
+
+def build_model(source, header):
+    '''Reconstruct torch model with header from source (eg ZipSource).'''
+    import torch  # only needed for reconstructing the model, not for reading sections
+    model_class = getattr(importlib.import_module(header['class']['module']), header['class']['name'])
+    rnn = model_class.__new__(model_class)  # no __init__(), which needs a git repository
+    torch.nn.Module.__init__(rnn)
+    for name, module_dict in header['modules'].items():
+        setattr(rnn, name, torch.nn.Linear(module_dict['in_features'], module_dict['out_features'], bias=module_dict['bias']))
+    rnn.load_state_dict({name: torch.from_numpy(source.read_array(member=member))
+                         for name, member in header['weights'].items()})
+    for key, val in header['attributes'].items():
+        setattr(rnn, key, val)
+    for key, spec in header['sections'].items():
+        val = _decode(spec=spec, source=source)
+        setattr(rnn, key, torch.from_numpy(val) if spec['type'] == 'tensor' else val)
+    for key, member in header['pickled'].items():
+        setattr(rnn, key, pickle.loads(source.read_bytes(member=member)))
+    if 'saved_states_dict' in header['sections'].keys():  # state dicts of torch tensors
+        rnn.saved_states_dict = {epoch: {name: torch.from_numpy(arr) for name, arr in state.items()}
+                                 for epoch, state in rnn.saved_states_dict.items()}
+    rnn.__git_repo__ = None
+    return rnn
+
+def load_structured(path):
+    '''Reconstruct torch model from structured model file path.'''
+    with zipfile.ZipFile(path, mode='r') as zip_file:
+        header = decode_header(header_bytes=zip_file.read('header.json'), path=path)
+        return build_model(source=ZipSource(zip_file=zip_file), header=header)
+
+def load_model(path):
+    '''Load model file path, either structured or (old) pickled, or from the archive of its folder (see rnn_archive.py).'''
+    if not os.path.exists(path):
+        import rnn_archive  # imports rnn_io
+        return rnn_archive.load_archived(path=path)
+    if is_structured(path=path):
+        return load_structured(path=path)
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def load_model_bytes(data, path=''):
+    '''Load model from the bytes data of a model file (structured or pickled), eg read ahead by model_prefetch.py.
+    path is only used in error messages.'''
+    if data[:len(zip_magic)] == zip_magic:
+        with zipfile.ZipFile(io.BytesIO(data), mode='r') as zip_file:
+            header = decode_header(header_bytes=zip_file.read('header.json'), path=path)
+            return build_model(source=ZipSource(zip_file=zip_file), header=header)
+    return pickle.loads(data)
+
+def get_unique_suffix():
+    '''Random suffix for model file names (eg rnn-mnm_2021-05-17-1318_3fa9c2d1.data) that collide with an existing file.'''
+    return '_' + uuid.uuid4().hex[:8]
+
+def write_atomic(path, write_function, exclusive=False, fsync=False):
+    '''Write file path with write_function(file_handle) to a temporary file in the same folder first, which
+    then replaces path in one step, so that path is never partially written. If exclusive, path is only
+    created if it does not exist yet (atomically, also between processes): returns False (and writes
+    nothing) if it does. If fsync, the data are flushed to disk before the file gets its name.
+    Returns True if written.'''
+    folder = os.path.dirname(os.path.abspath(path))
+    file_handle = tempfile.NamedTemporaryFile(dir=folder, prefix='.tmp_', suffix='.tmp', delete=False)
+    try:
+        with file_handle:
+            write_function(file_handle)
+            if fsync:
+                file_handle.flush()
+                os.fsync(file_handle.fileno())
+        os.chmod(file_handle.name, 0o666 & ~get_umask())  # same permissions as open()
+        if not exclusive:
+            os.replace(file_handle.name, path)
+            return True
+        try:
+            os.link(file_handle.name, path)  # fails if path exists
+        except FileExistsError:
+            return False
+        except OSError as e:  # file system without hard links: reserve name (O_EXCL), then replace
+            if e.errno not in [errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EXDEV]:
+                raise
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+            except FileExistsError:
+                return False
+            os.replace(file_handle.name, path)
+        return True
+    finally:
+        if os.path.exists(file_handle.name):
+            os.remove(file_handle.name)
+
+def write_unique(path, write_function, fsync=False):
+    '''Create new file path with write_function(file_handle, path) (see write_atomic()). If path exists, a random
+    suffix (see get_unique_suffix()) is added to the file name. write_function gets the final path, eg to store
+    it in the file. Returns the path that was written.'''
+    base, ext = os.path.splitext(path)
+    while not write_atomic(path=path, write_function=lambda file_handle: write_function(file_handle, path),
+                           exclusive=True, fsync=fsync):
+        path = base + get_unique_suffix() + ext
+    return path
+
+def convert_to_structured(path):
+    '''Rewrite old pickled model file path in the structured format (in place, atomically), so that
+    read_fields() does not need to unpickle it. Returns True if converted, False if already structured.'''
+    if is_structured(path=path):
+        return False
+    rnn = load_model(path=path)
+    folder = os.path.dirname(os.path.abspath(path))
+    file_handle = tempfile.NamedTemporaryFile(dir=folder, prefix='.tmp_', suffix='.tmp', delete=False)
+    try:
+        with file_handle:
+            write_model(rnn=rnn, file_handle=file_handle)
+        shutil.copymode(path, file_handle.name)
+        os.replace(file_handle.name, path)
+    except BaseException:
+        if os.path.exists(file_handle.name):
+            os.remove(file_handle.name)
+        raise
+    return True
@@ -8,9 +8,15 @@
 
 
 import numpy as np
-import pickle, os
+import os, copy
 import pandas as pd
 import bptt_rnn_mtl as bpm
+import rnn_io
+import model_catalog
+import rnn_archive
+import loss_store
+import model_cache
+import model_prefetch
 from tqdm import tqdm
 
 def angle_vecs(v1, v2):
@@ -186,13 +192,85 @@ def rmse_matrix_symm(matrix, subtract=0.5):
     low_tri_sum /= n_el
     return (rmse, low_tri_sum)
 
-def load_rnn(rnn_name):
-    """Load RNN"""
-    with open(rnn_name, 'rb') as f:
-        rnn = pickle.load(f)
+def get_rng(rng=None):
+    """Return rng if given, else a np.random.Generator seeded from the global np.random state
+    (so that np.random.seed() still controls the result)."""
+    if rng is None:
+        rng = np.random.default_rng(np.random.randint(np.iinfo(np.int32).max))
+    return rng
+
+def stratified_split(labels, ratio_train=0.8, rng=None):
+    """Stratified random train/test split of trial indices (one split only).
+
+    Vectorised replacement of sklearn.model_selection.StratifiedShuffleSplit(n_splits=1).
+    The number of train trials per class is allocated the same way as sklearn: the floor of
+    the proportional share of int(ratio_train * n_trials), with the remaining trials going to
+    the classes with the largest remainder (ties broken at random).
+
+    Parameters
+    ----------
+    labels : np.array
+        label per trial (anything np.unique can sort, eg object array of str).
+    ratio_train : float, default: 0.8
+        fraction of trials in the train set.
+    rng : np.random.Generator, optional
+        random generator. If None, one is seeded from the global np.random state.
+
+    Returns
+    -------
+    train_inds : np.array of int
+        shuffled train trial indices.
+    test_inds : np.array of int
+        shuffled test trial indices.
+    """
+    assert ratio_train <= 1 and ratio_train >= 0
+    rng = get_rng(rng=rng)
+    labels = np.asarray(labels)
+    if labels.dtype == object:  # sorting fixed-width str is much faster than python objects
+        labels = labels.astype(str)
+    classes, label_codes = np.unique(labels, return_inverse=True)  # integer code per trial
+    label_codes = label_codes.ravel()
+    n_trials = len(label_codes)
+    n_train = int(ratio_train * n_trials)
+
+    ## Number of train trials per class (sklearn's _approximate_mode):
+    class_counts = np.bincount(label_codes, minlength=len(classes))
+    continuous = class_counts / n_trials * n_train
+    n_train_class = np.floor(continuous).astype(int)
+    n_left = n_train - n_train_class.sum()
+    if n_left > 0:  # give one extra trial to the classes with largest remainder, random tie break
+        order_remainder = np.lexsort((rng.random(len(classes)), -1 * (continuous - n_train_class)))
+        n_train_class[order_remainder[:n_left]] += 1
+
+    ## Random permutation within each class, first n_train_class of each class go to train:
+    order = np.lexsort((rng.random(n_trials), label_codes))  # grouped by class, shuffled within
+    codes_sorted = label_codes[order]
+    class_start = np.concatenate(([0], np.cumsum(class_counts)[:-1]))
+    rank_in_class = np.arange(n_trials) - class_start[codes_sorted]
+    bool_train = rank_in_class < n_train_class[codes_sorted]
+    train_inds = rng.permutation(order[bool_train])
+    test_inds = rng.permutation(order[np.logical_not(bool_train)])
+    return train_inds, test_inds
+
+def load_rnn(rnn_name, use_cache=True, shared=False):
+    """Load RNN from file rnn_name (structured format or old pickle, see rnn_io.py). If use_cache, models
+    are kept in memory (see model_cache.py) and a copy of the cached model is returned. If shared, the cached
+    model itself is returned, which must not be changed (no load_state_dict(), forward runs, save_pearson_corr())."""
+    rnn = model_cache.load_model(path=rnn_name, shared=shared) if use_cache else rnn_io.load_model(path=rnn_name)
     rnn.eval()
     return rnn
 
+def iter_rnns(rnn_folder, list_rnns=None, readahead=model_prefetch.default_readahead, use_cache=True, shared=False):
+    """Yield (rnn_name, rnn) for all rnns in list_rnns (default get_list_rnns(rnn_folder)), loaded as load_rnn()
+    while the next readahead files are read in the background (see model_prefetch.py). Use shared=True for
+    read-only loops (eg reading decoding scores), to skip copying cached models."""
+    if list_rnns is None:
+        list_rnns = get_list_rnns(rnn_folder=rnn_folder)
+    for rnn_name, (_, rnn) in zip(list_rnns, model_prefetch.iter_models(paths=[os.path.join(rnn_folder, x) for x in list_rnns],
+                                                                        readahead=readahead, use_cache=use_cache, shared=shared)):
+        rnn.eval()
+        yield rnn_name, rnn
+
 def make_df_network_size(rnn_folder):
     """OLD"""
     assert False, 'check if function still ok'
@@ -219,11 +297,17 @@ def labels_to_mnm(labels):
         match_array[:, 1] = np.logical_not(match_array[:, 0])
         return match_array
 
-def get_train_test_diag():
-    assert False, 'check if function still ok'
-    tmp_train, tmp_test = (np.array([8, 9, 10, 9, 10, 11, 10, 11, 12, 11, 12, 13, 12, 13, 14, 13, 14, 15, 14, 15, 16, 15, 16, 16]),
-                           np.array([4, 4, 4, 5, 5, 5, 6, 6, 6, 7, 7, 7, 8, 8, 8, 9, 9, 9, 10, 10, 10, 11, 11, 12]))
-    return (tmp_train, tmp_test)
+def get_train_test_diag(offsets=(4, 5, 6), test_start=4, n_times=17):
+    """Indices (train times, test times) of an off-diagonal band of a cross-temporal score matrix:
+    decoders trained at test time + offset, for test times from test_start (within n_times).
+    The default is the band used for the summary accuracy of the (17 time point) alpha decoders."""
+    train_times, test_times = [], []
+    for test_time in range(test_start, n_times):
+        for offset in offsets:
+            if test_time + offset < n_times:
+                train_times.append(test_time + offset)
+                test_times.append(test_time)
+    return (np.array(train_times), np.array(test_times))
 
 def rotation_index(mat, times_early=[4], times_late=[6]):
     assert False, 'check if function still ok'
@@ -316,19 +400,30 @@ def timestamp_min_date(rnn_name, date_min='2021-05-17', verbose=0):
             else:
                 return True
 
-def get_list_rnns(rnn_folder='',max_date_bool=True, verbose=0):
-    """Get list of rnns in folder, and possibly take timestamp into account"""
+def get_list_rnns(rnn_folder='',max_date_bool=True, verbose=0, use_catalog=True):
+    """Get list of rnns in folder (including archived ones, see rnn_archive.py), and possibly take timestamp into
+    account. If use_catalog, the model catalog is used if set (see model_catalog.set_default_catalog()); the
+    folder is rescanned first if files were added or removed since its last scan."""
     if verbose:
         print(f'get list rnns max date is {max_date_bool}')
         print(f'Folder is {rnn_folder}')
+    catalog = model_catalog.get_default_catalog() if use_catalog else None
+    if catalog is not None:
+        if not catalog.is_current(folder=rnn_folder):
+            catalog.rescan_folder(folder=rnn_folder)
+        list_paths = catalog.select(folder=rnn_folder, date_max=('2021-05-17' if max_date_bool else None))
+        return [os.path.basename(x) for x in list_paths]
+    list_files = os.listdir(rnn_folder) if os.path.isdir(rnn_folder) else []
+    archive = rnn_archive.get_archive(archive_path=rnn_archive.get_archive_path(rnn_folder))  # models of archived folder
+    list_files = list_files + [x for x in archive.list_models() if x not in list_files]
     if max_date_bool:
-        list_rnns = [x for x in os.listdir(rnn_folder) if x[-5:] == '.data' and timestamp_max_date(rnn_name=x, date_max='2021-05-17')]
+        list_rnns = [x for x in list_files if x[-5:] == '.data' and timestamp_max_date(rnn_name=x, date_max='2021-05-17')]
     else:
-        list_rnns = [x for x in os.listdir(rnn_folder) if x[-5:] == '.data']
+        list_rnns = [x for x in list_files if x[-5:] == '.data']
     return list_rnns
 
 def compute_learning_index(rnn_folder=None, list_loss=['pred'], normalise_start=False,
-                           method='integral', verbose=0, rnn_max_date_bool=True):
+                           method='integral', verbose=0, rnn_max_date_bool=True, loss_store_use=None):
     """Compute learning index, meaning how well rnns converge. Do for all losses in list_loss.
     methods:
     integral: mean of all data points per rnn
@@ -336,9 +431,15 @@ def compute_learning_index(rnn_folder=None, list_loss=['pred'], normalise_start=
     final_loss: average of final 5 data points
     half_time: time for which np.diff is smallest (ie greatest negative)
     agrmin_gradient:  same but with np.gradient
+    If loss_store_use is a LossStore (see loss_store.py), the loss curves are taken from there instead of the files
+    (asserting that the store is current). Learning indices are in the order of get_list_rnns() in both cases.
     """
     assert normalise_start is False
     list_rnns = get_list_rnns(rnn_folder=rnn_folder, max_date_bool=rnn_max_date_bool)
+    if loss_store_use is not None:
+        assert len(list_rnns) > 0, 'list of rnns is empty'
+        rows = loss_store_use.get_rows(paths=[os.path.join(rnn_folder, x) for x in list_rnns])
+        return {key: loss_store_use.compute_learning_index(loss_key=key, method=method, rows=rows) for key in list_loss}
     if verbose > 0:
         print(rnn_folder, len(list_rnns), list_loss)
     # if len(list_rnns) > 20:
@@ -346,17 +447,15 @@ def compute_learning_index(rnn_folder=None, list_loss=['pred'], normalise_start=
     #     print(f'list rnns shortened for {rnn_folder}')
     n_rnn = len(list_rnns)
     assert n_rnn > 0, 'list of rnns is empty'
-    for i_rnn, rnn_name in enumerate(list_rnns):
-        rnn = load_rnn(os.path.join(rnn_folder, rnn_name))
+    for i_rnn, (_, rnn_fields) in enumerate(model_prefetch.iter_fields(paths=[os.path.join(rnn_folder, x) for x in list_rnns],
+                                        fields=['info_dict.n_epochs'] + [f'test_loss_split.{key}' for key in list_loss])):  # asserts that losses were saved
         if i_rnn == 0:
-            n_epochs = rnn.info_dict['n_epochs']
+            n_epochs = rnn_fields['info_dict.n_epochs']
             conv_dict = {key: np.zeros((n_rnn, n_epochs)) for key in list_loss}
         else:
-            assert rnn.info_dict['n_epochs'] == n_epochs, 'number of epochs not equal, this is not implemented explicitly when computing the integral'
+            assert rnn_fields['info_dict.n_epochs'] == n_epochs, 'number of epochs not equal, this is not implemented explicitly when computing the integral'
         for key in list_loss:
-            assert key in rnn.test_loss_split.keys(), f'{key} not saved for {rnn}. List of saved loss names: {rnn.test_loss_split.keys()}'
-            arr = rnn.test_loss_split[key]
-            conv_dict[key][i_rnn, :] = arr.copy()
+            conv_dict[key][i_rnn, :] = rnn_fields[f'test_loss_split.{key}']
     learn_eff = {}
     for key in list_loss:
         # print(list_loss, list_rnns)
@@ -365,27 +464,7 @@ def compute_learning_index(rnn_folder=None, list_loss=['pred'], normalise_start=
             assert False, 'normalise start not implemented'
             mat = mat / np.mean(mat[:, 0])#[:, np.newaxis]
         # plot_arr = np.mean(mat, 0)
-        if method == 'integral':
-            learn_eff[key] = np.mean(mat, 1)  # sum = integral, mean = divide by n epochs
-        elif method == 'mean_integral':
-            learn_eff[key] = np.zeros(mat.shape[0]) + np.mean(np.mean(mat, 1))
-        elif method == 'final_loss':
-            learn_eff[key] = np.mean(mat[:, -5:], 1)
-            # learn_eff[key] = np.mean(mat[:, :5], 1)
-        elif method == 'half_time':
-            half_time_ar = np.zeros(mat.shape[0])
-            for i_rnn in range(mat.shape[0]):
-                # half_time_ar[i_rnn] = np.argmin(np.abs(mat[i_rnn, :] - 0.5))
-                half_time_ar[i_rnn] = np.argmin(np.diff(mat[i_rnn, :]))
-            learn_eff[key] = half_time_ar
-        elif method == 'argmin_gradient':
-            min_grad_arr = np.zeros(mat.shape[0])
-            for i_rnn in range(mat.shape[0]):
-                grad = np.gradient(mat[i_rnn, :])
-                min_grad_arr[i_rnn] = np.argmin(grad)
-            learn_eff[key] = min_grad_arr
-        else:
-            assert False, f'Method {method} not implemented!'
+        learn_eff[key] = loss_store.compute_learning_index_mat(mat=mat, method=method)
         assert len(learn_eff[key]) == len(list_rnns)
 
     # if verbose > 0:
@@ -396,9 +475,9 @@ def calculate_all_learning_eff_indices(task_list=['dmc', 'dms'], ratio_exp_str='
                                        nature_stim_list=['onehot', 'periodic'], method='integral',
                                        sparsity_str_list = ['0e+00', '1e-06', '5e-06', '1e-05', '5e-05', '1e-04', '5e-04', '1e-03', '5e-03', '1e-02', '5e-02', '1e-01'],
                                        use_gridsweep_rnns=False, gridsweep_n_nodes='n_nodes_20',
-                                       eval_pred_loss_only=False):
+                                       eval_pred_loss_only=False, loss_store_use=None):
     """For each combination of conditions as given by input args, compute learning efficiency indeces
-    of each rnn and save everything in a df"""
+    of each rnn and save everything in a df. Loss curves are read from loss_store_use (LossStore) if given."""
     n_sim = 200
     n_loss_functions_per_sim = 4
     n_data = len(task_list) * len(nature_stim_list) * len(sparsity_str_list) * n_loss_functions_per_sim * n_sim
@@ -435,7 +514,7 @@ def calculate_all_learning_eff_indices(task_list=['dmc', 'dms'], ratio_exp_str='
                         list_keys = ['pred']  # set this one if you want check how pred went
                     learn_eff = compute_learning_index(rnn_folder=folder_rnns,
                                                           list_loss=list_keys,
-                                                          method=method,
+                                                          method=method, loss_store_use=loss_store_use,
                                                           rnn_max_date_bool=np.logical_not(use_gridsweep_rnns))
                     for loss_comp in list_keys:
                         for le in learn_eff[loss_comp]:
@@ -459,9 +538,9 @@ def calculate_all_learning_eff_indices(task_list=['dmc', 'dms'], ratio_exp_str='
 def calculate_all_learning_eff_indices_gridsweep(task_list=['dmc'], ratio_exp_str='7525',
                                                 nature_stim_list=['onehot'], method='final_loss',
                                                 sparsity_str_list = ['0e+00', '1e-05', '5e-05', '1e-04', '5e-04', '1e-03', '5e-03', '1e-02', '5e-02', '1e-01'],
-                                                n_nodes_list=['5', '10', '20', '30', '40', '50', '75', '100']):
+                                                n_nodes_list=['5', '10', '20', '30', '40', '50', '75', '100'], loss_store_use=None):
     """For each combination of conditions as given by input args, compute learning efficiency indeces
-    of each rnn and save everything in a df"""
+    of each rnn and save everything in a df. Loss curves are read from loss_store_use (LossStore) if given."""
     n_sim = 200  # 10 should be enough but cutting off
     n_loss_functions_per_sim = 2
     n_data = len(task_list) * len(nature_stim_list) * len(sparsity_str_list) * len(n_nodes_list) * n_loss_functions_per_sim * n_sim
@@ -495,7 +574,7 @@ def calculate_all_learning_eff_indices_gridsweep(task_list=['dmc'], ratio_exp_st
                             suffix = '_multi'
                         learn_eff = compute_learning_index(rnn_folder=folder_rnns,
                                                             list_loss=list_keys,
-                                                            method=method,
+                                                            method=method, loss_store_use=loss_store_use,
                                                             rnn_max_date_bool=False)
                         for loss_comp in list_keys:
                             for le in learn_eff[loss_comp]:
@@ -561,12 +640,21 @@ def count_datasets_sparsity_sweep(super_folder='/home/tplas/repos/eavesdropping/
 
     return pd.DataFrame(n_ds_dict)
 
-def ensure_corr_mat_exists(rnn, representation='s1'):
+def ensure_corr_mat_exists(rnn, representation='s1', data_seed=None):
     """if not pre-calculated, then calculate now:"""
     if hasattr(rnn, 'rep_corr_mat_dict') is False:
-        bpm.save_pearson_corr(rnn=rnn, representation=representation)
+        bpm.save_pearson_corr(rnn=rnn, representation=representation, data_seed=data_seed)
     elif representation not in rnn.rep_corr_mat_dict.keys():
-        bpm.save_pearson_corr(rnn=rnn, representation=representation)
+        bpm.save_pearson_corr(rnn=rnn, representation=representation, data_seed=data_seed)
+
+def get_corr_mat(rnn, representation='s1', data_seed=None):
+    """Correlation matrix of representation of rnn, calculated on a copy of rnn if not pre-calculated
+    (so that rnn, eg a cached model of load_rnn(), is not changed)."""
+    if hasattr(rnn, 'rep_corr_mat_dict') and representation in rnn.rep_corr_mat_dict.keys():
+        return rnn.rep_corr_mat_dict[representation]
+    rnn = copy.deepcopy(rnn)
+    bpm.save_pearson_corr(rnn=rnn, representation=representation, data_seed=data_seed)
+    return rnn.rep_corr_mat_dict[representation]
 
 def calculate_autotemp_different_epochs(rnn, epoch_list=[1, 2, 3, 4], autotemp_dec_dict=None):
     """Calculating autotemp accuracy of S1 for list of epochs of rnn, unless entry already exists in dict"""
@@ -627,15 +715,15 @@ def inspect_sparsity_effect_weights(super_folder='/home/tplas/repos/eavesdroppin
         for name_layer in layer_names:
             dict_layers[name_layer][spars_f] = {x: np.zeros(n_rnns) for x in metric_list}
         ## Load RNN
-        for i_rnn, rnn_name in enumerate(rnn_list):
+        for i_rnn, (_, rnn_weights) in enumerate(model_prefetch.iter_fields(paths=[os.path.join(rnn_folder, x) for x in rnn_list],
+                                                 fields=[f'weights.{name_layer}.weight' for name_layer in layer_names])):
             # if i_rnn == 4:
             #     break
-            rnn = load_rnn(rnn_name=os.path.join(rnn_folder, rnn_name))
             for name_layer in layer_names:
-                weights_tensor = rnn.state_dict()[f'{name_layer}.weight']
-                dict_layers[name_layer][spars_f]['L1'][i_rnn] = weights_tensor.norm(p=1)
-                dict_layers[name_layer][spars_f]['L2'][i_rnn] = weights_tensor.norm(p=2)
-                dict_layers[name_layer][spars_f]['number_nonzero'][i_rnn] = (weights_tensor.abs() > th_nz).sum().float() / weights_tensor.numel()
+                weights_arr = rnn_weights[f'weights.{name_layer}.weight']
+                dict_layers[name_layer][spars_f]['L1'][i_rnn] = np.sum(np.abs(weights_arr))
+                dict_layers[name_layer][spars_f]['L2'][i_rnn] = np.sqrt(np.sum(weights_arr ** 2))
+                dict_layers[name_layer][spars_f]['number_nonzero'][i_rnn] = np.sum(np.abs(weights_arr) > th_nz) / weights_arr.size
 
         ## Extract metrics from parameters of all layers
 
@@ -0,0 +1,23 @@
+## Shared fixtures of the tests. The modules of this repo are not a package, so the repo root is put on the path.
+
+import os, sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def make_rnn(file_name, n_nodes=10, seed=0):
+    '''Small untrained bptt_rnn.RNN_MNM with the info_dict entries used by decoding and the loss store.'''
+    import torch
+    import bptt_rnn as bp
+    torch.manual_seed(seed)
+    rnn = bp.RNN_MNM(n_stim=7, n_nodes=n_nodes)
+    rnn.set_info({'n_nodes': n_nodes, 'n_total': 200, 'n_times': 10, 'n_freq': 7,
+                  'noise_scale': 0.15, 'doublesse': False, 'n_epochs': 3})
+    rnn.test_loss_split['pred'] = np.random.RandomState(seed).rand(3)
+    rnn.file_name = file_name
+    return rnn
+
+@pytest.fixture
+def rnn_factory():
+    return make_rnn
@@ -0,0 +1,48 @@
+## Codecs of compressed arrays (compression.py): sniffing the codec from the data and streamed decompression.
+
+import io, zlib
+import numpy as np
+import pytest
+import compression
+
+@pytest.mark.parametrize('codec', compression.codecs)
+def test_compress_round_trip(codec):
+    if not compression.is_available(codec):
+        pytest.skip(f'{codec} not installed')
+    data = np.arange(10000, dtype=np.float32).tobytes()
+    compressed = compression.compress(data=data, codec=codec)
+    assert compression.get_codec(compressed) == codec
+    assert compression.decompress(compressed) == data
+
+def test_uncompressed_not_sniffed():
+    npy_bytes = compression.save_array_bytes(arr=np.zeros(3))
+    assert compression.get_codec(npy_bytes) is None
+    assert compression.decompress(npy_bytes) == npy_bytes
+
+@pytest.mark.parametrize('codec', [None] + compression.codecs)
+def test_load_array(codec):
+    if codec is not None and not compression.is_available(codec):
+        pytest.skip(f'{codec} not installed')
+    arr = np.random.RandomState(0).randn(50, 40)
+    data = compression.save_array_bytes(arr=arr, codec=codec)
+    assert np.array_equal(compression.load_array(io.BufferedReader(io.BytesIO(data))), arr)
+
+def test_zlib_stream_small_chunks():
+    data = np.random.RandomState(0).randint(0, 4, size=100000).astype(np.uint8).tobytes()
+    stream = io.BufferedReader(compression.ZlibStream(io.BytesIO(zlib.compress(data)), chunk_size=7))
+    assert stream.read() == data
+
+def test_zlib_stream_truncated():
+    compressed = zlib.compress(np.arange(10000).tobytes())
+    stream = io.BufferedReader(compression.ZlibStream(io.BytesIO(compressed[:len(compressed) // 2])))
+    with pytest.raises(EOFError):
+        stream.read()
+
+@pytest.mark.parametrize('codec', [None, 'zlib'])
+def test_array_file_round_trip(tmp_path, codec):
+    arr = np.arange(12, dtype=np.float64).reshape(3, 4)
+    path = str(tmp_path / 'arr.npy')
+    compression.save_array(path=path, arr=arr, codec=codec)
+    loaded = compression.load_array_file(path=path, mmap_mode='r')
+    assert np.array_equal(loaded, arr)
+    assert isinstance(loaded, np.memmap) == (codec is None)
@@ -0,0 +1,89 @@
+## Batched decoders (decoders.py) against sklearn, and the stratified splits of rot_utilities.py / decoders.py.
+
+import numpy as np
+import pytest
+import scipy.stats
+import sklearn
+import sklearn.discriminant_analysis
+import sklearn.model_selection
+import decoders
+import rot_utilities as ru
+
+def make_activity(n_trials=120, n_times=3, n_nodes=4, n_classes=3, seed=0):
+    rs = np.random.RandomState(seed)
+    labels = np.arange(n_trials) % n_classes
+    activity = rs.randn(n_trials, n_times, n_nodes) + labels[:, None, None] * rs.randn(n_times, n_nodes)
+    return activity, labels
+
+def reference_proba(activity_train, labels, activity_test, decoder_type):
+    """Posterior class probabilities of one time point with scipy Gaussian densities, with covariances
+    normalised as documented in decoders.fit_discriminant()."""
+    classes = np.unique(labels)
+    n_classes = len(classes)
+    centred = np.concatenate([activity_train[labels == lab] - activity_train[labels == lab].mean(0) for lab in classes])
+    pooled_cov = centred.T @ centred / (len(labels) - n_classes)
+    log_joint = np.zeros((len(activity_test), n_classes))
+    for i_class, lab in enumerate(classes):
+        cov = pooled_cov if decoder_type == 'LDA' else np.cov(activity_train[labels == lab].T)
+        log_joint[:, i_class] = (scipy.stats.multivariate_normal(mean=activity_train[labels == lab].mean(0), cov=cov).logpdf(activity_test) +
+                                 np.log(np.mean(labels == lab)))
+    return np.exp(log_joint - np.logaddexp.reduce(log_joint, axis=1, keepdims=True))
+
+@pytest.mark.parametrize('decoder_type', ['LDA', 'QDA'])
+def test_discriminant_matches_reference(decoder_type):
+    activity, labels = make_activity()
+    params = decoders.fit_discriminant(activity=activity, labels=labels, decoder_type=decoder_type)
+    proba = np.exp(decoders.discriminant_log_proba(params=params, activity=activity))[0]
+    for i_time in range(activity.shape[1]):
+        for i_test in range(activity.shape[1]):
+            assert np.allclose(proba[i_time, i_test], reference_proba(activity_train=activity[:, i_time, :], labels=labels,
+                               activity_test=activity[:, i_test, :], decoder_type=decoder_type), atol=1e-8)
+
+@pytest.mark.skipif(sklearn.__version__.split('.')[:2] != ['0', '21'], reason='covariance normalisation of sklearn 0.21 (py37.yml)')
+@pytest.mark.parametrize('decoder_type', ['LDA', 'QDA'])
+def test_discriminant_matches_sklearn(decoder_type):
+    activity, labels = make_activity()
+    params = decoders.fit_discriminant(activity=activity, labels=labels, decoder_type=decoder_type)
+    proba = np.exp(decoders.discriminant_log_proba(params=params, activity=activity))[0]
+    for i_time in range(activity.shape[1]):
+        if decoder_type == 'LDA':
+            sk_decoder = sklearn.discriminant_analysis.LinearDiscriminantAnalysis()
+        else:
+            sk_decoder = sklearn.discriminant_analysis.QuadraticDiscriminantAnalysis()
+        sk_decoder.fit(activity[:, i_time, :], labels)
+        for i_test in range(activity.shape[1]):
+            assert np.allclose(proba[i_time, i_test], sk_decoder.predict_proba(activity[:, i_test, :]), atol=1e-8)
+
+def test_unseen_test_labels_score_zero():
+    proba = np.full((1, 1, 1, 4, 2), 0.5)
+    with pytest.warns(UserWarning):
+        score = decoders.score_crosstemp(proba=proba, labels=np.array([0, 1, 2, 1]), classes=np.array([0, 1]))
+    assert np.isclose(score[0, 0, 0], 1.5 / 4)
+
+def test_stratified_split_matches_sklearn_counts():
+    labels = np.repeat([0, 1, 2], [50, 30, 21])
+    train_inds, test_inds = ru.stratified_split(labels=labels, ratio_train=0.8, rng=np.random.default_rng(0))
+    assert np.array_equal(np.sort(np.concatenate([train_inds, test_inds])), np.arange(len(labels)))
+    sk_train, _ = next(sklearn.model_selection.StratifiedShuffleSplit(n_splits=1, train_size=0.8, test_size=None,
+                                                                       random_state=0).split(np.zeros(len(labels)), labels))
+    assert len(train_inds) == len(sk_train)
+    assert np.all(np.abs(np.bincount(labels[train_inds]) - np.bincount(labels[sk_train])) <= 1)
+
+def test_stratified_kfold_partitions_trials():
+    labels = np.repeat([0, 1, 2], [17, 11, 9])
+    folds = decoders.stratified_kfold(labels=labels, n_folds=5, rng=np.random.default_rng(0))
+    assert len(folds) == 5
+    assert np.array_equal(np.sort(np.concatenate(folds)), np.arange(len(labels)))
+    fold_sizes = [len(inds_test) for inds_test in folds]
+    assert max(fold_sizes) - min(fold_sizes) <= 1
+    for lab in np.unique(labels):
+        class_counts = [np.sum(labels[inds_test] == lab) for inds_test in folds]
+        assert max(class_counts) - min(class_counts) <= 1
+
+def test_stratified_kfold_follows_global_seed():
+    labels = np.arange(40) % 2
+    np.random.seed(1)
+    folds_a = decoders.stratified_kfold(labels=labels)
+    np.random.seed(1)
+    folds_b = decoders.stratified_kfold(labels=labels)
+    assert all(np.array_equal(a, b) for a, b in zip(folds_a, folds_b))
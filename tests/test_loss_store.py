@@ -0,0 +1,36 @@
+## Loss store (loss_store.py): rebuilding over a previous store, and learning indices equal to those from the files.
+
+import os
+import numpy as np
+import pytest
+import model_catalog
+import loss_store
+import rot_utilities as ru
+
+@pytest.fixture
+def catalog_folder(tmp_path, rnn_factory):
+    folder = str(tmp_path / 'cell') + '/'
+    os.makedirs(folder)
+    catalog = model_catalog.ModelCatalog(db_path=str(tmp_path / 'catalog.sqlite'))
+    for i_rnn in range(4):
+        rnn_factory(f'rnn-mnm_2021-05-0{i_rnn + 1}-1200.data', seed=i_rnn).save_model(folder=folder, verbose=0)
+    catalog.rescan(root=str(tmp_path), verbose=0)
+    return catalog, folder
+
+def test_rebuild_and_learning_index(tmp_path, catalog_folder):
+    catalog, folder = catalog_folder
+    store_folder = str(tmp_path / 'loss_store') + '/'
+    loss_store.build_loss_store(catalog=catalog, store_folder=store_folder, verbose=0)
+    store = loss_store.build_loss_store(catalog=catalog, store_folder=store_folder, verbose=0)  # replaces previous store
+    assert sorted(os.listdir(str(tmp_path))) == ['catalog.sqlite', 'cell', 'loss_store']
+    from_files = ru.compute_learning_index(rnn_folder=folder, rnn_max_date_bool=False)
+    from_store = ru.compute_learning_index(rnn_folder=folder, rnn_max_date_bool=False, loss_store_use=store)
+    assert np.allclose(from_files['pred'], from_store['pred'])
+
+def test_stale_store(tmp_path, catalog_folder, rnn_factory):
+    catalog, folder = catalog_folder
+    store = loss_store.build_loss_store(catalog=catalog, store_folder=str(tmp_path / 'loss_store') + '/', verbose=0)
+    rnn_factory('rnn-mnm_2021-05-01-1200.data', seed=10).save_model(folder=folder, verbose=0)
+    os.utime(folder + 'rnn-mnm_2021-05-01-1200.data', (0, 0))
+    with pytest.raises(AssertionError, match='changed since'):
+        ru.compute_learning_index(rnn_folder=folder, rnn_max_date_bool=False, loss_store_use=store)
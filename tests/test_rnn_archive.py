@@ -0,0 +1,67 @@
+## Archives of model folders (rnn_archive.py): appending shards, reading archived paths and compaction.
+
+import os
+import numpy as np
+import torch
+import rnn_archive
+import rnn_io
+import model_catalog
+
+def save_models(folder, rnn_factory, n_models=3):
+    rnns = [rnn_factory(f'rnn-mnm_2021-05-0{i_rnn + 1}-1200.data', seed=i_rnn) for i_rnn in range(n_models)]
+    for rnn in rnns:
+        rnn.save_model(folder=folder, verbose=0)
+    return rnns
+
+def test_archive_folder_round_trip(tmp_path, rnn_factory):
+    folder = str(tmp_path / 'cell')
+    os.makedirs(folder)
+    rnns = save_models(folder=folder, rnn_factory=rnn_factory)
+    archive = rnn_archive.archive_folder(folder, remove_files=True)
+    assert not os.path.exists(folder)
+    assert archive.list_models() == sorted(rnn.file_name for rnn in rnns)
+    for rnn in rnns:
+        path = os.path.join(folder, rnn.file_name)
+        loaded = rnn_io.load_model(path=path)  # via the archive
+        assert torch.equal(loaded.lin_feedback.weight, rnn.lin_feedback.weight)
+        assert rnn_io.read_fields(path=path, fields=['info_dict.n_nodes'])['info_dict.n_nodes'] == rnn.info_dict['n_nodes']
+    stacked = archive.read_stacked(member='weights/lin_input.weight.npy')
+    assert np.array_equal(stacked, np.stack([rnn.lin_input.weight.detach().numpy() for rnn in rnns]))
+
+def test_append_newest_shard_wins_and_compact(tmp_path, rnn_factory):
+    folder = str(tmp_path / 'cell')
+    os.makedirs(folder)
+    rnns = save_models(folder=folder, rnn_factory=rnn_factory)
+    archive = rnn_archive.archive_folder(folder, remove_files=True)
+    path = os.path.join(folder, rnns[0].file_name)
+    stat_before = model_catalog.get_file_stat(path=path)
+
+    new_rnn = rnn_factory(rnns[0].file_name, seed=10)  # new version of the first model
+    archive.append([new_rnn])
+    assert len(archive.list_shards()) == 2
+    assert model_catalog.get_file_stat(path=path) != stat_before  # now in the new shard
+    assert torch.equal(rnn_io.load_model(path=path).lin_input.weight, new_rnn.lin_input.weight)
+
+    archive.compact()
+    assert len(archive.list_shards()) == 1
+    assert archive.list_models() == sorted(rnn.file_name for rnn in rnns)
+    assert torch.equal(rnn_io.load_model(path=path).lin_input.weight, new_rnn.lin_input.weight)
+    other_path = os.path.join(folder, rnns[1].file_name)
+    assert torch.equal(rnn_io.load_model(path=other_path).lin_input.weight, rnns[1].lin_input.weight)
+
+def test_shard_index_is_kept(tmp_path, rnn_factory, monkeypatch):
+    folder = str(tmp_path / 'cell')
+    os.makedirs(folder)
+    rnns = save_models(folder=folder, rnn_factory=rnn_factory)
+    archive = rnn_archive.archive_folder(folder, remove_files=True)
+    path = os.path.join(folder, rnns[0].file_name)
+    model_catalog.get_file_stat(path=path)
+    n_calls = []
+    list_shards = rnn_archive.RNNArchive.list_shards
+    monkeypatch.setattr(rnn_archive.RNNArchive, 'list_shards', lambda self: n_calls.append(1) or list_shards(self))
+    for _ in range(10):
+        model_catalog.get_file_stat(path=path)
+    assert len(n_calls) == 0  # archive folder did not change
+    archive.append([rnn_factory('rnn-mnm_2021-05-09-1200.data')])
+    model_catalog.get_file_stat(path=path)
+    assert len(n_calls) == 1
@@ -0,0 +1,75 @@
+## Round trips of the structured model file format (rnn_io.py) and atomic writes.
+
+import os
+import numpy as np
+import pytest
+import torch
+import compression
+import rnn_io
+
+def assert_same_model(rnn, loaded):
+    assert type(loaded) == type(rnn)
+    assert loaded.file_name == rnn.file_name
+    assert loaded.info_dict == rnn.info_dict
+    state, loaded_state = rnn.state_dict(), loaded.state_dict()
+    assert state.keys() == loaded_state.keys()
+    for key in state.keys():
+        assert torch.equal(state[key], loaded_state[key]), key
+    assert np.array_equal(loaded.test_loss_split['pred'], rnn.test_loss_split['pred'])
+
+@pytest.mark.parametrize('codec', [None, 'zlib', 'zstd', 'lz4'])
+def test_write_load_round_trip(tmp_path, rnn_factory, codec):
+    if codec is not None and not compression.is_available(codec):
+        pytest.skip(f'{codec} not installed')
+    rnn = rnn_factory('rnn-mnm_test.data')
+    path = str(tmp_path / rnn.file_name)
+    rnn_io.write_atomic(path=path, write_function=lambda file_handle: rnn_io.write_model(rnn=rnn, file_handle=file_handle, codec=codec))
+    assert rnn_io.is_structured(path=path)
+    assert_same_model(rnn, rnn_io.load_model(path=path))
+    with open(path, 'rb') as f:
+        assert_same_model(rnn, rnn_io.load_model_bytes(data=f.read(), path=path))
+
+def test_read_fields(tmp_path, rnn_factory):
+    rnn = rnn_factory('rnn-mnm_test.data')
+    rnn.save_model(folder=str(tmp_path), verbose=0)
+    fields = rnn_io.read_fields(path=rnn.full_path, fields=['info_dict.n_nodes', 'test_loss_split.pred', 'weights.lin_input.weight'])
+    assert fields['info_dict.n_nodes'] == rnn.info_dict['n_nodes']
+    assert np.array_equal(fields['test_loss_split.pred'], rnn.test_loss_split['pred'])
+    assert np.array_equal(fields['weights.lin_input.weight'], rnn.lin_input.weight.detach().numpy())
+
+def test_save_model_pickle_format(tmp_path, rnn_factory):
+    rnn = rnn_factory('rnn-mnm_test.data')
+    rnn.save_model(folder=str(tmp_path), verbose=0, file_format='pickle')
+    assert not rnn_io.is_structured(path=rnn.full_path)
+    assert_same_model(rnn, rnn_io.load_model(path=rnn.full_path))
+
+def test_save_model_leaves_no_temporary_files(tmp_path, rnn_factory):
+    rnn = rnn_factory('rnn-mnm_test.data')
+    rnn.save_model(folder=str(tmp_path), verbose=0)
+    rnn.save_model(folder=str(tmp_path), verbose=0)  # overwrite
+    assert os.listdir(str(tmp_path)) == ['rnn-mnm_test.data']
+
+def test_write_atomic_exclusive(tmp_path):
+    path = str(tmp_path / 'file.bin')
+    assert rnn_io.write_atomic(path=path, write_function=lambda f: f.write(b'first'), exclusive=True)
+    assert not rnn_io.write_atomic(path=path, write_function=lambda f: f.write(b'second'), exclusive=True)
+    with open(path, 'rb') as f:
+        assert f.read() == b'first'
+    assert rnn_io.write_atomic(path=path, write_function=lambda f: f.write(b'third'))
+    with open(path, 'rb') as f:
+        assert f.read() == b'third'
+    assert os.listdir(str(tmp_path)) == ['file.bin']
+
+def test_write_atomic_failure_keeps_file(tmp_path):
+    path = str(tmp_path / 'file.bin')
+    rnn_io.write_atomic(path=path, write_function=lambda f: f.write(b'first'))
+
+    def failing_write(f):
+        f.write(b'partial')
+        raise RuntimeError('write failed')
+
+    with pytest.raises(RuntimeError):
+        rnn_io.write_atomic(path=path, write_function=failing_write)
+    with open(path, 'rb') as f:
+        assert f.read() == b'first'
+    assert os.listdir(str(tmp_path)) == ['file.bin']  # temporary file removed